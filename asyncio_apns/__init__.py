@@ -1,7 +1,21 @@
 from .apns_connection import connect, APNsConnection, NotificationPriority
-from .errors import APNsError, APNsDisconnectError
-from .payload import Payload, PayloadAlert
-from .retrying import RetryingProxy
+from .auth import ProviderToken
+from .durable import DurableSender, SegmentLog
+from .errors import APNsError, APNsDisconnectError, APNsExpiredError, PayloadTooLargeError, Reason
+from .invalid_tokens import InvalidToken, InvalidTokenCache
+from .limiter import AIMDLimiter
+from .metrics import Metrics, MetricsRecorder
+from .payload import (Payload, PayloadAlert, CompiledPayload, PayloadTemplate, Slot, MAX_PAYLOAD_SIZE,
+                      VOIP_MAX_PAYLOAD_SIZE)
+from .pool import APNsConnectionPool
+from .retrying import RetryBudget, RetryingProxy, RetryPolicy
+from .scheduler import Scheduler
+from .sharding import ShardedSender
 
 __all__ = ['connect', 'APNsConnection', 'NotificationPriority', 'APNsError',
-           'APNsDisconnectError', 'Payload', 'PayloadAlert', 'RetryingProxy']
+           'APNsDisconnectError', 'APNsExpiredError', 'Payload', 'PayloadAlert', 'CompiledPayload',
+           'APNsConnectionPool', 'ProviderToken', 'Metrics', 'MetricsRecorder',
+           'RetryingProxy', 'RetryPolicy', 'RetryBudget', 'AIMDLimiter', 'Reason', 'InvalidToken',
+           'InvalidTokenCache', 'Scheduler', 'ShardedSender', 'SegmentLog',
+           'DurableSender', 'PayloadTemplate', 'Slot', 'PayloadTooLargeError',
+           'MAX_PAYLOAD_SIZE', 'VOIP_MAX_PAYLOAD_SIZE']
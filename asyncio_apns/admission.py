@@ -0,0 +1,121 @@
+import asyncio
+import collections
+
+
+class StreamAdmission:
+    """FIFO admission of requests to the streams of one HTTP/2 connection.
+
+    ``capacity`` returns the current stream limit of the connection.
+    A freed slot is handed straight to the oldest waiter, so a newcomer
+    can never overtake a queued request. ``reserved`` slots are only
+    given to high priority requests, which are also served first. At
+    most ``max_queue`` requests wait for a slot, further ones wait for
+    room in the queue.
+    """
+
+    def __init__(self, capacity, *, max_queue=None, reserved=0, loop=None):
+        self._capacity = capacity
+        self.max_queue = max_queue
+        self.reserved = reserved
+        self.active = 0
+        self._high = collections.deque()
+        self._low = collections.deque()
+        self._room_waiters = collections.deque()
+        self._loop = loop
+
+    @property
+    def queue_depth(self):
+        return len(self._high) + len(self._low)
+
+    @property
+    def high_priority_queue_depth(self):
+        return len(self._high)
+
+    def _can_admit(self, high_priority):
+        limit = self._capacity()
+        if not high_priority:
+            limit -= self.reserved
+        return self.active < limit
+
+    def _queue_full(self):
+        return self.max_queue is not None and self.queue_depth >= self.max_queue
+
+    @asyncio.coroutine
+    def _wait(self, queue, timeout, handed_over):
+        waiter = asyncio.Future(loop=self._loop)
+        queue.append(waiter)
+        try:
+            if timeout is None:
+                yield from waiter
+            else:
+                yield from asyncio.wait_for(waiter, max(timeout, 0), loop=self._loop)
+        except BaseException:
+            if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                # woken in the same iteration the wait was abandoned, pass the wakeup on
+                handed_over()
+            else:
+                try:
+                    queue.remove(waiter)
+                except ValueError:
+                    pass
+            raise
+
+    @asyncio.coroutine
+    def acquire(self, high_priority=True, timeout=None):
+        """Waits for a stream slot, raises ``asyncio.TimeoutError`` after ``timeout`` seconds.
+
+        Returns whether the request had to wait.
+        """
+        if high_priority:
+            nobody_ahead = not self._high
+        else:
+            nobody_ahead = not self._high and not self._low
+        if nobody_ahead and self._can_admit(high_priority):
+            self.active += 1
+            return False
+        deadline = None
+        if timeout is not None:
+            loop = self._loop or asyncio.get_event_loop()
+            deadline = loop.time() + timeout
+        while self._queue_full():
+            # backpressure: the producer waits until the queue has room again
+            yield from self._wait(self._room_waiters, None if deadline is None else deadline - loop.time(),
+                                  self._wake_room_waiter)
+        try:
+            yield from self._wait(self._high if high_priority else self._low,
+                                  None if deadline is None else deadline - loop.time(), self.release)
+        finally:
+            self._wake_room_waiter()
+        return True
+
+    def release(self):
+        self.active -= 1
+        self.dispatch()
+
+    def dispatch(self):
+        """Hands free slots to waiters, also called when the stream limit changes."""
+        while True:
+            if self._high and self._can_admit(True):
+                waiter = self._high.popleft()
+            elif self._low and self._can_admit(False):
+                waiter = self._low.popleft()
+            else:
+                break
+            if waiter.done():
+                continue
+            self.active += 1
+            waiter.set_result(None)
+
+    def _wake_room_waiter(self):
+        while self._room_waiters and not self._queue_full():
+            waiter = self._room_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    def fail(self, exc):
+        for queue in (self._high, self._low, self._room_waiters):
+            while queue:
+                waiter = queue.popleft()
+                if not waiter.done():
+                    waiter.set_exception(exc)
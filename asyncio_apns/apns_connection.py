@@ -1,15 +1,34 @@
 import asyncio
-import json
+import collections
+import functools
 import enum
-from typing import Union, Sequence, Tuple, Optional
-from .errors import APNsError, APNsDisconnectError
-from .h2_client import H2ClientProtocol, HTTP2Error, HTTPMethod, DisconnectError
-from .payload import Payload
+import re
+import sys
+import time
+from typing import Union, Sequence, Tuple, Optional, Iterable, AsyncIterable, Mapping
+from .auth import ProviderToken
+from .bulk import SendResults
+from .errors import APNsError, APNsDisconnectError, APNsExpiredError, Reason
+from .h2_client import (DEFAULT_PING_TIMEOUT, H2ClientProtocol, HTTP2Error, HTTPMethod, DisconnectError,
+                        UnprocessedStreamError)
+from .invalid_tokens import INVALID_TOKEN_REASONS, InvalidTokenCache
+from .limiter import AIMDLimiter, OVERLOAD_STATUSES
+from .metrics import Metrics
+from .payload import Payload, CompiledPayload
 
 
 PRODUCTION_SERVER_ADDR = "api.push.apple.com"
 DEVELOPMENT_SERVER_ADDR = "api.development.push.apple.com"
 
+HEADER_TEMPLATES_CACHE_SIZE = 128
+
+# how many times a request the server never processed is sent again at once
+UNPROCESSED_RESEND_ATTEMPTS = 3
+
+# a failed standby connect is tried again after this delay, doubled on every failure in a row
+STANDBY_RETRY_DELAY = 1.0
+MAX_STANDBY_RETRY_DELAY = 60.0
+
 
 class NotificationPriority(enum.IntEnum):
     immediate = 10
@@ -17,95 +36,391 @@ class NotificationPriority(enum.IntEnum):
 
 
 @asyncio.coroutine
-def connect(cert_file: str, key_file: str, *, development=False, loop=None):
+def connect(cert_file: Optional[str] = None, key_file: Optional[str] = None, *,
+            auth_token: Optional[ProviderToken] = None, development=False,
+            coalesce_writes=False, metrics: Optional[Metrics] = None, standby_connections=0,
+            ping_interval: Optional[float] = None, adaptive_concurrency=False, loop=None):
     server_addr = DEVELOPMENT_SERVER_ADDR if development else PRODUCTION_SERVER_ADDR
-    connection = APNsConnection(cert_file, key_file, server_addr=server_addr, loop=loop)
+    connection = APNsConnection(cert_file, key_file, auth_token=auth_token, server_addr=server_addr,
+                                coalesce_writes=coalesce_writes, metrics=metrics,
+                                standby_connections=standby_connections, ping_interval=ping_interval,
+                                adaptive_concurrency=adaptive_concurrency, loop=loop)
     yield from connection.connect()
     return connection
 
 
-def _get_apns_id(headers: dict):
+def _compile_payload(payload: Union[Payload, CompiledPayload, str]) -> CompiledPayload:
+    if isinstance(payload, CompiledPayload):
+        return payload
+    if not isinstance(payload, Payload):
+        payload = Payload(payload)
+    return payload.compile()
+
+
+def _to_bytes(value) -> bytes:
+    return value if isinstance(value, bytes) else str(value).encode()
+
+
+# error bodies are small JSON objects, only the reason is picked out of them
+_REASON_RE = re.compile(rb'"reason"\s*:\s*"([^"]*)"')
+_TIMESTAMP_RE = re.compile(rb'"timestamp"\s*:\s*(\d+)')
+_REASONS = {reason.value.encode(): reason for reason in Reason}
+
+
+def _error_reason(exc) -> Optional[Union[Reason, str]]:
+    if not exc.data:
+        return None
+    match = _REASON_RE.search(exc.data)
+    if match is None:
+        return None
+    raw = match.group(1)
+    reason = _REASONS.get(raw)
+    return reason if reason is not None else sys.intern(raw.decode())
+
+
+def _error_timestamp(exc) -> Optional[int]:
+    match = _TIMESTAMP_RE.search(exc.data) if exc.data else None
+    return int(match.group(1)) if match is not None else None
+
+
+def _get_apns_id(headers: Mapping):
     return headers.get("apns-id")
 
 
 class APNsConnection:
-    def __init__(self, cert_file: str, key_file: str, *, loop=None,
-                 server_addr=PRODUCTION_SERVER_ADDR, server_port=443):
+    def __init__(self, cert_file: Optional[str] = None, key_file: Optional[str] = None, *,
+                 auth_token: Optional[ProviderToken] = None, loop=None,
+                 server_addr=PRODUCTION_SERVER_ADDR, server_port=443, coalesce_writes=False,
+                 metrics: Optional[Metrics] = None, max_queue: Optional[int] = None,
+                 reserved_immediate_streams=0, queue_timeout: Optional[float] = None,
+                 standby_connections=0, ping_interval: Optional[float] = None,
+                 ping_timeout: Optional[float] = DEFAULT_PING_TIMEOUT, adaptive_concurrency=False,
+                 invalid_tokens: Optional[InvalidTokenCache] = None):
+        if auth_token is None and not (cert_file and key_file):
+            raise ValueError("either cert_file and key_file or auth_token must be given")
         self.protocol = None
         self.cert_file = cert_file
         self.key_file = key_file
+        # with provider token authentication the topic must be set per message
+        self.auth_token = auth_token
         self.server_addr = server_addr
         self.server_port = server_port
+        self.coalesce_writes = coalesce_writes
+        self.metrics = metrics
+        # requests waiting for a free stream: at most max_queue of them, each for at most queue_timeout
+        self.max_queue = max_queue
+        self.reserved_immediate_streams = reserved_immediate_streams
+        self.queue_timeout = queue_timeout
+        # handshaken connections kept ready to replace the active one without handshake latency
+        self.standby_connections = standby_connections
+        self._standby = collections.deque()
+        self._standby_task = None
+        self._standby_retry = None  # TimerHandle of the next attempt after a failure
+        self._standby_retry_delay = STANDBY_RETRY_DELAY
+        # idle connections are checked with PING, dead ones are dropped after ping_timeout
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        # limits requests in flight below what MAX_CONCURRENT_STREAMS allows when APNs slows down or throttles
+        self.limiter = AIMDLimiter(loop=loop) if adaptive_concurrency else None
+        # tokens APNs rejected as invalid are not sent to again, the cache may be shared by connections
+        self.invalid_tokens = invalid_tokens
         self._loop = loop
         self._connection_task = None
+        self._header_templates = dict()  # (priority, topic, extra_headers) -> (head, tail)
 
     @property
     def connected(self):
         return self.protocol is not None and self.protocol.connected
 
+    @property
+    def queue_depth(self):
+        depth = self.protocol.queue_depth if self.connected else 0
+        if self.limiter is not None:
+            depth += self.limiter.queue_depth
+        return depth
+
+    @property
+    def rtt(self):
+        """Round trip time measured by the last keepalive PING, None if unknown."""
+        return self.protocol.rtt if self.connected else None
+
+    @property
+    def standby_ready(self):
+        return sum(1 for protocol in self._standby if protocol.connected)
+
     @asyncio.coroutine
-    def _do_connect(self):
+    def _open_protocol(self):
         verify_ssl = self.server_addr in (PRODUCTION_SERVER_ADDR, DEVELOPMENT_SERVER_ADDR)
-        self.protocol = yield from H2ClientProtocol.connect(
+        return (yield from H2ClientProtocol.connect(
                 self.server_addr, self.server_port, cert_file=self.cert_file,
-                key_file=self.key_file, verify_ssl=verify_ssl, loop=self._loop)
+                key_file=self.key_file, verify_ssl=verify_ssl,
+                coalesce_writes=self.coalesce_writes, metrics=self.metrics, max_queue=self.max_queue,
+                reserved_streams=self.reserved_immediate_streams, ping_interval=self.ping_interval,
+                ping_timeout=self.ping_timeout, loop=self._loop))
+
+    def _take_standby(self):
+        while self._standby:
+            protocol = self._standby.popleft()
+            if protocol.connected:
+                protocol.on_closed = None
+                return protocol
+        return None
 
     @asyncio.coroutine
-    def connect(self):
-        if self.connected:
+    def _do_connect(self):
+        protocol = self._take_standby()
+        if protocol is None:
+            protocol = yield from self._open_protocol()
+        self.protocol = protocol
+        self.protocol.on_goaway = self._on_goaway
+        if self.standby_connections:
+            self.protocol.on_closed = self._on_closed
+            self._fill_standby()
+
+    @asyncio.coroutine
+    def _do_fill_standby(self):
+        while self.standby_ready < self.standby_connections:
+            protocol = yield from self._open_protocol()
+            protocol.on_closed = self._on_standby_closed
+            self._standby.append(protocol)
+
+    def _standby_done(self, task):
+        self._standby_task = None
+        if task.cancelled():
             return
-        if self._connection_task:
-            yield from self._connection_task
+        if task.exception() is None:
+            self._standby_retry_delay = STANDBY_RETRY_DELAY
             return
-        try:
-            self._connection_task = self._loop.create_task(self._do_connect())
-            yield from self._connection_task
-        finally:
+        if self.metrics is not None:
+            self.metrics.standby_connect_failed(task.exception())
+        loop = self._loop or asyncio.get_event_loop()
+        self._standby_retry = loop.call_later(self._standby_retry_delay, self._retry_standby)
+        self._standby_retry_delay = min(self._standby_retry_delay * 2, MAX_STANDBY_RETRY_DELAY)
+
+    def _retry_standby(self):
+        self._standby_retry = None
+        self._fill_standby()
+
+    def _fill_standby(self):
+        if self._standby_retry is not None:
+            # waiting out the backoff of a failed attempt
+            return
+        if self._standby_task is None and self.standby_ready < self.standby_connections:
+            self._standby_task = asyncio.ensure_future(self._do_fill_standby(), loop=self._loop)
+            self._standby_task.add_done_callback(self._standby_done)
+
+    def _on_standby_closed(self, protocol):
+        # closed by the server while idle
+        if protocol in self._standby:
+            self._standby.remove(protocol)
+            self._fill_standby()
+
+    def _on_closed(self, protocol):
+        if protocol is self.protocol:
+            self._start_connect()
+
+    def _connect_done(self, task):
+        # a task cancelled by disconnect() may finish after a new one started
+        if self._connection_task is task:
             self._connection_task = None
+        if not task.cancelled():
+            # retrieved here so that a failed background reconnect is not reported as lost
+            task.exception()
+
+    def _start_connect(self):
+        if self._connection_task is None:
+            self._connection_task = asyncio.ensure_future(self._do_connect(), loop=self._loop)
+            self._connection_task.add_done_callback(self._connect_done)
+        return self._connection_task
+
+    @asyncio.coroutine
+    def connect(self):
+        if self.connected:
+            return
+        task = self._start_connect()
+        # not awaited directly, a cancelled caller must not cancel the connect shared with others
+        yield from asyncio.wait([task], loop=self._loop)
+        if task.cancelled():
+            # disconnect() was called meanwhile
+            raise APNsDisconnectError(None)
+        task.result()
+
+    def _on_goaway(self, protocol):
+        # the replacement handshake starts right away, new messages go to it
+        # while the old connection is closed by the server
+        if protocol is self.protocol:
+            self._start_connect()
 
     def disconnect(self):
-        self.protocol.disconnect()
+        if self._connection_task is not None:
+            # a reconnect finishing later would set self.protocol again
+            self._connection_task.cancel()
+            self._connection_task = None
+        if self._standby_task is not None:
+            self._standby_task.cancel()
+        if self._standby_retry is not None:
+            self._standby_retry.cancel()
+            self._standby_retry = None
+        self._standby_retry_delay = STANDBY_RETRY_DELAY
+        while self._standby:
+            protocol = self._standby.popleft()
+            protocol.on_closed = None
+            protocol.disconnect()
+        if self.protocol is not None:
+            self.protocol.disconnect()
         self.protocol = None
 
-    def _prepare_request(self, payload: Union[Payload, str], token: str,
-                         priority: NotificationPriority, topic: str,
-                         extra_headers: Optional[Sequence[Tuple[str, str]]]):
-        if not isinstance(payload, Payload):
-            payload = Payload(payload)
-        data = json.dumps(payload.as_dict()).encode()
-        request_headers = [
-            (':method', HTTPMethod.POST.value),
-            (':authority', self.server_addr),
-            (':scheme', 'https'),
-            (':path', "/3/device/{}".format(token)),
-            ('content-length', str(len(data))),
-            ('apns-priority', str(priority.value))
-        ]
+    def _build_header_template(self, priority: NotificationPriority, topic: Optional[str],
+                               extra_headers: Optional[Tuple[Tuple[str, str], ...]]):
+        # pseudo-headers go first, per-request :path and content-length are put between head and tail
+        head = (
+            (b':method', HTTPMethod.POST.value.encode()),
+            (b':authority', self.server_addr.encode()),
+            (b':scheme', b'https'),
+        )
+        tail = [(b'apns-priority', _to_bytes(priority.value))]
         if topic:
-            request_headers.append(('apns-topic', topic))
+            tail.append((b'apns-topic', _to_bytes(topic)))
         if extra_headers:
-            request_headers.extend(extra_headers)
-        return request_headers, data
+            tail.extend((_to_bytes(name), _to_bytes(value)) for name, value in extra_headers)
+        return head, tuple(tail)
+
+    def _header_template(self, priority: NotificationPriority, topic: Optional[str],
+                         extra_headers: Optional[Sequence[Tuple[str, str]]]):
+        # pairs may come as lists, from JSON for instance, and lists are not hashable
+        key = (priority, topic, tuple(tuple(header) for header in extra_headers) if extra_headers else None)
+        template = self._header_templates.get(key)
+        if template is None:
+            if len(self._header_templates) >= HEADER_TEMPLATES_CACHE_SIZE:
+                # per-message extra headers would otherwise grow the cache without bound
+                self._header_templates.clear()
+            template = self._header_templates[key] = self._build_header_template(*key)
+        return template
+
+    def _prepare_request(self, payload: Union[Payload, CompiledPayload, str], token: str,
+                         priority: NotificationPriority, topic: str,
+                         extra_headers: Optional[Sequence[Tuple[str, str]]], apns_id: Optional[str] = None,
+                         expiration: Optional[int] = None):
+        payload = _compile_payload(payload)
+        head, tail = self._header_template(priority, topic, extra_headers)
+        request_headers = head + (
+            (b':path', b'/3/device/' + token.encode()),
+            (b'content-length', payload.content_length),
+        ) + tail
+        # unique per message, kept out of the cached templates
+        if apns_id is not None:
+            request_headers += ((b'apns-id', apns_id.encode()),)
+        if expiration is not None:
+            request_headers += ((b'apns-expiration', str(int(expiration)).encode()),)
+        if self.auth_token is not None:
+            request_headers += ((b'authorization', self.auth_token.header_value),)
+        return request_headers, payload.data
 
     @asyncio.coroutine
-    def send_message(self, payload: Union[Payload, str], token: str,
+    def send_message(self, payload: Union[Payload, CompiledPayload, str], token: str,
                      priority: NotificationPriority = NotificationPriority.immediate,
-                     topic: str = None, extra_headers: Optional[Sequence[Tuple[str, str]]] = None):
-        if not self.connected:
-            yield from self.connect()
-        headers, data = self._prepare_request(payload, token, priority, topic, extra_headers)
+                     topic: str = None, extra_headers: Optional[Sequence[Tuple[str, str]]] = None,
+                     queue_timeout: Optional[float] = None, apns_id: Optional[str] = None,
+                     expiration: Optional[int] = None, deadline: Optional[float] = None):
+        """Sends a notification and returns its apns-id.
+
+        ``apns_id`` sets the id instead of letting APNs generate one.
+        ``expiration`` (unix time) is sent as apns-expiration, APNs stops
+        trying to deliver the notification then. ``deadline`` (unix time)
+        is local: a message still waiting for a stream at that time is
+        dropped with ``APNsExpiredError``. A non-zero ``expiration`` is
+        also a deadline.
+        """
+        if self.invalid_tokens is not None:
+            invalid = self.invalid_tokens.get(token)
+            if invalid is not None:
+                raise APNsError(invalid.reason, None, invalid.code)
+        started = time.monotonic() if self.metrics is not None else None
+        if expiration:
+            deadline = expiration if deadline is None else min(deadline, expiration)
+        headers, data = self._prepare_request(payload, token, priority, topic, extra_headers, apns_id, expiration)
+        if self.limiter is None:
+            return (yield from self._send_request(token, headers, data, priority, queue_timeout, started,
+                                                  deadline))
+        limiter_started = yield from self.limiter.acquire()
+        overloaded = answered = False
         try:
-            headers, _ = yield from self.protocol.send_request(headers, data)
-            return _get_apns_id(headers)
-        except HTTP2Error as exc:
-            error_data = exc.json_data()
-            reason = None
-            if error_data is not None:
-                reason = error_data.get("reason")
-            raise APNsError(reason, _get_apns_id(exc.headers))
-        except DisconnectError as exc:
-            error_data = exc.json_data()
-            reason = None
-            if error_data is not None:
-                reason = error_data.get("reason")
-            raise APNsDisconnectError(reason)
+            apns_id = yield from self._send_request(token, headers, data, priority, queue_timeout, started,
+                                                    deadline)
+            answered = True
+            return apns_id
+        except APNsError as exc:
+            overloaded = exc.code in OVERLOAD_STATUSES
+            raise
+        finally:
+            # only the latency of delivered messages is a congestion signal
+            self.limiter.release(limiter_started, overloaded=overloaded, sample=answered)
+
+    @asyncio.coroutine
+    def _send_request(self, token: str, headers, data, priority: NotificationPriority,
+                      queue_timeout: Optional[float], started: Optional[float], deadline: Optional[float]):
+        resend_attempts = UNPROCESSED_RESEND_ATTEMPTS
+        if queue_timeout is None:
+            queue_timeout = self.queue_timeout
+        while True:
+            timeout = queue_timeout
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise self._expired(started)
+                timeout = remaining if timeout is None else min(timeout, remaining)
+            if not self.connected:
+                yield from self.connect()
+            try:
+                response_headers, _ = yield from self.protocol.send_request(
+                    headers, data, high_priority=priority == NotificationPriority.immediate, timeout=timeout)
+                if started is not None:
+                    self.metrics.message_done(time.monotonic() - started, None)
+                return _get_apns_id(response_headers)
+            except HTTP2Error as exc:
+                reason = _error_reason(exc)
+                timestamp = _error_timestamp(exc) if exc.code == 410 else None
+                if reason is Reason.ExpiredProviderToken and self.auth_token is not None:
+                    self.auth_token.invalidate()
+                elif reason in INVALID_TOKEN_REASONS and self.invalid_tokens is not None:
+                    self.invalid_tokens.add(token, reason, exc.code, timestamp)
+                if started is not None:
+                    self.metrics.message_done(time.monotonic() - started, reason)
+                raise APNsError(reason, _get_apns_id(exc.headers), exc.code, timestamp)
+            except DisconnectError as exc:
+                if isinstance(exc, UnprocessedStreamError) and resend_attempts:
+                    # never reached APNs, no need to wait before sending it over a new connection
+                    resend_attempts -= 1
+                    continue
+                reason = _error_reason(exc)
+                if started is not None:
+                    self.metrics.message_done(time.monotonic() - started, reason or "Disconnected")
+                raise APNsDisconnectError(reason)
+            except asyncio.TimeoutError:
+                if deadline is not None and time.time() >= deadline:
+                    raise self._expired(started) from None
+                raise
+
+    def _expired(self, started: Optional[float]) -> APNsExpiredError:
+        if started is not None:
+            self.metrics.message_done(time.monotonic() - started, "Expired")
+        return APNsExpiredError()
+
+    def send_many(self, payload: Union[Payload, CompiledPayload, str],
+                  tokens: Union[Iterable[str], AsyncIterable[str]],
+                  *, max_in_flight=1000, **kwargs) -> SendResults:
+        """Sends one payload to every token, yielding ``(token, apns-id or error)`` as requests complete."""
+        # encoded once, only the :path header differs between recipients
+        payload = _compile_payload(payload)
+        return SendResults(functools.partial(self.send_message, **kwargs), tokens, payload=payload,
+                           max_in_flight=max_in_flight, loop=self._loop)
+
+    def send_many_pairs(self, pairs: Union[Iterable[Tuple[str, Union[Payload, CompiledPayload, str]]],
+                                           AsyncIterable[Tuple[str, Union[Payload, CompiledPayload, str]]]],
+                        *, max_in_flight=1000, **kwargs) -> SendResults:
+        """Like ``send_many``, but every item is a ``(token, payload)`` pair.
+
+        Pairs sharing a ``CompiledPayload`` reuse its encoded bytes.
+        """
+        return SendResults(functools.partial(self.send_message, **kwargs), pairs,
+                           max_in_flight=max_in_flight, loop=self._loop)
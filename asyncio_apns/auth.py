@@ -0,0 +1,74 @@
+import base64
+import json
+import time
+from typing import Optional
+
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature
+except ImportError:  # pragma: no cover
+    ec = None
+
+
+# APNs rejects tokens older than one hour and throttles refreshes more frequent than every 20 minutes
+DEFAULT_REFRESH_INTERVAL = 50 * 60
+
+
+def _b64(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b'=')
+
+
+class ProviderToken:
+    """ES256 provider authentication token built from a .p8 signing key.
+
+    The signed JWT is cached and only re-signed every ``refresh_interval``
+    seconds. One token is valid for every topic of the team, so a single
+    connection can serve several apps.
+    """
+
+    def __init__(self, key_id: str, team_id: str, *, key_file: Optional[str] = None,
+                 key: Optional[bytes] = None, refresh_interval=DEFAULT_REFRESH_INTERVAL,
+                 clock=time.time):
+        if ec is None:
+            raise ImportError("provider token authentication requires the 'cryptography' package")
+        if (key_file is None) == (key is None):
+            raise ValueError("exactly one of key_file and key must be given")
+        if key_file is not None:
+            with open(key_file, 'rb') as f:
+                key = f.read()
+        self.key_id = key_id
+        self.team_id = team_id
+        self.refresh_interval = refresh_interval
+        self._clock = clock
+        self._private_key = serialization.load_pem_private_key(key, password=None, backend=default_backend())
+        self._header_segment = _b64(json.dumps({"alg": "ES256", "kid": key_id}).encode())
+        self._issued_at = None
+        self._header_value = None
+
+    def _sign(self, issued_at: int) -> bytes:
+        claims = _b64(json.dumps({"iss": self.team_id, "iat": issued_at}).encode())
+        signing_input = self._header_segment + b'.' + claims
+        der_signature = self._private_key.sign(signing_input, ec.ECDSA(hashes.SHA256()))
+        r, s = decode_dss_signature(der_signature)
+        # JWS wants the raw 64 byte r || s form rather than DER
+        signature = r.to_bytes(32, 'big') + s.to_bytes(32, 'big')
+        return signing_input + b'.' + _b64(signature)
+
+    @property
+    def header_value(self) -> bytes:
+        """Value of the ``authorization`` request header."""
+        now = self._clock()
+        if self._issued_at is None or now - self._issued_at >= self.refresh_interval:
+            self._issued_at = int(now)
+            self._header_value = b'bearer ' + self._sign(self._issued_at)
+        return self._header_value
+
+    @property
+    def token(self) -> bytes:
+        return self.header_value[len(b'bearer '):]
+
+    def invalidate(self):
+        """Forces the next request to use a freshly signed token."""
+        self._issued_at = None
@@ -0,0 +1,190 @@
+"""Throughput and latency benchmark against a local mock APNs server.
+
+Run it with ``python -m asyncio_apns.bench``. The mock server runs in a
+separate process so that its CPU time and memory are not counted.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    # not on Windows
+    resource = None
+
+from .apns_connection import APNsConnection
+from .errors import APNsError
+from .payload import Payload
+
+
+BenchResult = collections.namedtuple(
+    "BenchResult", ["concurrency", "payload_size", "messages", "pushes_per_sec",
+                    "p50", "p99", "p999", "process_peak_rss_kib",
+                    "retained_bytes_per_message", "retained_blocks_per_message"])
+
+
+def process_peak_rss_kib():
+    """Peak RSS of the whole process so far, it never goes down between cases; None where unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB elsewhere
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def make_payload(size: int):
+    """Payload whose encoded body is about ``size`` bytes."""
+    overhead = len(Payload(alert="").compile().data)
+    return Payload(alert="x" * max(0, size - overhead)).compile()
+
+
+@asyncio.coroutine
+def run_case(connection, concurrency: int, payload_size: int, messages: int, *,
+             trace_memory=False, loop=None):
+    loop = loop or asyncio.get_event_loop()
+    payload = make_payload(payload_size)
+    latencies = []
+    remaining = [messages]
+
+    @asyncio.coroutine
+    def worker():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            started = loop.time()
+            try:
+                yield from connection.send_message(payload, "0" * 64)
+            except APNsError:
+                pass
+            latencies.append(loop.time() - started)
+
+    if trace_memory:
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+    started = loop.time()
+    yield from asyncio.gather(*(worker() for _ in range(concurrency)), loop=loop)
+    elapsed = loop.time() - started
+    retained_bytes = retained_blocks = None
+    if trace_memory:
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        retained_bytes, retained_blocks = _retained(before, after, messages)
+
+    latencies.sort()
+    return BenchResult(
+        concurrency, len(payload.data), messages, messages / elapsed,
+        percentile(latencies, 0.5), percentile(latencies, 0.99), percentile(latencies, 0.999),
+        process_peak_rss_kib(), retained_bytes, retained_blocks)
+
+
+def _retained(before, after, messages):
+    """Bytes and blocks per message still allocated after the run, not counting the bench itself."""
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+    stats = after.filter_traces(filters).compare_to(before.filter_traces(filters), "filename")
+    return (sum(stat.size_diff for stat in stats) / messages,
+            sum(stat.count_diff for stat in stats) / messages)
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _self_signed_cert(directory):
+    cert_file = os.path.join(directory, "cert.pem")
+    key_file = os.path.join(directory, "key.pem")
+    subprocess.check_call(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=127.0.0.1",
+         "-keyout", key_file, "-out", cert_file], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert_file, key_file
+
+
+def start_server(cert_file, key_file, port, args):
+    command = [sys.executable, "-m", "asyncio_apns.mock_server", "--cert", cert_file, "--key", key_file,
+               "--port", str(port), "--latency", str(args.latency), "--error-rate", str(args.error_rate)]
+    if args.max_concurrent_streams:
+        command += ["--max-concurrent-streams", str(args.max_concurrent_streams)]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE)
+    # the server prints a line once it listens
+    server.stdout.readline()
+    return server
+
+
+def format_result(result: BenchResult):
+    line = ("concurrency={r.concurrency:<5} payload={r.payload_size:<5} messages={r.messages:<7} "
+            "pushes/s={r.pushes_per_sec:>9.1f} p50={p50:>7.2f}ms p99={p99:>7.2f}ms p999={p999:>7.2f}ms").format(
+        r=result, p50=result.p50 * 1000, p99=result.p99 * 1000, p999=result.p999 * 1000)
+    if result.process_peak_rss_kib is not None:
+        line += " process_peak_rss={}KiB".format(result.process_peak_rss_kib)
+    if result.retained_bytes_per_message is not None:
+        line += " retained/msg={:.1f}B,{:.2f}blocks".format(
+            result.retained_bytes_per_message, result.retained_blocks_per_message)
+    return line
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(",")]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--cert", help="server and client certificate, a temporary one is made if omitted")
+    parser.add_argument("--key")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--concurrency", type=_int_list, default=[1, 10, 100, 1000])
+    parser.add_argument("--payload-sizes", type=_int_list, default=[128, 1024, 4096])
+    parser.add_argument("--latency", type=float, default=0.0, help="mock server response delay, seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--max-concurrent-streams", type=int, default=1000)
+    parser.add_argument("--coalesce-writes", action="store_true")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="measure memory retained per message with tracemalloc snapshots (slows the run down)")
+    parser.add_argument("--json", action="store_true", help="print one JSON object per case")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.cert and args.key:
+            cert_file, key_file = args.cert, args.key
+        else:
+            cert_file, key_file = _self_signed_cert(directory)
+        port = _free_port()
+        server = start_server(cert_file, key_file, port, args)
+        loop = asyncio.get_event_loop()
+        try:
+            for concurrency in args.concurrency:
+                for payload_size in args.payload_sizes:
+                    connection = APNsConnection(cert_file, key_file, loop=loop, server_addr="127.0.0.1",
+                                                server_port=port, coalesce_writes=args.coalesce_writes)
+                    loop.run_until_complete(connection.connect())
+                    result = loop.run_until_complete(run_case(
+                        connection, concurrency, payload_size, args.messages,
+                        trace_memory=args.trace_memory, loop=loop))
+                    connection.disconnect()
+                    if args.json:
+                        print(json.dumps(result._asdict()))
+                    else:
+                        print(format_result(result))
+                    sys.stdout.flush()
+        finally:
+            server.terminate()
+            server.wait()
+            loop.close()
+
+
+if __name__ == "__main__":
+    main()
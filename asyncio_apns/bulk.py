@@ -0,0 +1,107 @@
+import asyncio
+import collections
+
+
+_EXHAUSTED = object()
+
+
+class SendResults:
+    """Async iterator over ``(token, result)`` pairs of a bulk send.
+
+    ``result`` is the apns-id on success or the raised exception, such as
+    ``APNsError``, ``APNsDisconnectError`` or ``asyncio.TimeoutError``, so
+    that one failed message does not end the iteration. ``items`` are
+    ``(token, payload)`` pairs, or bare tokens when ``payload`` is given.
+    Results come in completion order. At most ``max_in_flight`` requests are sent or waiting to be
+    consumed at any time, and ``items`` is read lazily, so the token
+    source may be arbitrarily large.
+    """
+
+    def __init__(self, send, items, *, payload=None, max_in_flight=1000, loop=None):
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be positive")
+        self._send = send
+        self._payload = payload
+        self._loop = loop or asyncio.get_event_loop()
+        self._max_in_flight = max_in_flight
+        if hasattr(items, "__aiter__"):
+            self._items = items.__aiter__()
+            self._async_items = True
+        else:
+            self._items = iter(items)
+            self._async_items = False
+        self._exhausted = False
+        self._closed = False
+        self._tasks = set()
+        self._done = collections.deque()
+        self._waiter = None
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def _next_item(self):
+        if self._async_items:
+            try:
+                return (yield from self._items.__anext__())
+            except StopAsyncIteration:
+                return _EXHAUSTED
+        return next(self._items, _EXHAUSTED)
+
+    @asyncio.coroutine
+    def _send_one(self, token, payload):
+        try:
+            return token, (yield from self._send(payload, token))
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            return token, exc
+
+    def _on_done(self, task):
+        self._tasks.discard(task)
+        if self._closed:
+            return
+        self._done.append(task)
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    @asyncio.coroutine
+    def _fill(self):
+        while not self._exhausted and len(self._tasks) + len(self._done) < self._max_in_flight:
+            item = yield from self._next_item()
+            if item is _EXHAUSTED:
+                self._exhausted = True
+                break
+            if self._payload is not None:
+                token, payload = item, self._payload
+            else:
+                token, payload = item
+            task = self._loop.create_task(self._send_one(token, payload))
+            task.add_done_callback(self._on_done)
+            self._tasks.add(task)
+
+    @asyncio.coroutine
+    def __anext__(self):
+        if self._closed:
+            raise StopAsyncIteration
+        yield from self._fill()
+        while not self._done:
+            if not self._tasks or self._closed:
+                raise StopAsyncIteration
+            self._waiter = asyncio.Future(loop=self._loop)
+            try:
+                yield from self._waiter
+            finally:
+                self._waiter = None
+        return self._done.popleft().result()
+
+    def close(self):
+        """Stop reading ``items``, cancel requests still in flight and drop unread results."""
+        self._exhausted = True
+        self._closed = True
+        for task in self._tasks:
+            task.cancel()
+        self._tasks.clear()
+        self._done.clear()
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
@@ -0,0 +1,313 @@
+"""Persistent outbound queue, so that unsent messages survive a crash or a deploy.
+
+Messages are appended to memory-mapped segment files before they are
+sent and acknowledged once APNs answered. After a restart ``replay``
+reads the messages that were never acknowledged straight from the
+segments, one at a time.
+"""
+import asyncio
+import collections
+import itertools
+import json
+import mmap
+import os
+import struct
+import time
+import zlib
+from typing import Iterator, Optional, Sequence, Tuple, Union
+
+from .apns_connection import NotificationPriority, _compile_payload
+from .bulk import SendResults
+from .errors import APNsError, APNsDisconnectError, APNsExpiredError
+from .payload import CompiledPayload, Payload
+
+
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+
+# body length, crc32 of the body, sequence number, expiry (unix time, 0 for none)
+_RECORD_HEADER = struct.Struct(">IIQq")
+# token, headers and payload lengths
+_BODY_HEADER = struct.Struct(">HHI")
+
+_SEGMENT_SUFFIX = ".log"
+_CHECKPOINT = "checkpoint"
+
+LogEntry = collections.namedtuple("LogEntry", ["sequence", "token", "payload", "headers", "expiry"])
+
+
+def _segment_name(first_sequence: int) -> str:
+    return "{:020d}{}".format(first_sequence, _SEGMENT_SUFFIX)
+
+
+def _encode(sequence, token, payload, headers, expiry) -> bytes:
+    token = token.encode()
+    headers = json.dumps(headers).encode() if headers else b""
+    body = b"".join((_BODY_HEADER.pack(len(token), len(headers), len(payload)), token, headers, payload))
+    return _RECORD_HEADER.pack(len(body), zlib.crc32(body), sequence, expiry or 0) + body
+
+
+def _ranges(sequences):
+    """``[start, end)`` pairs covering ``sequences``, acknowledgements mostly come in runs."""
+    ranges = []
+    for sequence in sorted(sequences):
+        if ranges and ranges[-1][1] == sequence:
+            ranges[-1][1] += 1
+        else:
+            ranges.append([sequence, sequence + 1])
+    return ranges
+
+
+def _decode(buffer, offset):
+    """Returns the entry at ``offset`` and the offset of the next one, None at the end of the log."""
+    if offset + _RECORD_HEADER.size > len(buffer):
+        return None
+    length, crc, sequence, expiry = _RECORD_HEADER.unpack_from(buffer, offset)
+    start = offset + _RECORD_HEADER.size
+    # zero filled space after the last record, or a record torn by a crash
+    if length == 0 or start + length > len(buffer):
+        return None
+    body = bytes(buffer[start:start + length])
+    if zlib.crc32(body) != crc:
+        return None
+    token_length, headers_length, payload_length = _BODY_HEADER.unpack_from(body)
+    position = _BODY_HEADER.size
+    token = body[position:position + token_length].decode()
+    position += token_length
+    headers = body[position:position + headers_length]
+    headers = [tuple(header) for header in json.loads(headers.decode())] if headers else []
+    position += headers_length
+    payload = body[position:position + payload_length]
+    return LogEntry(sequence, token, payload, headers, expiry or None), start + length
+
+
+class SegmentLog:
+    """Append-only log of messages in ``directory``, split into segments.
+
+    Every segment is a file of ``segment_size`` bytes written through
+    ``mmap``, so an appended message survives a crash of the process;
+    ``sync`` also flushes it to the disk. ``ack`` marks a message as
+    done and ``checkpoint`` stores the acknowledgements and removes
+    segments holding only acknowledged messages.
+    """
+
+    def __init__(self, directory: str, *, segment_size=DEFAULT_SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        os.makedirs(directory, exist_ok=True)
+        self.watermark = 0  # every message below it is acknowledged
+        self.acked = set()  # acknowledged messages at or above the watermark
+        self._read_checkpoint()
+        self._segments = sorted(int(name[:-len(_SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+                                if name.endswith(_SEGMENT_SUFFIX))
+        self._file = None
+        self._mmap = None
+        self._offset = 0
+        self.next_sequence = self.watermark
+        if self._segments:
+            self.next_sequence = max(self.watermark, self._segments[-1])
+            self._open_segment(self._segments[-1])
+            for entry, offset in self._scan(self._mmap):
+                self.next_sequence = entry.sequence + 1
+                self._offset = offset
+
+    @property
+    def pending(self):
+        return self.next_sequence - self.watermark - len(self.acked)
+
+    def _path(self, first_sequence):
+        return os.path.join(self.directory, _segment_name(first_sequence))
+
+    def _read_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, _CHECKPOINT)) as checkpoint:
+                state = json.load(checkpoint)
+        except FileNotFoundError:
+            return
+        self.watermark = state["watermark"]
+        if "acked" in state:
+            # written before acknowledgements were stored as ranges
+            self.acked = set(state["acked"])
+        else:
+            self.acked = set(itertools.chain.from_iterable(range(start, end) for start, end in state["ranges"]))
+
+    def _open_segment(self, first_sequence):
+        self._close_segment()
+        self._file = open(self._path(first_sequence), "r+b")
+        self._mmap = mmap.mmap(self._file.fileno(), 0)
+        self._offset = 0
+
+    def _close_segment(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+            self._mmap = self._file = None
+
+    def _new_segment(self):
+        with open(self._path(self.next_sequence), "wb") as segment:
+            segment.truncate(self.segment_size)
+        self._segments.append(self.next_sequence)
+        self._open_segment(self.next_sequence)
+
+    @staticmethod
+    def _scan(buffer):
+        offset = 0
+        while True:
+            decoded = _decode(buffer, offset)
+            if decoded is None:
+                return
+            entry, offset = decoded
+            yield entry, offset
+
+    def append(self, token: str, payload: bytes, headers: Sequence[Tuple[str, str]] = (),
+               expiry: Optional[int] = None) -> int:
+        """Stores a message and returns its sequence number."""
+        record = _encode(self.next_sequence, token, payload, list(headers), expiry)
+        if len(record) > self.segment_size:
+            raise ValueError("message does not fit in a segment")
+        if self._mmap is None or self._offset + len(record) > self.segment_size:
+            self._new_segment()
+        self._mmap[self._offset:self._offset + len(record)] = record
+        self._offset += len(record)
+        self.next_sequence += 1
+        return self.next_sequence - 1
+
+    def ack(self, sequence: int):
+        if sequence < self.watermark:
+            return
+        self.acked.add(sequence)
+        while self.watermark in self.acked:
+            self.acked.remove(self.watermark)
+            self.watermark += 1
+
+    def sync(self):
+        if self._mmap is not None:
+            self._mmap.flush()
+
+    def checkpoint(self):
+        path = os.path.join(self.directory, _CHECKPOINT)
+        with open(path + ".tmp", "w") as checkpoint:
+            json.dump({"watermark": self.watermark, "ranges": _ranges(self.acked)}, checkpoint)
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+        os.replace(path + ".tmp", path)
+        # a segment ends where the next one starts, the active one is kept
+        while len(self._segments) > 1 and self._segments[1] <= self.watermark:
+            os.remove(self._path(self._segments.pop(0)))
+
+    def replay(self) -> Iterator[LogEntry]:
+        """Yields the messages not acknowledged yet, reading the segments lazily."""
+        end = self.next_sequence
+        for first_sequence in list(self._segments):
+            # a mapping of its own, appending may roll the active segment over meanwhile
+            with open(self._path(first_sequence), "rb") as segment:
+                buffer = mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for entry, _ in self._scan(buffer):
+                        if entry.sequence >= end:
+                            return
+                        if entry.sequence >= self.watermark and entry.sequence not in self.acked:
+                            yield entry
+                finally:
+                    buffer.close()
+
+    def close(self):
+        self.checkpoint()
+        self._close_segment()
+
+
+class DurableSender:
+    """Logs every message to ``log`` before ``client`` sends it.
+
+    A message is acknowledged once APNs answered it, successfully or
+    not, or once it expired. A message that failed with a disconnect or
+    a timeout is sent again from the log, after ``retry_delay`` seconds
+    doubling up to ``max_retry_delay``, so callers never send it twice.
+    After ``max_attempts`` such failures the error is raised and the
+    message stays in the log unacknowledged. Messages left in the log by a crash are sent by ``resume``, which is
+    meant to be called at start up. The log is checkpointed every
+    ``checkpoint_every`` acknowledgements.
+    """
+
+    def __init__(self, client, log: SegmentLog, *, checkpoint_every=1000, retry_delay=1.0,
+                 max_retry_delay=60.0, max_attempts=8, loop=None):
+        self.client = client
+        self.log = log
+        self.checkpoint_every = checkpoint_every
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_attempts = max_attempts
+        self._unsaved_acks = 0
+        self._loop = loop or asyncio.get_event_loop()
+
+    def _ack(self, sequence):
+        self.log.ack(sequence)
+        self._unsaved_acks += 1
+        if self._unsaved_acks >= self.checkpoint_every:
+            self._unsaved_acks = 0
+            self.log.checkpoint()
+
+    @asyncio.coroutine
+    def _send(self, sequence, payload, token, priority, topic, extra_headers, expiry):
+        kwargs = dict(expiration=expiry) if expiry is not None else dict()
+        delay = self.retry_delay
+        attempts = 0
+        while True:
+            try:
+                result = yield from self.client.send_message(payload, token, priority, topic, extra_headers,
+                                                             **kwargs)
+            except (APNsError, APNsExpiredError):
+                # answered by APNs, sending it again would fail the same way
+                self._ack(sequence)
+                raise
+            except (APNsDisconnectError, asyncio.TimeoutError):
+                # never answered, a new record from the caller would be sent twice after a restart
+                attempts += 1
+                if attempts >= self.max_attempts:
+                    # left unacknowledged for resume
+                    raise
+                if expiry is not None and expiry <= time.time() + delay:
+                    self._ack(sequence)
+                    raise APNsExpiredError() from None
+                yield from asyncio.sleep(delay, loop=self._loop)
+                delay = min(delay * 2, self.max_retry_delay)
+                continue
+            self._ack(sequence)
+            return result
+
+    @asyncio.coroutine
+    def send_message(self, payload: Union[Payload, CompiledPayload, str], token: str,
+                     priority: NotificationPriority = NotificationPriority.immediate,
+                     topic: str = None, extra_headers: Optional[Sequence[Tuple[str, str]]] = None,
+                     expiry: Optional[int] = None):
+        """Sends a message, ``expiry`` is its apns-expiration, it is not sent after that."""
+        payload = _compile_payload(payload)
+        headers = [("apns-priority", str(priority.value))]
+        if topic:
+            headers.append(("apns-topic", topic))
+        headers.extend(extra_headers or ())
+        sequence = self.log.append(token, payload.data, headers, expiry)
+        return (yield from self._send(sequence, payload, token, priority, topic, extra_headers, expiry))
+
+    @asyncio.coroutine
+    def _resend(self, entry: LogEntry, token):
+        if entry.expiry is not None and entry.expiry <= time.time():
+            self._ack(entry.sequence)
+            return None
+        priority, topic, extra_headers = NotificationPriority.immediate, None, []
+        for name, value in entry.headers:
+            if name == "apns-priority":
+                priority = NotificationPriority(int(value))
+            elif name == "apns-topic":
+                topic = value
+            else:
+                extra_headers.append((name, value))
+        return (yield from self._send(entry.sequence, CompiledPayload(entry.payload), token, priority, topic,
+                                      extra_headers or None, entry.expiry))
+
+    def resume(self, *, max_in_flight=100) -> SendResults:
+        """Sends the logged messages not acknowledged yet, yielding ``(token, result)`` pairs.
+
+        Expired messages are dropped and yield None.
+        """
+        entries = ((entry.token, entry) for entry in self.log.replay())
+        return SendResults(self._resend, entries, max_in_flight=max_in_flight, loop=self._loop)
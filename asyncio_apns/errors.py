@@ -1,8 +1,52 @@
+import enum
+
+
+class Reason(str, enum.Enum):
+    """Error reasons APNs answers with, unknown ones are kept as plain strings.
+
+    Members compare and hash equal to their string values.
+    """
+    BadCollapseId = "BadCollapseId"
+    BadDeviceToken = "BadDeviceToken"
+    BadExpirationDate = "BadExpirationDate"
+    BadMessageId = "BadMessageId"
+    BadPriority = "BadPriority"
+    BadTopic = "BadTopic"
+    DeviceTokenNotForTopic = "DeviceTokenNotForTopic"
+    DuplicateHeaders = "DuplicateHeaders"
+    IdleTimeout = "IdleTimeout"
+    InvalidPushType = "InvalidPushType"
+    MissingDeviceToken = "MissingDeviceToken"
+    MissingTopic = "MissingTopic"
+    PayloadEmpty = "PayloadEmpty"
+    TopicDisallowed = "TopicDisallowed"
+    BadCertificate = "BadCertificate"
+    BadCertificateEnvironment = "BadCertificateEnvironment"
+    ExpiredProviderToken = "ExpiredProviderToken"
+    Forbidden = "Forbidden"
+    InvalidProviderToken = "InvalidProviderToken"
+    MissingProviderToken = "MissingProviderToken"
+    BadPath = "BadPath"
+    MethodNotAllowed = "MethodNotAllowed"
+    Unregistered = "Unregistered"
+    PayloadTooLarge = "PayloadTooLarge"
+    TooManyProviderTokenUpdates = "TooManyProviderTokenUpdates"
+    TooManyRequests = "TooManyRequests"
+    InternalServerError = "InternalServerError"
+    ServiceUnavailable = "ServiceUnavailable"
+    Shutdown = "Shutdown"
+
+    def __str__(self):
+        return self.value
+
+
 class APNsError(Exception):
-    def __init__(self, status, identifier):
+    def __init__(self, status, identifier, code=None, timestamp=None):
         super().__init__()
         self.status = status
         self.identifier = identifier
+        self.code = code  # HTTP status of the response
+        self.timestamp = timestamp  # of a 410, in milliseconds, when APNs saw the token invalid
 
     def __repr__(self):
         return "APNsError(status={}, identifier={})".format(
@@ -13,6 +57,19 @@ class APNsError(Exception):
         return "APNsError({})".format(self.status)
 
 
+class PayloadTooLargeError(ValueError):
+    """The encoded payload is over the size APNs accepts."""
+
+    def __init__(self, size, limit):
+        super().__init__("payload is {} bytes, the limit is {}".format(size, limit))
+        self.size = size
+        self.limit = limit
+
+
+class APNsExpiredError(Exception):
+    """The message deadline passed before it could be sent, it was dropped."""
+
+
 class APNsDisconnectError(Exception):
     def __init__(self, reason):
         super().__init__()
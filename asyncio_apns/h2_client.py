@@ -1,14 +1,24 @@
 import asyncio
 import enum
+import functools
 import ssl
 import collections
+import collections.abc
+import itertools
 import json
+import os
+import struct
+import sys
+import time
 from urllib.parse import urlsplit
 
 from h2.connection import H2Connection, ConnectionState
-from h2.events import (ConnectionTerminated, DataReceived,
-                       ResponseReceived, StreamEnded, WindowUpdated)
-from h2.exceptions import TooManyStreamsError
+from h2.errors import ErrorCodes
+from h2.events import (ConnectionTerminated, DataReceived, PingAcknowledged, RemoteSettingsChanged,
+                       ResponseReceived, StreamEnded, StreamReset, WindowUpdated)
+from h2.exceptions import StreamClosedError, TooManyStreamsError
+
+from .admission import StreamAdmission
 
 
 class HTTPMethod(enum.Enum):
@@ -28,92 +38,384 @@ class ExceptionJSONDataMixin:
 
 
 class HTTP2Error(Exception, ExceptionJSONDataMixin):
+    """Non-200 response, ``headers`` is a dict of the response headers."""
+
     def __init__(self, code, headers, data=None):
         self.code = code
         self.headers = headers
         self.data = data
 
 
+class ResponseHeaders(collections.abc.Mapping):
+    """Read-only mapping over the response headers as received, without building a dict.
+
+    A response has a handful of headers, a lookup scans them.
+    """
+
+    __slots__ = ('_headers',)
+
+    def __init__(self, headers):
+        self._headers = headers  # (name, value) pairs
+
+    def __getitem__(self, name):
+        for key, value in self._headers:
+            if key == name:
+                return value
+        raise KeyError(name)
+
+    def get(self, name, default=None):
+        for key, value in self._headers:
+            if key == name:
+                return value
+        return default
+
+    def __iter__(self):
+        return (name for name, _ in self._headers)
+
+    def __len__(self):
+        return len(self._headers)
+
+    def __repr__(self):
+        return "ResponseHeaders({!r})".format(self._headers)
+
+
 class DisconnectError(Exception, ExceptionJSONDataMixin):
     def __init__(self, code, data=None):
         self.code = code
         self.data = data
 
 
+class UnprocessedStreamError(DisconnectError):
+    """The server never processed the request, it is safe to send it again."""
+
+
+DEFAULT_WRITE_THRESHOLD = 64 * 1024
+DEFAULT_PING_TIMEOUT = 10.0
+
+
+class _Stream:
+    """State of one request, filled in place as its events arrive."""
+
+    __slots__ = ('response', 'flow_control', 'headers', 'data', 'started')
+
+    def __init__(self, response, started=None):
+        self.response = response  # Future resolved when the stream ends
+        self.flow_control = None  # Future set while the body waits for a window update
+        self.headers = None
+        self.data = None
+        self.started = started  # only measured when metrics are enabled
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """Client context resuming the last TLS session with a server on reconnect."""
+
+    def __new__(cls, *args, **kwargs):
+        context = super().__new__(cls, *args, **kwargs)
+        context.sessions = dict()  # server_hostname -> ssl.SSLSession
+        return context
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self.sessions.get(server_hostname)
+        return super().wrap_bio(incoming, outgoing, server_side=server_side,
+                                server_hostname=server_hostname, session=session)
+
+    def save_session(self, ssl_object):
+        if ssl_object.session is not None:
+            self.sessions[ssl_object.server_hostname] = ssl_object.session
+
+
+def _modified(path):
+    if not path:
+        return None
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        # load_cert_chain reports it
+        return None
+
+
+def ssl_context(cert_file=None, key_file=None, verify_ssl=True):
+    """One context per credential set, the PEM files are read again only after they change."""
+    return _ssl_context(cert_file, key_file, verify_ssl, _modified(cert_file), _modified(key_file))
+
+
+@functools.lru_cache(maxsize=32)
+def _ssl_context(cert_file, key_file, verify_ssl, cert_modified, key_modified):
+    if sys.version_info >= (3, 6):
+        context = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.load_default_certs()
+    else:
+        # no PROTOCOL_TLS_CLIENT and no session argument to wrap_bio, sessions are not resumed
+        context = ssl.create_default_context()
+    context.set_alpn_protocols(["h2"])
+    if not verify_ssl:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    if cert_file and key_file:
+        context.load_cert_chain(cert_file, key_file)
+    return context
+
+
+ssl_context.cache_clear = _ssl_context.cache_clear
+
+
 class H2ClientProtocol(asyncio.Protocol):
-    def __init__(self, connection=H2Connection()):
-        self.conn = connection
-        self.response_futures = dict()  # stream_id -> Future
-        self.flow_control_futures = dict()  # stream_id -> Future
+    def __init__(self, connection=None, *, loop=None, coalesce_writes=False,
+                 write_threshold=DEFAULT_WRITE_THRESHOLD, metrics=None,
+                 max_queue=None, reserved_streams=0, ping_interval=None,
+                 ping_timeout=DEFAULT_PING_TIMEOUT):
+        self.conn = connection if connection is not None else H2Connection()
+        self.streams = dict()  # stream_id -> _Stream
+        self.blocked_streams = set()  # ids of streams waiting for a flow control window
+        # requests wait here for a stream slot; reserved_streams are kept for high priority ones
+        self.admission = StreamAdmission(lambda: self.max_concurrent_streams, max_queue=max_queue,
+                                         reserved=reserved_streams, loop=loop)
+        # requests refused by h2 itself wait for the next stream to close
         self.stream_waiters = collections.deque()
-        self.events_queue = collections.defaultdict(collections.deque)  # stream_id -> deque
         self.transport = None
-        self.loop = None
+        self.loop = loop
+        # with coalesce_writes frames are flushed once per loop iteration
+        # or as soon as write_threshold bytes are pending
+        self.coalesce_writes = coalesce_writes
+        self.write_threshold = write_threshold
+        self._write_buffer = bytearray()
+        self._flush_handle = None
+        self.metrics = metrics
+        self.on_goaway = None  # called with the protocol when the server sends GOAWAY
+        self.on_closed = None  # called with the protocol when the transport is closed
+        # after ping_interval seconds without incoming frames a PING is sent,
+        # a connection whose PING is not acknowledged within ping_timeout is dropped
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.rtt = None  # seconds, measured by the last acknowledged PING
+        self.healthy = True
+        self._last_received = None
+        self._ping_handle = None
+        self._ping_timeout_handle = None
+        self._ping_sent = None
+        self._ping_data = None
+        self._ping_counter = itertools.count()
 
     @property
     def connected(self):
-        return self.transport is not None and not self.connection_closed()
+        return self.transport is not None and self.healthy and not self.connection_closed()
 
     def connection_closed(self):
         return self.conn.state_machine.state == ConnectionState.CLOSED
 
+    @property
+    def max_concurrent_streams(self):
+        return self.conn.remote_settings.max_concurrent_streams
+
+    @property
+    def open_streams(self):
+        return self.conn.open_outbound_streams
+
+    @property
+    def queue_depth(self):
+        return self.admission.queue_depth
+
+    @property
+    def free_streams(self):
+        # queued requests are already competing for slots
+        return (self.max_concurrent_streams - max(self.open_streams, self.admission.active)
+                - self.admission.queue_depth)
+
     @classmethod
     @asyncio.coroutine
     def connect(cls, host: str, port: int,
                 *, cert_file=None, key_file=None,
-                verify_ssl=True, loop=None):
+                verify_ssl=True, coalesce_writes=False, metrics=None,
+                max_queue=None, reserved_streams=0, ping_interval=None,
+                ping_timeout=DEFAULT_PING_TIMEOUT, loop=None):
         if loop is None:
             loop = asyncio.get_event_loop()
-        ssl_context = ssl.create_default_context()
-        ssl_context.set_alpn_protocols(["h2"])
-        if not verify_ssl:
-            ssl_context.check_hostname = False
-            ssl_context.verify_mode = ssl.CERT_NONE
-        if cert_file and key_file:
-            ssl_context.load_cert_chain(cert_file, key_file)
         # waiting for successful connect
-        _, protocol = yield from loop.create_connection(H2ClientProtocol, host=host, port=port, ssl=ssl_context)
-        protocol.loop = loop
+        _, protocol = yield from loop.create_connection(
+            lambda: cls(loop=loop, coalesce_writes=coalesce_writes, metrics=metrics,
+                        max_queue=max_queue, reserved_streams=reserved_streams,
+                        ping_interval=ping_interval, ping_timeout=ping_timeout),
+            host=host, port=port, ssl=ssl_context(cert_file, key_file, verify_ssl))
         return protocol
 
     def disconnect(self):
-        self.transport.close()
+        if self.transport is not None:
+            self.transport.close()
 
     def connection_made(self, transport):
         self.transport = transport
         self.conn.initiate_connection()
         self.transport.write(self.conn.data_to_send())
+        if self.ping_interval is not None:
+            self._last_received = self.loop.time()
+            self._ping_handle = self.loop.call_later(self.ping_interval, self._keepalive)
 
     def connection_lost(self, exc):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._cancel_ping()
+        self._save_tls_session()
+        self._write_buffer.clear()
+        if self.metrics is not None:
+            self.metrics.connection_lost()
         self.on_terminated(None, None)
         self.transport = None
+        if self.on_closed is not None:
+            self.on_closed(self)
+
+    def _write(self):
+        data = self.conn.data_to_send()
+        if not self.coalesce_writes:
+            if data:
+                self.transport.write(data)
+            return
+        self._write_buffer += data
+        if len(self._write_buffer) >= self.write_threshold:
+            self._flush()
+        elif self._write_buffer and self._flush_handle is None:
+            self._flush_handle = self.loop.call_soon(self._flush)
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._write_buffer and self.transport is not None:
+            self.transport.write(bytes(self._write_buffer))
+            self._write_buffer.clear()
+
+    def _save_tls_session(self):
+        if self.transport is None:
+            return
+        ssl_object = self.transport.get_extra_info("ssl_object")
+        if ssl_object is not None and isinstance(ssl_object.context, ResumingSSLContext):
+            ssl_object.context.save_session(ssl_object)
+
+    def _cancel_ping(self):
+        for handle in (self._ping_handle, self._ping_timeout_handle):
+            if handle is not None:
+                handle.cancel()
+        self._ping_handle = self._ping_timeout_handle = None
+
+    def _keepalive(self):
+        idle = self.loop.time() - self._last_received
+        if idle < self.ping_interval:
+            # frames arrived meanwhile, the connection is known to be alive
+            self._ping_handle = self.loop.call_later(self.ping_interval - idle, self._keepalive)
+            return
+        self._ping_handle = None
+        self.send_ping()
+
+    def send_ping(self):
+        """Sends a PING, ``rtt`` is updated when it is acknowledged."""
+        if self._ping_data is not None or not self.connected:
+            return
+        self._ping_data = struct.pack(">Q", next(self._ping_counter))
+        self._ping_sent = self.loop.time()
+        self.conn.ping(self._ping_data)
+        self._write()
+        if self.ping_timeout is not None:
+            self._ping_timeout_handle = self.loop.call_later(self.ping_timeout, self._ping_timed_out)
+
+    def ping_acknowledged(self, event):
+        if event.ping_data != self._ping_data:
+            return
+        self.rtt = self.loop.time() - self._ping_sent
+        self._ping_data = None
+        if self._ping_timeout_handle is not None:
+            self._ping_timeout_handle.cancel()
+            self._ping_timeout_handle = None
+        if self.metrics is not None:
+            self.metrics.ping_acknowledged(self.rtt)
+        if self.ping_interval is not None and self._ping_handle is None:
+            self._ping_handle = self.loop.call_later(self.ping_interval, self._keepalive)
+
+    def _ping_timed_out(self):
+        self._ping_timeout_handle = None
+        # the peer is gone, fail everything now instead of waiting for TCP to notice
+        self.healthy = False
+        self.on_terminated(None, None)
+        self._cancel_ping()
+        if self.transport is not None:
+            self.transport.abort()
 
     def data_received(self, data):
+        if self._last_received is not None:
+            self._last_received = self.loop.time()
         events = self.conn.receive_data(data)
-        self.transport.write(self.conn.data_to_send())
+        self._write()
         for event in events:
-            if isinstance(event, ResponseReceived) or isinstance(event, DataReceived):
-                self.events_queue[event.stream_id].append(event)
+            if isinstance(event, ResponseReceived):
+                stream = self.streams.get(event.stream_id)
+                if stream is not None:
+                    stream.headers = event.headers
+                    if self.metrics is not None:
+                        self.metrics.response_headers(time.monotonic() - stream.started)
+            elif isinstance(event, DataReceived):
+                self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                stream = self.streams.get(event.stream_id)
+                if stream is not None:
+                    stream.data = event.data if stream.data is None else stream.data + event.data
             elif isinstance(event, WindowUpdated):
                 self.window_opened(event)
+            elif isinstance(event, PingAcknowledged):
+                self.ping_acknowledged(event)
+            elif isinstance(event, RemoteSettingsChanged):
+                # MAX_CONCURRENT_STREAMS may have grown
+                self.admission.dispatch()
+                # TLS 1.3 session tickets arrive after the handshake, by now they are in
+                self._save_tls_session()
             elif isinstance(event, StreamEnded):
-                self.events_queue[event.stream_id].append(event)
                 self.handle_response(event.stream_id)
                 self._on_stream_closed()
+            elif isinstance(event, StreamReset):
+                self.stream_reset(event)
+                self._on_stream_closed()
             elif isinstance(event, ConnectionTerminated):
-                self.on_terminated(event.error_code, event.additional_data)
-
-        data = self.conn.data_to_send()
-        if data:
-            self.transport.write(data)
-
-    def on_terminated(self, error_code, data):
-        while self.response_futures:
-            _, f = self.response_futures.popitem()
-            f.set_exception(DisconnectError(error_code, data))
+                if self.metrics is not None:
+                    self.metrics.goaway(event.error_code, event.last_stream_id)
+                self.on_terminated(event.error_code, event.additional_data, event.last_stream_id)
+                if self.on_goaway is not None:
+                    self.on_goaway(self)
+
+        self._write()
+
+    def on_terminated(self, error_code, data, last_stream_id=None):
+        # streams above the GOAWAY last_stream_id were never processed by the server,
+        # h2 closes the connection on GOAWAY, so the rest cannot complete either
+        self.blocked_streams.clear()
+        while self.streams:
+            stream_id, stream = self.streams.popitem()
+            if last_stream_id is not None and stream_id > last_stream_id:
+                error = UnprocessedStreamError(error_code, data)
+            else:
+                error = DisconnectError(error_code, data)
+            self._fail_stream(stream, error)
+        # requests still waiting for a stream have not been sent at all
         while self.stream_waiters:
             f = self.stream_waiters.popleft()
-            f.set_exception(DisconnectError(error_code, data))
+            f.set_exception(UnprocessedStreamError(error_code, data))
+        self.admission.fail(UnprocessedStreamError(error_code, data))
+
+    def stream_reset(self, event):
+        stream = self.streams.pop(event.stream_id, None)
+        if stream is None:
+            return
+        self.blocked_streams.discard(event.stream_id)
+        if event.error_code == ErrorCodes.REFUSED_STREAM:
+            error = UnprocessedStreamError(event.error_code)
+        else:
+            error = DisconnectError(event.error_code)
+        self._fail_stream(stream, error)
+
+    @staticmethod
+    def _fail_stream(stream, error):
+        stream.response.set_exception(error)
+        if stream.flow_control is not None and not stream.flow_control.done():
+            stream.flow_control.set_exception(error)
+            # the request fails while sending its body and never awaits the response
+            stream.response.exception()
 
     def _on_stream_closed(self):
         if self.stream_waiters:
@@ -123,32 +425,50 @@ class H2ClientProtocol(asyncio.Protocol):
     def window_opened(self, event):
         if event.stream_id:
             # This is specific to a single stream.
-            if event.stream_id in self.flow_control_futures:
-                future = self.flow_control_futures.pop(event.stream_id)
-                future.set_result(None)
+            if event.stream_id in self.blocked_streams:
+                self.blocked_streams.discard(event.stream_id)
+                self._unblock(event.stream_id)
         else:
             # This event is specific to the connection. Free up *all* the
             # streams.
 
-            for future in self.flow_control_futures.values():
-                future.set_result(None)
+            for stream_id in self.blocked_streams:
+                self._unblock(stream_id)
+
+            self.blocked_streams = set()
 
-            self.flow_control_futures = {}
+    def _unblock(self, stream_id):
+        stream = self.streams.get(stream_id)
+        if stream is None or stream.flow_control is None:
+            return
+        stream.flow_control.set_result(None)
+        stream.flow_control = None
 
     @asyncio.coroutine
-    def send_request(self, headers, body=None):
-        while True:
-            try:
-                stream_id = self.conn.get_next_available_stream_id()
-                future = self._send_request(stream_id, headers, body)
-                return (yield from future)
-            except TooManyStreamsError:
-                wait_future = asyncio.Future(loop=self.loop)
-                self.stream_waiters.append(wait_future)
-                yield from wait_future
+    def send_request(self, headers, body=None, *, high_priority=True, timeout=None):
+        """Sends a request once a stream slot is free.
+
+        Raises ``asyncio.TimeoutError`` if no slot frees up within ``timeout`` seconds.
+        """
+        queued = time.monotonic() if self.metrics is not None else None
+        waited = yield from self.admission.acquire(high_priority, timeout)
+        try:
+            while True:
+                try:
+                    stream_id = self.conn.get_next_available_stream_id()
+                    future = self._send_request(stream_id, headers, body, queued if waited else None)
+                    return (yield from future)
+                except TooManyStreamsError:
+                    waited = True
+                    wait_future = asyncio.Future(loop=self.loop)
+                    self.stream_waiters.append(wait_future)
+                    yield from wait_future
+        finally:
+            self.admission.release()
 
     @asyncio.coroutine
     def _send_request_body(self, stream_id, body):
+        """Returns False if the response arrived before the whole body was sent."""
         while True:
             window_size = self.conn.local_flow_control_window(stream_id)
 
@@ -163,50 +483,73 @@ class H2ClientProtocol(asyncio.Protocol):
             )
             for chunk in chunks:
                 self.conn.send_data(stream_id, chunk)
-            self.transport.write(self.conn.data_to_send())
+            self._write()
 
             if body:
                 # we have data left to send
-                future = self.flow_control_futures[stream_id] = asyncio.Future(loop=self.loop)
-                yield from future
+                future = self.streams[stream_id].flow_control = asyncio.Future(loop=self.loop)
+                self.blocked_streams.add(stream_id)
+                if self.metrics is None:
+                    yield from future
+                else:
+                    blocked = time.monotonic()
+                    yield from future
+                    self.metrics.flow_control_blocked(time.monotonic() - blocked)
+                if stream_id not in self.streams:
+                    return False
             else:
-                break
+                return True
 
     @asyncio.coroutine
-    def _send_request(self, stream_id, headers, body):
+    def _send_request(self, stream_id, headers, body, queued=None):
         self.conn.send_headers(stream_id, headers)
 
         future = asyncio.Future(loop=self.loop)
-        self.response_futures[stream_id] = future
+        if self.metrics is None:
+            self.streams[stream_id] = _Stream(future)
+        else:
+            started = time.monotonic()
+            if queued is not None:
+                self.metrics.stream_queued(started - queued)
+            self.streams[stream_id] = _Stream(future, started)
 
-        if body is not None:
-            yield from self._send_request_body(stream_id, body)
-        self.conn.end_stream(stream_id)
+        if body is None or (yield from self._send_request_body(stream_id, body)):
+            self.conn.end_stream(stream_id)
+        else:
+            # answered early, the rest of the body is not needed
+            try:
+                self.conn.reset_stream(stream_id, ErrorCodes.NO_ERROR)
+            except StreamClosedError:
+                pass
 
-        self.transport.write(self.conn.data_to_send())
+        self._write()
 
         return (yield from future)
 
     def handle_response(self, stream_id):
-        future = self.response_futures.pop(stream_id)
-        response_event = self.events_queue[stream_id].popleft()
-        data_event = None
-        while True:
-            data = self.events_queue[stream_id].popleft()
-            if isinstance(data, DataReceived):
-                data_event = data
-            elif isinstance(data, StreamEnded):
-                break
-        self.events_queue.pop(stream_id)
-
-        headers = dict(response_event.headers)
-        data = data_event.data if data_event is not None else None
-        status_code = int(headers[":status"])
+        stream = self.streams.pop(stream_id)
+        self.blocked_streams.discard(stream_id)
+        if stream.flow_control is not None and not stream.flow_control.done():
+            # the body was still waiting for a window, sending it stops here
+            stream.flow_control.set_result(None)
+        status_code = _status_code(stream.headers)
+        if self.metrics is not None:
+            self.metrics.request_done(time.monotonic() - stream.started, status_code)
         if status_code != 200:
-            error = HTTP2Error(status_code, headers, data)
-            future.set_exception(error)
+            error = HTTP2Error(status_code, dict(stream.headers), stream.data)
+            stream.response.set_exception(error)
         else:
-            future.set_result((headers, data))
+            # no dict for every successful response, the caller only looks up apns-id
+            stream.response.set_result((ResponseHeaders(stream.headers), stream.data))
+
+
+def _status_code(headers) -> int:
+    # pseudo-headers come first and :status is the only one in a response
+    name, value = headers[0]
+    if name != ":status":
+        value = next(value for name, value in headers if name == ":status")
+    # skips int() for the common case
+    return 200 if value == "200" else int(value)
 
 
 def prepare_request(method: HTTPMethod, parsed_url):
@@ -0,0 +1,113 @@
+import asyncio
+import collections
+import time
+from typing import Optional
+
+from .errors import Reason
+
+
+# reasons meaning that the device token will never be delivered to again
+INVALID_TOKEN_REASONS = (Reason.Unregistered, Reason.BadDeviceToken)
+
+InvalidToken = collections.namedtuple("InvalidToken", ["token", "reason", "code", "timestamp"])
+
+
+class InvalidTokenCache:
+    """Bounded LRU set of device tokens APNs reported invalid.
+
+    ``APNsConnection`` answers messages to a cached token with the
+    cached error instead of sending them. A token is forgotten ``ttl``
+    seconds after it was added, or when the least recently used of
+    ``max_size`` tokens has to make room; ``discard`` forgets a token
+    the app registered again.
+
+    ``sink`` is a coroutine function called with lists of
+    ``InvalidToken`` records to persist them. A batch is written once
+    ``batch_size`` records are pending or ``flush_interval`` seconds
+    after the first of them arrived.
+    """
+
+    def __init__(self, max_size=100000, *, ttl=24 * 60 * 60, sink=None, batch_size=100,
+                 flush_interval=1.0, clock=time.time, loop=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._clock = clock
+        self._loop = loop or asyncio.get_event_loop()
+        self._entries = collections.OrderedDict()  # token -> (InvalidToken, expires_at)
+        self._pending = []
+        self._flush_handle = None
+        self._flushing = set()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, token):
+        return self.get(token) is not None
+
+    def get(self, token: str) -> Optional[InvalidToken]:
+        entry = self._entries.get(token)
+        if entry is None:
+            return None
+        record, expires_at = entry
+        if expires_at <= self._clock():
+            del self._entries[token]
+            return None
+        self._entries.move_to_end(token)
+        return record
+
+    def add(self, token: str, reason, code=None, timestamp: Optional[int] = None):
+        """Remembers ``token``, ``timestamp`` is in milliseconds as in APNs responses."""
+        record = InvalidToken(token, reason, code, timestamp)
+        # tokens of apps uninstalled long ago come with old timestamps, they are suppressed all the same
+        self._entries[token] = (record, self._clock() + self.ttl)
+        self._entries.move_to_end(token)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        if self.sink is not None:
+            self._pending.append(record)
+            if len(self._pending) >= self.batch_size:
+                self._start_flush()
+            elif self._flush_handle is None:
+                self._flush_handle = self._loop.call_later(self.flush_interval, self._start_flush)
+
+    def discard(self, token: str, registered_at: Optional[float] = None):
+        """Forgets ``token``, unless APNs reported it invalid after ``registered_at`` (unix time)."""
+        entry = self._entries.get(token)
+        if entry is None:
+            return
+        timestamp = entry[0].timestamp
+        if registered_at is not None and timestamp is not None and timestamp / 1000 > registered_at:
+            # the registration is older than the invalidation, the token is still dead
+            return
+        del self._entries[token]
+
+    def _start_flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        task = asyncio.ensure_future(self.sink(batch), loop=self._loop)
+        self._flushing.add(task)
+        task.add_done_callback(self._flush_done)
+
+    def _flush_done(self, task):
+        self._flushing.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            # the batch is lost, there is nobody to retry for
+            self._loop.call_exception_handler({
+                "message": "Writing invalid tokens failed",
+                "exception": task.exception(),
+                "future": task,
+            })
+
+    @asyncio.coroutine
+    def flush(self):
+        """Writes the pending records and waits for all writes in progress."""
+        self._start_flush()
+        if self._flushing:
+            yield from asyncio.wait(list(self._flushing), loop=self._loop)
@@ -0,0 +1,97 @@
+import asyncio
+import collections
+import time
+
+
+# HTTP statuses APNs answers with when it throttles the provider
+OVERLOAD_STATUSES = (429, 503)
+
+# how fast the latency baseline follows slower samples, so it adapts to a changed network path
+BASELINE_DRIFT = 0.01
+
+
+class AIMDLimiter:
+    """Additive increase, multiplicative decrease limit of requests in flight.
+
+    Every request answered in time raises ``limit`` by ``1 / limit``,
+    that is by about one per round of requests. A request throttled by
+    APNs or answered later than ``latency_tolerance`` times the latency
+    baseline cuts ``limit`` by ``backoff``. The limit is cut at most once
+    per round: requests started before the previous cut are ignored.
+    """
+
+    def __init__(self, initial_limit=20, *, min_limit=1, max_limit=1000, backoff=0.5,
+                 latency_tolerance=2.0, clock=time.monotonic, loop=None):
+        if not 1 <= min_limit <= initial_limit <= max_limit:
+            raise ValueError("expected 1 <= min_limit <= initial_limit <= max_limit")
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.latency_baseline = None
+        self.in_flight = 0
+        self._clock = clock
+        self._cut_at = None
+        self._waiters = collections.deque()
+        self._loop = loop
+
+    @property
+    def queue_depth(self):
+        return len(self._waiters)
+
+    @asyncio.coroutine
+    def acquire(self):
+        """Waits until fewer than ``limit`` requests are in flight, returns the start time."""
+        if not self._waiters and self.in_flight < int(self.limit):
+            self.in_flight += 1
+            return self._clock()
+        waiter = asyncio.Future(loop=self._loop)
+        self._waiters.append(waiter)
+        try:
+            yield from waiter
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was handed over in the same iteration the wait was abandoned
+                self.in_flight -= 1
+                self._wake()
+            else:
+                self._waiters.remove(waiter)
+            raise
+        return self._clock()
+
+    def release(self, started, *, overloaded=False, sample=True):
+        """Frees the slot of a request started at ``started``.
+
+        ``overloaded`` tells that APNs throttled the request, with
+        ``sample`` false its latency does not change the limit.
+        """
+        self.in_flight -= 1
+        if overloaded:
+            self._cut(started)
+        elif sample:
+            latency = self._clock() - started
+            baseline = self.latency_baseline
+            if baseline is None or latency < baseline:
+                self.latency_baseline = latency
+            else:
+                self.latency_baseline = baseline + (latency - baseline) * BASELINE_DRIFT
+            if baseline is not None and latency > baseline * self.latency_tolerance:
+                self._cut(started)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        self._wake()
+
+    def _cut(self, started):
+        if self._cut_at is not None and started < self._cut_at:
+            return
+        self._cut_at = self._clock()
+        self.limit = max(self.min_limit, self.limit * self.backoff)
+
+    def _wake(self):
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if waiter.done():
+                continue
+            self.in_flight += 1
+            waiter.set_result(None)
@@ -0,0 +1,76 @@
+import collections
+
+
+class Metrics:
+    """Instrumentation hooks of ``H2ClientProtocol`` and ``APNsConnection``.
+
+    Every hook does nothing, subclasses override the ones they need.
+    Durations are in seconds. When no metrics object is given, no hook
+    is called and no time is measured.
+    """
+
+    def stream_queued(self, wait_time: float):
+        """A request waited for a free stream (MAX_CONCURRENT_STREAMS)."""
+
+    def flow_control_blocked(self, wait_time: float):
+        """A request body waited for a flow control window update."""
+
+    def response_headers(self, elapsed: float):
+        """Response headers arrived ``elapsed`` seconds after the request headers were sent."""
+
+    def request_done(self, elapsed: float, status: int):
+        """A stream ended with HTTP ``status`` ``elapsed`` seconds after it was opened."""
+
+    def message_done(self, elapsed: float, reason):
+        """``APNsConnection.send_message`` finished, ``reason`` is None on success."""
+
+    def goaway(self, error_code, last_stream_id):
+        """The server sent GOAWAY."""
+
+    def connection_lost(self):
+        """The transport was closed."""
+
+    def ping_acknowledged(self, rtt: float):
+        """A keepalive PING was acknowledged after ``rtt`` seconds."""
+
+    def standby_connect_failed(self, exc: Exception):
+        """Opening a standby connection failed, it is tried again later."""
+
+
+class MetricsRecorder(Metrics):
+    """Keeps counters and raw duration samples in memory."""
+
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.histograms = collections.defaultdict(list)
+
+    def stream_queued(self, wait_time):
+        self.counters["stream_queued"] += 1
+        self.histograms["stream_queued"].append(wait_time)
+
+    def flow_control_blocked(self, wait_time):
+        self.counters["flow_control_blocked"] += 1
+        self.histograms["flow_control_blocked"].append(wait_time)
+
+    def response_headers(self, elapsed):
+        self.histograms["response_headers"].append(elapsed)
+
+    def request_done(self, elapsed, status):
+        self.counters["status_{}".format(status)] += 1
+        self.histograms["request"].append(elapsed)
+
+    def message_done(self, elapsed, reason):
+        self.counters["reason_{}".format(reason) if reason is not None else "delivered"] += 1
+        self.histograms["message"].append(elapsed)
+
+    def goaway(self, error_code, last_stream_id):
+        self.counters["goaway"] += 1
+
+    def connection_lost(self):
+        self.counters["connection_lost"] += 1
+
+    def ping_acknowledged(self, rtt):
+        self.histograms["ping_rtt"].append(rtt)
+
+    def standby_connect_failed(self, exc):
+        self.counters["standby_connect_failed"] += 1
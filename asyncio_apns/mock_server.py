@@ -0,0 +1,215 @@
+"""Local stand-in for the APNs HTTP/2 gateway, for load and failure-mode tests.
+
+Run it with ``python -m asyncio_apns.mock_server --cert cert.pem --key key.pem``.
+"""
+import argparse
+import asyncio
+import json
+import random
+import ssl
+import time
+import uuid
+
+from h2.config import H2Configuration
+from h2.connection import H2Connection
+from h2.events import (ConnectionTerminated, DataReceived, RequestReceived,
+                       StreamEnded, StreamReset)
+from h2.settings import SettingCodes
+
+
+DEVICE_PATH_PREFIX = "/3/device/"
+
+# (status, reason) pairs answered for the configured share of requests
+DEFAULT_ERRORS = ((400, "BadDeviceToken"), (410, "Unregistered"))
+
+
+class MockAPNsServer:
+    """HTTP/2 server answering like APNs does.
+
+    ``latency`` delays every response, ``error_rate`` is the share of
+    requests answered with one of ``errors``. ``max_concurrent_streams``
+    and ``initial_window_size`` are announced in the server SETTINGS and
+    ``connection_window_size`` raises the connection flow control window.
+    After ``goaway_after`` requests a connection is closed with GOAWAY;
+    ``send_goaway`` does the same on demand.
+    """
+
+    def __init__(self, cert_file: str, key_file: str, *, host="127.0.0.1", port=0,
+                 latency=0.0, error_rate=0.0, errors=DEFAULT_ERRORS,
+                 max_concurrent_streams=None, initial_window_size=None,
+                 connection_window_size=None, goaway_after=None, seed=None, loop=None):
+        self.cert_file = cert_file
+        self.key_file = key_file
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.error_rate = error_rate
+        self.errors = errors
+        self.max_concurrent_streams = max_concurrent_streams
+        self.initial_window_size = initial_window_size
+        self.connection_window_size = connection_window_size
+        self.goaway_after = goaway_after
+        self.random = random.Random(seed)
+        self.connections = set()
+        self.requests_count = 0
+        self.responses_count = 0
+        self._server = None
+        self._loop = loop or asyncio.get_event_loop()
+
+    def _ssl_context(self):
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(self.cert_file, self.key_file)
+        ssl_context.set_alpn_protocols(["h2"])
+        return ssl_context
+
+    @asyncio.coroutine
+    def start(self):
+        self._server = yield from self._loop.create_server(
+            lambda: _MockAPNsProtocol(self), host=self.host, port=self.port, ssl=self._ssl_context())
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    @asyncio.coroutine
+    def stop(self):
+        for connection in list(self.connections):
+            connection.transport.close()
+        self._server.close()
+        yield from self._server.wait_closed()
+
+    def send_goaway(self, error_code=0, reason="Shutdown"):
+        for connection in list(self.connections):
+            connection.goaway(error_code, reason)
+
+    def _response_for(self, token: str):
+        if not token:
+            return 404, "BadPath"
+        if self.error_rate and self.random.random() < self.error_rate:
+            return self.random.choice(self.errors)
+        return 200, None
+
+
+class _MockAPNsProtocol(asyncio.Protocol):
+    def __init__(self, server: MockAPNsServer):
+        self.server = server
+        self.conn = H2Connection(config=H2Configuration(client_side=False, header_encoding="utf-8"))
+        self.transport = None
+        self.requests = dict()  # stream_id -> request headers
+        self.handled = 0
+        self.last_answered_stream_id = 0
+        self.closing = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.connections.add(self)
+        self.conn.initiate_connection()
+        settings = dict()
+        if self.server.max_concurrent_streams is not None:
+            settings[SettingCodes.MAX_CONCURRENT_STREAMS] = self.server.max_concurrent_streams
+        if self.server.initial_window_size is not None:
+            settings[SettingCodes.INITIAL_WINDOW_SIZE] = self.server.initial_window_size
+        if settings:
+            self.conn.update_settings(settings)
+        if self.server.connection_window_size:
+            self.conn.increment_flow_control_window(self.server.connection_window_size)
+        self.transport.write(self.conn.data_to_send())
+
+    def connection_lost(self, exc):
+        self.server.connections.discard(self)
+        self.transport = None
+
+    def data_received(self, data):
+        if self.closing:
+            return
+        for event in self.conn.receive_data(data):
+            if isinstance(event, RequestReceived):
+                self.requests[event.stream_id] = dict(event.headers)
+            elif isinstance(event, DataReceived):
+                self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, StreamEnded):
+                self.request_received(event.stream_id)
+            elif isinstance(event, StreamReset):
+                self.requests.pop(event.stream_id, None)
+            elif isinstance(event, ConnectionTerminated):
+                self.transport.close()
+                return
+        self._write()
+
+    def _write(self):
+        if self.transport is not None:
+            self.transport.write(self.conn.data_to_send())
+
+    def request_received(self, stream_id):
+        self.server.requests_count += 1
+        self.handled += 1
+        if self.server.latency:
+            self.server._loop.call_later(self.server.latency, self.respond, stream_id)
+        else:
+            self.respond(stream_id)
+
+    def respond(self, stream_id):
+        headers = self.requests.pop(stream_id, None)
+        if self.closing or headers is None:
+            return
+        path = headers.get(":path", "")
+        token = path[len(DEVICE_PATH_PREFIX):] if path.startswith(DEVICE_PATH_PREFIX) else ""
+        status, reason = self.server._response_for(token)
+        response_headers = [(":status", str(status)),
+                            ("apns-id", headers.get("apns-id") or str(uuid.uuid4()).upper())]
+        if reason is None:
+            self.conn.send_headers(stream_id, response_headers, end_stream=True)
+        else:
+            body = {"reason": reason}
+            if status == 410:
+                body["timestamp"] = int(time.time() * 1000)
+            data = json.dumps(body).encode()
+            response_headers.append(("content-type", "application/json"))
+            response_headers.append(("content-length", str(len(data))))
+            self.conn.send_headers(stream_id, response_headers)
+            self.conn.send_data(stream_id, data, end_stream=True)
+        self.server.responses_count += 1
+        self.last_answered_stream_id = max(self.last_answered_stream_id, stream_id)
+        self._write()
+        if self.server.goaway_after is not None and self.handled >= self.server.goaway_after:
+            self.goaway(0, "Shutdown")
+
+    def goaway(self, error_code, reason):
+        if self.closing or self.transport is None:
+            return
+        self.closing = True
+        # streams still waiting for their response were never processed
+        self.conn.close_connection(error_code, json.dumps({"reason": reason}).encode(),
+                                   last_stream_id=self.last_answered_stream_id)
+        self._write()
+        self.transport.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--cert", required=True)
+    parser.add_argument("--key", required=True)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8443)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--max-concurrent-streams", type=int)
+    parser.add_argument("--initial-window-size", type=int)
+    parser.add_argument("--goaway-after", type=int)
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    server = MockAPNsServer(args.cert, args.key, host=args.host, port=args.port, latency=args.latency,
+                            error_rate=args.error_rate, max_concurrent_streams=args.max_concurrent_streams,
+                            initial_window_size=args.initial_window_size, goaway_after=args.goaway_after,
+                            loop=loop)
+    loop.run_until_complete(server.start())
+    print("Serving on {}:{}".format(server.host, server.port), flush=True)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(server.stop())
+        loop.close()
+
+
+if __name__ == "__main__":
+    main()
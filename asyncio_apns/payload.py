@@ -1,4 +1,15 @@
-from typing import Optional, List, Union
+import json
+import re
+from json.encoder import encode_basestring_ascii
+from typing import Iterable, Iterator, Mapping, Optional, List, Union
+
+from .errors import PayloadTooLargeError
+
+
+MAX_PAYLOAD_SIZE = 4096
+VOIP_MAX_PAYLOAD_SIZE = 5120
+
+_ELLIPSIS = "\u2026"
 
 
 class PayloadAlert:
@@ -42,20 +53,62 @@ class PayloadAlert:
         return result
 
 
+class CompiledPayload:
+    """Encoded payload body, shared as is between all recipients."""
+
+    __slots__ = ('data', 'content_length')
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.content_length = str(len(data)).encode()
+
+    def __setattr__(self, name, value):
+        if hasattr(self, name):
+            raise AttributeError("CompiledPayload is immutable")
+        super().__setattr__(name, value)
+
+    def __repr__(self):
+        return "CompiledPayload({!r})".format(self.data)
+
+
+def _truncated(text: str, excess: int) -> Optional[str]:
+    """``text`` ending with an ellipsis, encoded at least ``excess`` bytes shorter; None if it is too short."""
+    excess += len(encode_basestring_ascii(_ELLIPSIS)) - 2
+    end = len(text)
+    # whole characters are dropped, an escape sequence or a surrogate pair is never split
+    while excess > 0 and end:
+        end -= 1
+        excess -= len(encode_basestring_ascii(text[end])) - 2
+    if excess > 0:
+        return None
+    return text[:end] + _ELLIPSIS
+
+
 class Payload:
+    """Notification payload, ``compile`` refuses to encode more than ``max_size`` bytes.
+
+    Use ``VOIP_MAX_PAYLOAD_SIZE`` for VoIP pushes. With
+    ``truncate_body`` an oversized alert body is shortened to fit and
+    ends with an ellipsis instead.
+    """
+
     def __init__(self,
                  alert: Optional[Union[PayloadAlert, str]] = None,
                  badge: Optional[int] = None,
                  sound: Optional[str] = None,
                  content_available: Optional[bool] = None,
                  category: Optional[str] = None,
-                 custom: Optional[dict] = None):
+                 custom: Optional[dict] = None,
+                 max_size: int = MAX_PAYLOAD_SIZE,
+                 truncate_body: bool = False):
         self.alert = alert
         self.badge = badge
         self.sound = sound
         self.content_available = content_available
         self.category = category
         self.custom = custom
+        self.max_size = max_size
+        self.truncate_body = truncate_body
 
     def as_dict(self):
         result = dict(aps={})
@@ -77,3 +130,132 @@ class Payload:
         if self.custom is not None:
             result.update(self.custom)
         return result
+
+    def compile(self) -> CompiledPayload:
+        result = self.as_dict()
+        data = json.dumps(result).encode()
+        if len(data) <= self.max_size:
+            return CompiledPayload(data)
+        alert = result['aps'].get('alert')
+        body = alert.get('body') if isinstance(alert, dict) else alert
+        if not self.truncate_body or not isinstance(body, str):
+            raise PayloadTooLargeError(len(data), self.max_size)
+        # the rest encodes the same, so the body alone has to shrink by the excess
+        body = _truncated(body, len(data) - self.max_size)
+        if body is None:
+            raise PayloadTooLargeError(len(data), self.max_size)
+        if isinstance(alert, dict):
+            alert['body'] = body
+        else:
+            result['aps']['alert'] = body
+        return CompiledPayload(json.dumps(result).encode())
+
+
+def _encode_str(value) -> bytes:
+    if not isinstance(value, str):
+        raise TypeError("expected str, got {}".format(type(value).__name__))
+    # the C escaper json.dumps uses, so rendered payloads equal compiled ones
+    return encode_basestring_ascii(value).encode()
+
+
+def _encode_int(value) -> bytes:
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise TypeError("expected int, got {}".format(type(value).__name__))
+    return b"%d" % value
+
+
+_SLOT_ENCODERS = {str: _encode_str, int: _encode_int}
+
+# what a Slot is serialized to while the template is compiled, numbered in order
+_PLACEHOLDER = "\x00{}\x00"
+_PLACEHOLDER_RE = re.compile(rb'"\\u0000(\d+)\\u0000"')
+
+
+class Slot:
+    """Placeholder for a ``str`` or ``int`` value in a ``PayloadTemplate``.
+
+    ``max_size`` caps the encoded value in bytes, quotes and escapes
+    included. When every slot of a template has one, the template is
+    checked against the size limit once, at compile time.
+    """
+
+    __slots__ = ('name', 'type', 'max_size', 'encode')
+
+    def __init__(self, name: str, type=str, max_size: Optional[int] = None):
+        if type not in _SLOT_ENCODERS:
+            raise TypeError("slot type must be str or int")
+        self.name = name
+        self.type = type
+        self.max_size = max_size
+        self.encode = _SLOT_ENCODERS[type]
+
+    def __repr__(self):
+        return "Slot({!r}, {})".format(self.name, self.type.__name__)
+
+
+class PayloadTemplate:
+    """Payload encoded once, with ``Slot`` placeholders filled in per message.
+
+    ``payload`` may hold slots anywhere a string or a number goes: the
+    alert or its fields, the badge, custom values. The JSON around them
+    is encoded here, so ``render`` only escapes the slot values and
+    joins bytes. ``max_size`` defaults to the one of ``payload``.
+    Templates do not truncate, payloads with ``truncate_body`` are
+    refused rather than rendered over the limit.
+    """
+
+    def __init__(self, payload: Payload, max_size: Optional[int] = None):
+        if payload.truncate_body:
+            raise ValueError("PayloadTemplate does not support truncate_body")
+        if max_size is None:
+            max_size = payload.max_size
+        slots = []
+
+        def placeholder(value):
+            if not isinstance(value, Slot):
+                raise TypeError("Object of type {} is not JSON serializable".format(type(value).__name__))
+            slots.append(value)
+            return _PLACEHOLDER.format(len(slots) - 1)
+
+        parts = _PLACEHOLDER_RE.split(json.dumps(payload.as_dict(), default=placeholder).encode())
+        if len(parts) != 2 * len(slots) + 1:
+            raise ValueError("payload strings must not look like slot placeholders")
+        self.max_size = max_size
+        self.slots = [slots[int(index)] for index in parts[1::2]]
+        self._head = parts[0]
+        self._parts = list(zip(self.slots, parts[2::2]))
+        fixed_size = sum(len(part) for part in parts[::2])
+        if any(slot.max_size is None for slot in self.slots):
+            self._check_size = True
+            largest = fixed_size
+        else:
+            self._check_size = False
+            largest = fixed_size + sum(slot.max_size for slot in self.slots)
+        if largest > max_size:
+            raise PayloadTooLargeError(largest, max_size)
+
+    def render(self, **values) -> CompiledPayload:
+        return self.render_values(values)
+
+    def render_values(self, values: Mapping) -> CompiledPayload:
+        result = [self._head]
+        for slot, part in self._parts:
+            try:
+                value = values[slot.name]
+            except KeyError:
+                raise KeyError("no value for slot {!r}".format(slot.name)) from None
+            encoded = slot.encode(value)
+            if slot.max_size is not None and len(encoded) > slot.max_size:
+                raise PayloadTooLargeError(len(encoded), slot.max_size)
+            result.append(encoded)
+            result.append(part)
+        data = b"".join(result)
+        if self._check_size and len(data) > self.max_size:
+            raise PayloadTooLargeError(len(data), self.max_size)
+        return CompiledPayload(data)
+
+    def render_many(self, values: Iterable[Mapping]) -> Iterator[CompiledPayload]:
+        """Renders a payload for every mapping of slot names to values."""
+        render = self.render_values
+        for item in values:
+            yield render(item)
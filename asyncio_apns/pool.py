@@ -0,0 +1,149 @@
+import asyncio
+import collections
+
+from .apns_connection import APNsConnection
+
+
+ConnectionStats = collections.namedtuple(
+    "ConnectionStats", ["connected", "open_streams", "max_concurrent_streams"])
+
+
+def _faster(connection, other):
+    return connection.rtt is not None and (other.rtt is None or connection.rtt < other.rtt)
+
+
+class APNsConnectionPool:
+    """Several HTTP/2 connections to one APNs host.
+
+    Every message goes over the connection with the most free streams,
+    the one with the lowest keepalive PING round trip time among equals.
+    The pool opens another connection (up to ``max_size``) once all of
+    them are saturated and closes extra ones (down to ``min_size``) after
+    they stay idle for ``idle_timeout`` seconds. ``connection_options``
+    are passed to every ``APNsConnection``.
+    """
+
+    def __init__(self, cert_file: str, key_file: str, *, min_size=1, max_size=4,
+                 idle_timeout=60.0, loop=None, **connection_options):
+        if min_size < 1 or max_size < min_size:
+            raise ValueError("expected 1 <= min_size <= max_size")
+        self.cert_file = cert_file
+        self.key_file = key_file
+        self.connection_options = connection_options
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.connections = []
+        self._loop = loop or asyncio.get_event_loop()
+        self._idle_since = dict()  # connection -> loop time it became idle
+        self._growing = None
+
+    @property
+    def connected(self):
+        return any(connection.connected for connection in self.connections)
+
+    @property
+    def size(self):
+        return len(self.connections)
+
+    def stats(self):
+        result = []
+        for connection in self.connections:
+            if connection.connected:
+                protocol = connection.protocol
+                result.append(ConnectionStats(True, protocol.open_streams, protocol.max_concurrent_streams))
+            else:
+                result.append(ConnectionStats(False, 0, 0))
+        return result
+
+    def _new_connection(self):
+        return APNsConnection(self.cert_file, self.key_file, loop=self._loop, **self.connection_options)
+
+    def _discard_dead(self):
+        # connections closed by the server are replaced with fresh ones
+        alive = []
+        for connection in self.connections:
+            if connection.protocol is not None and not connection.protocol.connected:
+                self._idle_since.pop(connection, None)
+                # also closes its standby connections and stops its reconnect
+                connection.disconnect()
+            else:
+                alive.append(connection)
+        self.connections = alive
+
+    def _shrink(self):
+        now = self._loop.time()
+        for connection in list(self.connections):
+            if not connection.connected or connection.protocol.open_streams:
+                self._idle_since.pop(connection, None)
+                continue
+            idle_since = self._idle_since.setdefault(connection, now)
+            if now - idle_since >= self.idle_timeout and len(self.connections) > self.min_size:
+                del self._idle_since[connection]
+                self.connections.remove(connection)
+                connection.disconnect()
+
+    def _least_loaded(self):
+        best, best_free = None, 0
+        for connection in self.connections:
+            if not connection.connected:
+                continue
+            free = connection.protocol.free_streams
+            if best is None or free > best_free or (free == best_free and _faster(connection, best)):
+                best, best_free = connection, free
+        return best, best_free
+
+    @asyncio.coroutine
+    def connect(self):
+        self._discard_dead()
+        while len(self.connections) < self.min_size:
+            self.connections.append(self._new_connection())
+        yield from asyncio.gather(*(connection.connect() for connection in self.connections), loop=self._loop)
+
+    @asyncio.coroutine
+    def _do_grow(self):
+        connection = self._new_connection()
+        self.connections.append(connection)
+        try:
+            yield from connection.connect()
+        except Exception:
+            self.connections.remove(connection)
+            raise
+
+    @asyncio.coroutine
+    def _grow(self):
+        if self._growing is None:
+            self._growing = self._loop.create_task(self._do_grow())
+        growing = self._growing
+        try:
+            yield from growing
+        finally:
+            if self._growing is growing:
+                self._growing = None
+
+    @asyncio.coroutine
+    def _acquire(self):
+        self._discard_dead()
+        self._shrink()
+        connection, free = self._least_loaded()
+        if connection is None or len(self.connections) < self.min_size:
+            # dead connections are replaced up to min_size
+            yield from self.connect()
+            connection, free = self._least_loaded()
+        if free <= 0 and len(self.connections) < self.max_size:
+            yield from self._grow()
+            connection, free = self._least_loaded()
+        # when the pool is at max_size the request waits for a stream on the least loaded connection
+        return connection
+
+    @asyncio.coroutine
+    def send_message(self, *args, **kwargs):
+        connection = yield from self._acquire()
+        return (yield from connection.send_message(*args, **kwargs))
+
+    def disconnect(self):
+        for connection in self.connections:
+            if connection.connected:
+                connection.disconnect()
+        self.connections = []
+        self._idle_since.clear()
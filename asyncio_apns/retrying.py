@@ -1,23 +1,131 @@
 import asyncio
+import random
+import time
+import uuid
+from typing import Optional
 
 from .apns_connection import APNsConnection
-from .errors import APNsDisconnectError
+from .errors import APNsError, APNsDisconnectError, Reason
+
+
+# APNs answers these when the failure is on its side, the same message may succeed later
+RETRYABLE_REASONS = frozenset((Reason.TooManyRequests, Reason.InternalServerError,
+                               Reason.ServiceUnavailable, Reason.Shutdown))
+
+
+class RetryBudget:
+    """Caps retries at ``ratio`` of the messages sent plus ``min_per_second``.
+
+    Every message deposits ``ratio``, every retry withdraws one, the
+    balance never exceeds ``max_balance``. During an outage retries stop
+    once the budget is spent instead of multiplying the load.
+    """
+
+    def __init__(self, ratio=0.2, *, min_per_second=10.0, max_balance=100.0, clock=time.monotonic):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_balance = max_balance
+        self.balance = max_balance
+        self._clock = clock
+        self._refilled_at = clock()
+
+    def deposit(self):
+        self.balance = min(self.max_balance, self.balance + self.ratio)
+
+    def withdraw(self) -> bool:
+        now = self._clock()
+        self.balance = min(self.max_balance, self.balance + (now - self._refilled_at) * self.min_per_second)
+        self._refilled_at = now
+        if self.balance < 1:
+            return False
+        self.balance -= 1
+        return True
+
+
+class RetryPolicy:
+    """When and how long to wait before sending a failed message again.
+
+    Disconnects and ``retryable_reasons`` are retried, other errors are
+    final. The delay before attempt ``n`` is random between zero and
+    ``base_delay * 2 ** (n - 1)``, capped at ``max_delay``. A message is
+    given up after ``max_attempts`` attempts, when the next one would
+    start after ``deadline`` seconds, or when ``budget`` is spent.
+    """
+
+    def __init__(self, *, max_attempts=5, base_delay=0.1, max_delay=10.0, deadline: Optional[float] = 60.0,
+                 retryable_reasons=RETRYABLE_REASONS, budget: Optional[RetryBudget] = None,
+                 random=random.random, clock=time.monotonic):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.retryable_reasons = retryable_reasons
+        self.budget = budget if budget is not None else RetryBudget(clock=clock)
+        self._random = random
+        self._clock = clock
+
+    def is_retryable(self, exc: Exception) -> bool:
+        if isinstance(exc, APNsDisconnectError):
+            return True
+        return isinstance(exc, APNsError) and exc.status in self.retryable_reasons
+
+    def message_deadline(self, deadline: Optional[float] = None) -> Optional[float]:
+        """Time by ``clock`` after which a message is not retried, ``deadline`` is its own unix time one."""
+        result = self._clock() + self.deadline if self.deadline is not None else None
+        if deadline is not None:
+            own = self._clock() + deadline - time.time()
+            result = own if result is None else min(result, own)
+        return result
+
+    def retry_delay(self, exc: Exception, attempts: int, deadline: Optional[float],
+                    base_delay: Optional[float] = None) -> Optional[float]:
+        """Seconds to wait before the next attempt, None to give up."""
+        if attempts >= self.max_attempts or not self.is_retryable(exc):
+            return None
+        if base_delay is None:
+            base_delay = self.base_delay
+        delay = self._random() * min(self.max_delay, base_delay * 2 ** (attempts - 1))
+        if deadline is not None and self._clock() + delay > deadline:
+            return None
+        # checked last, so that final errors do not spend the budget
+        if not self.budget.withdraw():
+            return None
+        return delay
 
 
 class RetryingProxy:
-    def __init__(self, client: APNsConnection, *, loop=None):
+    """Sends messages again according to ``policy``.
+
+    Every attempt of one message carries the same apns-id, so the
+    retries of a message can be told apart from duplicates.
+    """
+
+    def __init__(self, client: APNsConnection, *, policy: Optional[RetryPolicy] = None, loop=None):
         self.client = client
+        self.policy = policy if policy is not None else RetryPolicy()
         self._loop = loop or asyncio.get_event_loop()
 
     def __getattr__(self, item):
         return getattr(self.client, item)
 
     @asyncio.coroutine
-    def send_message(self, *args, resend_timeout=0.5, **kwargs):
+    def send_message(self, *args, resend_timeout: Optional[float] = None, apns_id: Optional[str] = None,
+                     **kwargs):
+        """Returns the apns-id, ``resend_timeout`` overrides the policy ``base_delay``."""
+        if apns_id is None:
+            apns_id = str(uuid.uuid4())
+        policy = self.policy
+        policy.budget.deposit()
+        # a non-zero expiration is a deadline for APNsConnection as well
+        own_deadlines = [value for value in (kwargs.get("deadline"), kwargs.get("expiration")) if value]
+        deadline = policy.message_deadline(min(own_deadlines) if own_deadlines else None)
+        attempts = 0
         while True:
             try:
-                yield from self.client.send_message(*args, **kwargs)
-                break
-            except APNsDisconnectError:
-                yield from asyncio.sleep(resend_timeout, loop=self._loop)
-                resend_timeout *= 2
+                return (yield from self.client.send_message(*args, apns_id=apns_id, **kwargs))
+            except (APNsError, APNsDisconnectError) as exc:
+                attempts += 1
+                delay = policy.retry_delay(exc, attempts, deadline, resend_timeout)
+                if delay is None:
+                    raise
+            yield from asyncio.sleep(delay, loop=self._loop)
@@ -0,0 +1,173 @@
+import asyncio
+import collections
+import time
+from typing import Optional, Sequence, Tuple, Union
+
+from .apns_connection import APNsConnection, NotificationPriority
+from .errors import APNsExpiredError
+from .payload import CompiledPayload, Payload
+
+
+IMMEDIATE = "immediate"
+DELAYED = "delayed"
+BACKGROUND = "background"
+
+# out of every 11 messages sent while all queues are busy, 8 are immediate ones
+DEFAULT_WEIGHTS = {IMMEDIATE: 8, DELAYED: 2, BACKGROUND: 1}
+
+COLLAPSE_ID_HEADER = "apns-collapse-id"
+
+
+def _is_background(payload) -> bool:
+    # silent content-available pushes wake the app without showing anything
+    return (isinstance(payload, Payload) and bool(payload.content_available)
+            and payload.alert is None and payload.badge is None and payload.sound is None)
+
+
+def _collapse_id(extra_headers) -> Optional[str]:
+    for name, value in extra_headers or ():
+        if name == COLLAPSE_ID_HEADER:
+            return value
+    return None
+
+
+class _Message:
+    __slots__ = ('args', 'kwargs', 'key', 'waiters', 'deadline')
+
+    def __init__(self, args, kwargs, key):
+        self.key = key  # (token, collapse id) or None
+        self.waiters = []
+        self.update(args, kwargs)
+
+    def update(self, args, kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        own_deadlines = [value for value in (kwargs.get("deadline"), kwargs.get("expiration")) if value]
+        self.deadline = min(own_deadlines) if own_deadlines else None
+
+    def expire(self):
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_exception(APNsExpiredError())
+
+    def abandoned(self):
+        return all(waiter.done() for waiter in self.waiters)
+
+
+class Scheduler:
+    """Queues messages in front of a client and sends them by class.
+
+    Immediate, delayed and background (content-available only) messages
+    wait in separate queues. While more than ``max_in_flight`` messages
+    are pending, the queues are served round robin in proportion to
+    ``weights``. A newer message for the same token and
+    ``apns-collapse-id`` replaces the content of a queued one, which keeps
+    its place in the queue: only the newest content is sent and all their
+    senders get its result. Messages whose ``deadline`` or
+    ``expiration`` passed while queued are dropped with
+    ``APNsExpiredError``.
+    """
+
+    def __init__(self, client: APNsConnection, *, max_in_flight=100, weights=None, loop=None):
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be positive")
+        weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        if min(weights.values()) < 1:
+            raise ValueError("weights must be positive")
+        self.client = client
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.merged_count = 0
+        self._queues = {name: collections.deque() for name in weights}
+        self._schedule = [name for name, weight in weights.items() for _ in range(weight)]
+        self._position = 0
+        self._collapsible = dict()  # (token, collapse id) -> queued _Message
+        self._loop = loop or asyncio.get_event_loop()
+
+    def queue_depth(self, name=None):
+        if name is not None:
+            return len(self._queues[name])
+        return sum(len(queue) for queue in self._queues.values())
+
+    @asyncio.coroutine
+    def send_message(self, payload: Union[Payload, CompiledPayload, str], token: str,
+                     priority: NotificationPriority = NotificationPriority.immediate,
+                     topic: str = None, extra_headers: Optional[Sequence[Tuple[str, str]]] = None,
+                     *, collapse_id: Optional[str] = None, background: Optional[bool] = None, **kwargs):
+        """Waits for the message to be sent, returns its apns-id.
+
+        ``background`` overrides the detection of silent pushes, which
+        only works for ``Payload`` objects.
+        """
+        if collapse_id is not None:
+            extra_headers = tuple(extra_headers or ()) + ((COLLAPSE_ID_HEADER, collapse_id),)
+        else:
+            collapse_id = _collapse_id(extra_headers)
+        if background is None:
+            background = _is_background(payload)
+        if background:
+            name = BACKGROUND
+        elif priority == NotificationPriority.immediate:
+            name = IMMEDIATE
+        else:
+            name = DELAYED
+        args = (payload, token, priority, topic, extra_headers)
+        key = (token, collapse_id) if collapse_id is not None else None
+        waiter = asyncio.Future(loop=self._loop)
+        queued = self._collapsible.get(key) if key is not None else None
+        if queued is not None:
+            # updated in place, moving it to the tail would starve a message updated faster than it is sent
+            queued.update(args, kwargs)
+            queued.waiters.append(waiter)
+            self.merged_count += 1
+        else:
+            message = _Message(args, kwargs, key)
+            message.waiters.append(waiter)
+            if key is not None:
+                self._collapsible[key] = message
+            self._queues[name].append(message)
+            self._dispatch()
+        return (yield from waiter)
+
+    def _next_message(self):
+        now = None
+        for _ in range(len(self._schedule)):
+            queue = self._queues[self._schedule[self._position]]
+            self._position = (self._position + 1) % len(self._schedule)
+            while queue:
+                message = queue.popleft()
+                if message.key is not None and self._collapsible.get(message.key) is message:
+                    del self._collapsible[message.key]
+                if message.abandoned():
+                    continue
+                if message.deadline is not None:
+                    now = now or time.time()
+                    if message.deadline <= now:
+                        message.expire()
+                        continue
+                return message
+        return None
+
+    def _dispatch(self):
+        while self.in_flight < self.max_in_flight:
+            message = self._next_message()
+            if message is None:
+                break
+            self.in_flight += 1
+            task = asyncio.ensure_future(self.client.send_message(*message.args, **message.kwargs),
+                                         loop=self._loop)
+            task.add_done_callback(lambda task, message=message: self._on_sent(task, message))
+
+    def _on_sent(self, task, message):
+        self.in_flight -= 1
+        exc = None if task.cancelled() else task.exception()
+        for waiter in message.waiters:
+            if waiter.done():
+                continue
+            if task.cancelled():
+                waiter.cancel()
+            elif exc is not None:
+                waiter.set_exception(exc)
+            else:
+                waiter.set_result(task.result())
+        self._dispatch()
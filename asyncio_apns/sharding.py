@@ -0,0 +1,265 @@
+"""Spreads sending over worker processes, each with its own event loop and pool.
+
+h2 framing is pure Python, so one event loop tops out at one core.
+``ShardedSender`` assigns every token to a worker by consistent hashing
+and exchanges batches of requests and results with the workers over
+socket pairs.
+"""
+import asyncio
+import bisect
+import hashlib
+import itertools
+import multiprocessing
+import os
+import pickle
+import socket
+import struct
+from typing import Optional, Sequence, Tuple, Union
+
+from .apns_connection import NotificationPriority, _compile_payload
+from .bulk import SendResults
+from .errors import APNsError, APNsDisconnectError
+from .invalid_tokens import INVALID_TOKEN_REASONS, InvalidTokenCache
+from .payload import CompiledPayload, Payload
+from .pool import APNsConnectionPool
+
+
+_FRAME_HEADER = struct.Struct(">I")
+
+# kinds of failures in result tuples
+_APNS_ERROR = 0
+_DISCONNECT_ERROR = 1
+_OTHER_ERROR = 2
+
+
+class WorkerError(Exception):
+    """A worker failed to send a message with an exception that cannot be passed back as is."""
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hash of tokens onto ``shards`` shards.
+
+    Changing the number of shards moves only about ``1 / shards`` of the
+    tokens, so per-token ordering and caches mostly survive a resize.
+    """
+
+    def __init__(self, shards: int, replicas=100):
+        points = sorted((_hash("{}-{}".format(shard, replica)), shard)
+                        for shard in range(shards) for replica in range(replicas))
+        self._points = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def shard(self, token: str) -> int:
+        index = bisect.bisect(self._points, _hash(token)) % len(self._points)
+        return self._shards[index]
+
+
+def _write_frame(writer, batch):
+    data = pickle.dumps(batch, pickle.HIGHEST_PROTOCOL)
+    writer.write(_FRAME_HEADER.pack(len(data)) + data)
+
+
+@asyncio.coroutine
+def _read_frame(reader):
+    try:
+        header = yield from reader.readexactly(_FRAME_HEADER.size)
+        return pickle.loads((yield from reader.readexactly(_FRAME_HEADER.unpack(header)[0])))
+    except asyncio.IncompleteReadError:
+        return None
+
+
+class _BatchWriter:
+    """Collects items and writes them as one frame per loop iteration."""
+
+    def __init__(self, writer, loop):
+        self.writer = writer
+        self._loop = loop
+        self._batch = []
+
+    def append(self, item):
+        if not self._batch:
+            self._loop.call_soon(self.flush)
+        self._batch.append(item)
+
+    def flush(self):
+        if self._batch:
+            batch, self._batch = self._batch, []
+            _write_frame(self.writer, batch)
+
+
+@asyncio.coroutine
+def _send_one(pool, results, request):
+    request_id, token, data, priority, topic, extra_headers, expiration, deadline = request
+    try:
+        apns_id = yield from pool.send_message(CompiledPayload(data), token, NotificationPriority(priority),
+                                               topic, extra_headers, expiration=expiration, deadline=deadline)
+        results.append((request_id, apns_id, None))
+    except APNsError as exc:
+        results.append((request_id, None, (_APNS_ERROR, exc.status, exc.identifier, exc.code, exc.timestamp)))
+    except APNsDisconnectError as exc:
+        results.append((request_id, None, (_DISCONNECT_ERROR, exc.reason, None, None, None)))
+    except Exception as exc:
+        # timeouts, connect failures, expired messages; one that does not pickle would lose the whole batch
+        try:
+            pickle.dumps(exc, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            exc = WorkerError(repr(exc))
+        results.append((request_id, None, (_OTHER_ERROR, exc, None, None, None)))
+
+
+@asyncio.coroutine
+def _serve(sock, cert_file, key_file, pool_options, loop):
+    reader, writer = yield from asyncio.open_connection(sock=sock, loop=loop)
+    pool = APNsConnectionPool(cert_file, key_file, loop=loop, **pool_options)
+    results = _BatchWriter(writer, loop)
+    tasks = set()
+    while True:
+        batch = yield from _read_frame(reader)
+        if batch is None:
+            break
+        for request in batch:
+            task = asyncio.ensure_future(_send_one(pool, results, request), loop=loop)
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    if tasks:
+        yield from asyncio.wait(tasks, loop=loop)
+    results.flush()
+    pool.disconnect()
+    writer.close()
+
+
+def _worker_main(sock, cert_file, key_file, pool_options):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(_serve(sock, cert_file, key_file, pool_options, loop))
+    finally:
+        loop.close()
+
+
+class _Worker:
+    def __init__(self, process, reader, writer, loop):
+        self.process = process
+        self.requests = _BatchWriter(writer, loop)
+        self.reader = reader
+        self.pending = dict()  # request id -> Future
+        self.reading = None
+        self.alive = True
+
+
+class ShardedSender:
+    """Sends messages through ``workers`` processes, one shard of tokens each.
+
+    Every worker runs an ``APNsConnectionPool`` made with
+    ``pool_options``. Messages travel to the workers as encoded payload
+    bytes, results come back as ``(apns-id, error)`` tuples. Tokens the
+    workers report invalid are recorded in ``invalid_tokens`` and not
+    sent again. Other failures in a worker are raised as they are, or as
+    ``WorkerError`` when they cannot be pickled. Messages for the shard
+    of a worker that died fail with ``APNsDisconnectError``.
+
+    ``pool_options`` are pickled for the worker processes, so workers
+    authenticate with ``cert_file`` and ``key_file``: a ``ProviderToken``
+    holds a private key object that cannot be passed to them.
+    """
+
+    def __init__(self, cert_file: str, key_file: str, *, workers: Optional[int] = None,
+                 invalid_tokens: Optional[InvalidTokenCache] = None, loop=None, **pool_options):
+        if pool_options.get("auth_token") is not None:
+            raise ValueError("ShardedSender workers authenticate with cert_file and key_file, not auth_token")
+        self.cert_file = cert_file
+        self.key_file = key_file
+        self.workers_count = workers or os.cpu_count() or 1
+        self.invalid_tokens = invalid_tokens
+        self.pool_options = pool_options
+        self.ring = HashRing(self.workers_count)
+        self.workers = []
+        self._request_ids = itertools.count()
+        self._loop = loop or asyncio.get_event_loop()
+
+    @asyncio.coroutine
+    def start(self):
+        # spawn, so that workers do not inherit the running event loop
+        context = multiprocessing.get_context("spawn")
+        for _ in range(self.workers_count):
+            parent_sock, child_sock = socket.socketpair()
+            process = context.Process(target=_worker_main, daemon=True,
+                                      args=(child_sock, self.cert_file, self.key_file, self.pool_options))
+            process.start()
+            child_sock.close()
+            reader, writer = yield from asyncio.open_connection(sock=parent_sock, loop=self._loop)
+            worker = _Worker(process, reader, writer, self._loop)
+            worker.reading = asyncio.ensure_future(self._read_results(worker), loop=self._loop)
+            self.workers.append(worker)
+
+    @asyncio.coroutine
+    def _read_results(self, worker):
+        while True:
+            batch = yield from _read_frame(worker.reader)
+            if batch is None:
+                break
+            for request_id, apns_id, error in batch:
+                future = worker.pending.pop(request_id)
+                if future.done():
+                    continue
+                if error is None:
+                    future.set_result(apns_id)
+                elif error[0] == _APNS_ERROR:
+                    future.set_exception(APNsError(error[1], error[2], error[3], error[4]))
+                elif error[0] == _DISCONNECT_ERROR:
+                    future.set_exception(APNsDisconnectError(error[1]))
+                else:
+                    future.set_exception(error[1])
+        # the worker exited, nothing more will be answered
+        worker.alive = False
+        while worker.pending:
+            _, future = worker.pending.popitem()
+            if not future.done():
+                future.set_exception(APNsDisconnectError(None))
+
+    @asyncio.coroutine
+    def send_message(self, payload: Union[Payload, CompiledPayload, str], token: str,
+                     priority: NotificationPriority = NotificationPriority.immediate,
+                     topic: str = None, extra_headers: Optional[Sequence[Tuple[str, str]]] = None,
+                     expiration: Optional[int] = None, deadline: Optional[float] = None):
+        """Returns the apns-id, ``expiration`` and ``deadline`` are as in ``APNsConnection.send_message``."""
+        if self.invalid_tokens is not None:
+            invalid = self.invalid_tokens.get(token)
+            if invalid is not None:
+                raise APNsError(invalid.reason, None, invalid.code)
+        worker = self.workers[self.ring.shard(token)]
+        if not worker.alive:
+            raise APNsDisconnectError(None)
+        request_id = next(self._request_ids)
+        future = worker.pending[request_id] = asyncio.Future(loop=self._loop)
+        worker.requests.append((request_id, token, _compile_payload(payload).data, priority.value, topic,
+                                tuple(extra_headers) if extra_headers else None, expiration, deadline))
+        try:
+            return (yield from future)
+        except APNsError as exc:
+            if self.invalid_tokens is not None and exc.status in INVALID_TOKEN_REASONS:
+                self.invalid_tokens.add(token, exc.status, exc.code, exc.timestamp)
+            raise
+
+    def send_many(self, payload: Union[Payload, CompiledPayload, str], tokens, *,
+                  max_in_flight=1000, **kwargs) -> SendResults:
+        payload = _compile_payload(payload)
+        return SendResults(lambda payload, token: self.send_message(payload, token, **kwargs), tokens,
+                           payload=payload, max_in_flight=max_in_flight, loop=self._loop)
+
+    @asyncio.coroutine
+    def stop(self):
+        """Lets the workers finish the pending messages and waits for them to exit."""
+        for worker in self.workers:
+            worker.requests.flush()
+            # the results still come back over the other direction
+            worker.requests.writer.write_eof()
+        for worker in self.workers:
+            yield from worker.reading
+            worker.requests.writer.close()
+            yield from self._loop.run_in_executor(None, worker.process.join)
+        self.workers = []
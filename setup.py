@@ -1,14 +1,17 @@
 import sys
 from setuptools import setup
 
-install_requires = ["h2>=2.2.0,<3.0.0"]
+install_requires = ["h2>=2.5.0,<3.0.0"]
 if sys.version_info < (3, 5):
     install_requires.append("typing")
 
 setup(
     name='asyncio-apns',
     version='0.0.1',
+    # typing.AsyncIterable is there from 3.5.2
+    python_requires='>=3.5.2',
     install_requires=install_requires,
+    extras_require={'token': ['cryptography']},
     packages=['asyncio_apns'],
     url='https://github.com/etataurov/asyncio-apns',
     license='MIT',
@@ -0,0 +1,127 @@
+import asyncio
+
+import pytest
+
+from asyncio_apns.admission import StreamAdmission
+
+
+class Capacity:
+    def __init__(self, value):
+        self.value = value
+
+    def __call__(self):
+        return self.value
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_admitted_immediately(event_loop):
+    admission = StreamAdmission(Capacity(2), loop=event_loop)
+    assert not (yield from admission.acquire())
+    assert not (yield from admission.acquire())
+    assert admission.active == 2
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_fifo_handoff(event_loop):
+    admission = StreamAdmission(Capacity(1), loop=event_loop)
+    yield from admission.acquire()
+    first = asyncio.ensure_future(admission.acquire(), loop=event_loop)
+    yield from asyncio.sleep(0)
+    assert admission.queue_depth == 1
+    admission.release()
+    # a newcomer arriving after the release must queue behind the woken waiter
+    newcomer = asyncio.ensure_future(admission.acquire(), loop=event_loop)
+    yield from asyncio.sleep(0)
+    assert first.done()
+    assert not newcomer.done()
+    assert admission.active == 1
+    admission.release()
+    yield from newcomer
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_reserved_for_high_priority(event_loop):
+    admission = StreamAdmission(Capacity(2), reserved=1, loop=event_loop)
+    yield from admission.acquire(high_priority=False)
+    low = asyncio.ensure_future(admission.acquire(high_priority=False), loop=event_loop)
+    yield from asyncio.sleep(0)
+    assert not low.done()
+    yield from admission.acquire(high_priority=True)
+    assert admission.active == 2
+    low.cancel()
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_high_priority_served_first(event_loop):
+    admission = StreamAdmission(Capacity(1), loop=event_loop)
+    yield from admission.acquire()
+    low = asyncio.ensure_future(admission.acquire(high_priority=False), loop=event_loop)
+    yield from asyncio.sleep(0)
+    high = asyncio.ensure_future(admission.acquire(high_priority=True), loop=event_loop)
+    yield from asyncio.sleep(0)
+    admission.release()
+    yield from asyncio.sleep(0)
+    assert high.done()
+    assert not low.done()
+    admission.release()
+    yield from low
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_timeout(event_loop):
+    admission = StreamAdmission(Capacity(1), loop=event_loop)
+    yield from admission.acquire()
+    with pytest.raises(asyncio.TimeoutError):
+        yield from admission.acquire(timeout=0.01)
+    assert admission.queue_depth == 0
+    assert admission.active == 1
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_backpressure(event_loop):
+    admission = StreamAdmission(Capacity(1), max_queue=1, loop=event_loop)
+    yield from admission.acquire()
+    queued = asyncio.ensure_future(admission.acquire(), loop=event_loop)
+    yield from asyncio.sleep(0)
+    blocked = asyncio.ensure_future(admission.acquire(), loop=event_loop)
+    yield from asyncio.sleep(0)
+    assert admission.queue_depth == 1
+    admission.release()
+    yield from queued
+    yield from asyncio.sleep(0)
+    # the blocked producer got room in the queue
+    assert admission.queue_depth == 1
+    admission.release()
+    yield from blocked
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_capacity_grows(event_loop):
+    capacity = Capacity(1)
+    admission = StreamAdmission(capacity, loop=event_loop)
+    yield from admission.acquire()
+    waiter = asyncio.ensure_future(admission.acquire(), loop=event_loop)
+    yield from asyncio.sleep(0)
+    capacity.value = 2
+    admission.dispatch()
+    yield from waiter
+    assert admission.active == 2
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_fail(event_loop):
+    admission = StreamAdmission(Capacity(1), loop=event_loop)
+    yield from admission.acquire()
+    waiter = asyncio.ensure_future(admission.acquire(), loop=event_loop)
+    yield from asyncio.sleep(0)
+    admission.fail(ValueError())
+    with pytest.raises(ValueError):
+        yield from waiter
@@ -0,0 +1,98 @@
+import base64
+import json
+
+import pytest
+
+from asyncio_apns import APNsConnection, NotificationPriority
+
+pytest.importorskip("cryptography")
+
+from cryptography.exceptions import InvalidSignature  # noqa: E402
+from cryptography.hazmat.backends import default_backend  # noqa: E402
+from cryptography.hazmat.primitives import hashes, serialization  # noqa: E402
+from cryptography.hazmat.primitives.asymmetric import ec  # noqa: E402
+from cryptography.hazmat.primitives.asymmetric.utils import encode_dss_signature  # noqa: E402
+
+from asyncio_apns.auth import ProviderToken  # noqa: E402
+
+
+def b64decode(data):
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+
+@pytest.fixture
+def private_key():
+    return ec.generate_private_key(ec.SECP256R1(), default_backend())
+
+
+@pytest.fixture
+def key_bytes(private_key):
+    return private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                     serialization.NoEncryption())
+
+
+class Clock:
+    def __init__(self, now=1000000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_signed(private_key, key_bytes):
+    token = ProviderToken("KEYID", "TEAMID", key=key_bytes, clock=Clock())
+    header, claims, signature = token.token.split(b'.')
+    assert json.loads(b64decode(header).decode()) == {"alg": "ES256", "kid": "KEYID"}
+    assert json.loads(b64decode(claims).decode()) == {"iss": "TEAMID", "iat": 1000000}
+    raw = b64decode(signature)
+    assert len(raw) == 64
+    der = encode_dss_signature(int.from_bytes(raw[:32], 'big'), int.from_bytes(raw[32:], 'big'))
+    try:
+        private_key.public_key().verify(der, header + b'.' + claims, ec.ECDSA(hashes.SHA256()))
+    except InvalidSignature:
+        pytest.fail("invalid signature")
+
+
+def test_token_from_file(tmpdir, key_bytes):
+    key_file = tmpdir.join("key.p8")
+    key_file.write_binary(key_bytes)
+    token = ProviderToken("KEYID", "TEAMID", key_file=str(key_file))
+    assert token.header_value.startswith(b'bearer ')
+
+
+def test_token_cached_until_refresh(key_bytes):
+    clock = Clock()
+    token = ProviderToken("KEYID", "TEAMID", key=key_bytes, refresh_interval=100, clock=clock)
+    first = token.header_value
+    clock.now += 99
+    assert token.header_value is first
+    clock.now += 1
+    assert token.header_value != first
+
+
+def test_token_invalidate(key_bytes):
+    clock = Clock()
+    token = ProviderToken("KEYID", "TEAMID", key=key_bytes, clock=clock)
+    first = token.header_value
+    clock.now += 1
+    token.invalidate()
+    assert token.header_value != first
+
+
+def test_key_required():
+    with pytest.raises(ValueError):
+        ProviderToken("KEYID", "TEAMID")
+
+
+def test_authorization_header(key_bytes):
+    token = ProviderToken("KEYID", "TEAMID", key=key_bytes)
+    connection = APNsConnection(auth_token=token)
+    headers, _ = connection._prepare_request("Hello", "abcde", NotificationPriority.immediate,
+                                             "com.example.app", None)
+    assert (b'authorization', token.header_value) in headers
+    assert (b'apns-topic', b'com.example.app') in headers
+
+
+def test_credentials_required():
+    with pytest.raises(ValueError):
+        APNsConnection()
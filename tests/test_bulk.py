@@ -0,0 +1,122 @@
+import asyncio
+
+import pytest
+
+from asyncio_apns.bulk import SendResults
+from asyncio_apns.errors import APNsError
+
+
+@asyncio.coroutine
+def collect(results):
+    collected = []
+    while True:
+        try:
+            collected.append((yield from results.__anext__()))
+        except StopAsyncIteration:
+            return collected
+
+
+class AsyncTokens:
+    def __init__(self, tokens):
+        self.tokens = iter(tokens)
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        yield from asyncio.sleep(0)
+        try:
+            return next(self.tokens)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class FakeSender:
+    def __init__(self, loop):
+        self.loop = loop
+        self.in_flight = 0
+        self.max_seen = 0
+
+    @asyncio.coroutine
+    def send(self, payload, token):
+        self.in_flight += 1
+        self.max_seen = max(self.max_seen, self.in_flight)
+        try:
+            yield from asyncio.sleep(0, loop=self.loop)
+            if token == "bad":
+                raise APNsError("BadDeviceToken", None)
+            return "id-" + token
+        finally:
+            self.in_flight -= 1
+
+
+@pytest.mark.asyncio
+def test_send_tokens(event_loop):
+    sender = FakeSender(event_loop)
+    results = SendResults(sender.send, ["a", "b", "bad"], payload="Hello", loop=event_loop)
+    collected = dict((yield from collect(results)))
+    assert collected["a"] == "id-a"
+    assert collected["b"] == "id-b"
+    assert isinstance(collected["bad"], APNsError)
+
+
+@pytest.mark.asyncio
+def test_send_pairs(event_loop):
+    sent = []
+
+    @asyncio.coroutine
+    def send(payload, token):
+        sent.append((token, payload))
+        return token
+
+    results = SendResults(send, [("a", "one"), ("b", "two")], loop=event_loop)
+    collected = yield from collect(results)
+    assert sorted(collected) == [("a", "a"), ("b", "b")]
+    assert sorted(sent) == [("a", "one"), ("b", "two")]
+
+
+@pytest.mark.asyncio
+def test_async_token_source(event_loop):
+    sender = FakeSender(event_loop)
+    results = SendResults(sender.send, AsyncTokens(["a", "b"]), payload="Hello", loop=event_loop)
+    collected = yield from collect(results)
+    assert sorted(collected) == [("a", "id-a"), ("b", "id-b")]
+
+
+@pytest.mark.asyncio
+def test_in_flight_bounded(event_loop):
+    sender = FakeSender(event_loop)
+    tokens = (str(i) for i in range(100))
+    results = SendResults(sender.send, tokens, payload="Hello", max_in_flight=7, loop=event_loop)
+    collected = yield from collect(results)
+    assert len(collected) == 100
+    assert sender.max_seen <= 7
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_close(event_loop):
+    sender = FakeSender(event_loop)
+    results = SendResults(sender.send, ["a", "b", "c"], payload="Hello", max_in_flight=2, loop=event_loop)
+    yield from results.__anext__()
+    results.close()
+    yield from asyncio.sleep(0, loop=event_loop)
+    with pytest.raises(StopAsyncIteration):
+        yield from results.__anext__()
+    assert sender.in_flight == 0
+
+
+@pytest.mark.asyncio
+def test_other_errors_are_results(event_loop):
+    @asyncio.coroutine
+    def send(payload, token):
+        if token == "slow":
+            raise asyncio.TimeoutError()
+        return token
+
+    results = SendResults(send, ["a", "slow", "b"], payload="Hello", loop=event_loop)
+    collected = dict((yield from collect(results)))
+    assert collected["a"] == "a"
+    assert collected["b"] == "b"
+    assert isinstance(collected["slow"], asyncio.TimeoutError)
@@ -1,10 +1,14 @@
 import asyncio
 from unittest import mock
 import json
+import time
 
 import pytest
 
-from asyncio_apns import APNsConnection, Payload, connect
+from asyncio_apns import (AIMDLimiter, APNsConnection, APNsDisconnectError, APNsError, APNsExpiredError,
+                          InvalidTokenCache, MetricsRecorder, NotificationPriority, Payload, Reason, connect)
+from asyncio_apns.apns_connection import _error_reason
+from asyncio_apns.h2_client import DisconnectError, HTTP2Error, UnprocessedStreamError
 
 
 def future_with_result(result):
@@ -77,6 +81,51 @@ def test_connect_when_connected(event_loop):
         assert mock_protocol.connect.call_count == 1
 
 
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_disconnect_cancels_connect(event_loop):
+    with mock.patch("asyncio_apns.apns_connection.H2ClientProtocol") as mock_protocol:
+        future = asyncio.Future()
+        mock_protocol.connect.return_value = future
+        connection = APNsConnection("some.crt", "some.key", loop=event_loop)
+        connecting = asyncio.ensure_future(connection.connect())
+        yield from asyncio.sleep(0)
+        yield from asyncio.sleep(0)
+        # the handshake in progress is abandoned
+        connection.disconnect()
+        with pytest.raises(APNsDisconnectError):
+            yield from connecting
+        assert future.cancelled()
+        assert connection.protocol is None
+        assert connection._connection_task is None
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_connect_after_cancelled_connect(event_loop):
+    with mock.patch("asyncio_apns.apns_connection.H2ClientProtocol") as mock_protocol:
+        protocol = mock.MagicMock()
+        handshakes = [asyncio.Future(), asyncio.Future(), future_with_result(mock.MagicMock())]
+        mock_protocol.connect.side_effect = handshakes
+        connection = APNsConnection("some.crt", "some.key", loop=event_loop)
+        connecting = asyncio.ensure_future(connection.connect())
+        yield from asyncio.sleep(0)
+        yield from asyncio.sleep(0)
+        connection.disconnect()
+        first = asyncio.ensure_future(connection.connect())
+        # the cancelled handshake finishes while the new one is in progress
+        for _ in range(3):
+            yield from asyncio.sleep(0)
+        second = asyncio.ensure_future(connection.connect())
+        yield from asyncio.sleep(0)
+        handshakes[1].set_result(protocol)
+        yield from asyncio.gather(first, second)
+        with pytest.raises(APNsDisconnectError):
+            yield from connecting
+        assert connection.protocol is protocol
+        assert mock_protocol.connect.call_count == 2
+
+
 @pytest.mark.asyncio
 def test_send_message(apns_connect):
     connection = yield from apns_connect()
@@ -86,7 +135,8 @@ def test_send_message(apns_connect):
         (mock.MagicMock(), mock.MagicMock()))
     yield from connection.send_message(message, token)
     expected_request_body = json.dumps(Payload(message).as_dict()).encode()
-    connection.protocol.send_request.assert_called_with(mock.ANY, expected_request_body)
+    connection.protocol.send_request.assert_called_with(mock.ANY, expected_request_body,
+                                                        high_priority=True, timeout=None)
 
 
 @pytest.mark.asyncio
@@ -102,3 +152,230 @@ def test_not_connected_when_sending_message(apns_connect):
         (mock.MagicMock(), mock.MagicMock()))
     yield from connection.send_message(message, token)
     assert apns_connection.H2ClientProtocol.connect.called
+
+
+@pytest.mark.asyncio
+def test_send_many(apns_connect):
+    connection = yield from apns_connect()
+    connection.protocol.send_request.side_effect = lambda *args, **kwargs: future_with_result(
+        ({"apns-id": "some-id"}, None))
+    results = connection.send_many("Hello", ["abcde", "fghij"], max_in_flight=1)
+    first = yield from results.__anext__()
+    second = yield from results.__anext__()
+    assert sorted([first, second]) == [("abcde", "some-id"), ("fghij", "some-id")]
+    with pytest.raises(StopAsyncIteration):
+        yield from results.__anext__()
+
+
+@pytest.mark.asyncio
+def test_send_compiled_payload(apns_connect):
+    connection = yield from apns_connect()
+    connection.protocol.send_request.return_value = future_with_result(
+        (mock.MagicMock(), mock.MagicMock()))
+    compiled = Payload("Hello").compile()
+    yield from connection.send_message(compiled, "abcde")
+    connection.protocol.send_request.assert_called_with(mock.ANY, compiled.data,
+                                                        high_priority=True, timeout=None)
+
+
+def test_prepare_request_headers():
+    connection = APNsConnection("some.crt", "some.key")
+    headers, data = connection._prepare_request("Hello", "abcde", NotificationPriority.delayed,
+                                                "com.example", [("apns-collapse-id", "c1")])
+    assert data == Payload("Hello").compile().data
+    assert list(headers) == [
+        (b':method', b'POST'),
+        (b':authority', connection.server_addr.encode()),
+        (b':scheme', b'https'),
+        (b':path', b'/3/device/abcde'),
+        (b'content-length', str(len(data)).encode()),
+        (b'apns-priority', b'5'),
+        (b'apns-topic', b'com.example'),
+        (b'apns-collapse-id', b'c1'),
+    ]
+
+
+def test_prepare_request_apns_id():
+    connection = APNsConnection("some.crt", "some.key")
+    headers, _ = connection._prepare_request("Hello", "abcde", NotificationPriority.immediate, None, None,
+                                             apns_id="some-id")
+    assert headers[-1] == (b'apns-id', b'some-id')
+    assert len(connection._header_templates) == 1
+
+
+def test_prepare_request_expiration():
+    connection = APNsConnection("some.crt", "some.key")
+    headers, _ = connection._prepare_request("Hello", "abcde", NotificationPriority.immediate, None, None,
+                                             expiration=1500000000)
+    assert headers[-1] == (b'apns-expiration', b'1500000000')
+
+
+@pytest.mark.asyncio
+def test_expired_not_sent(apns_connect):
+    connection = yield from apns_connect()
+    connection.metrics = MetricsRecorder()
+    with pytest.raises(APNsExpiredError):
+        yield from connection.send_message("Hello", "abcde", expiration=int(time.time()) - 1)
+    assert not connection.protocol.send_request.called
+    assert connection.metrics.counters["reason_Expired"] == 1
+
+
+@pytest.mark.asyncio
+def test_deadline_limits_queue_timeout(apns_connect):
+    connection = yield from apns_connect()
+    failed = asyncio.Future()
+    failed.set_exception(asyncio.TimeoutError())
+    connection.protocol.send_request.return_value = failed
+    with pytest.raises(APNsExpiredError):
+        yield from connection.send_message("Hello", "abcde", queue_timeout=10, deadline=time.time() - 0.001)
+    assert not connection.protocol.send_request.called
+    with mock.patch("asyncio_apns.apns_connection.time") as clock:
+        clock.time.side_effect = [100.0, 101.0]
+        with pytest.raises(APNsExpiredError):
+            yield from connection.send_message("Hello", "abcde", queue_timeout=10, deadline=100.5)
+    assert connection.protocol.send_request.call_args[1]["timeout"] == 0.5
+
+
+def test_prepare_request_list_headers():
+    connection = APNsConnection("some.crt", "some.key")
+    headers, _ = connection._prepare_request("Hello", "abcde", NotificationPriority.immediate, None,
+                                             [["apns-collapse-id", "c1"]])
+    assert headers[-1] == (b'apns-collapse-id', b'c1')
+
+
+def test_header_template_reused():
+    connection = APNsConnection("some.crt", "some.key")
+    first, _ = connection._prepare_request("Hello", "abcde", NotificationPriority.immediate, None, None)
+    second, _ = connection._prepare_request("Hello", "fghij", NotificationPriority.immediate, None, None)
+    assert first[0] is second[0]
+    assert first[-1] is second[-1]
+    assert len(connection._header_templates) == 1
+
+
+@pytest.mark.asyncio
+def test_message_metrics(apns_connect):
+    connection = yield from apns_connect()
+    connection.metrics = MetricsRecorder()
+    connection.protocol.send_request.return_value = future_with_result(({"apns-id": "some-id"}, None))
+    yield from connection.send_message("Hello", "abcde")
+    assert connection.metrics.counters["delivered"] == 1
+    assert len(connection.metrics.histograms["message"]) == 1
+
+
+@pytest.mark.asyncio
+def test_unprocessed_message_resent(apns_connect):
+    connection = yield from apns_connect()
+    failed = asyncio.Future()
+    failed.set_exception(UnprocessedStreamError(0))
+    connection.protocol.send_request.side_effect = [failed, future_with_result(({"apns-id": "some-id"}, None))]
+    result = yield from connection.send_message("Hello", "abcde")
+    assert result == "some-id"
+    assert connection.protocol.send_request.call_count == 2
+
+
+@pytest.mark.asyncio
+def test_disconnect_not_resent(apns_connect):
+    connection = yield from apns_connect()
+    failed = asyncio.Future()
+    failed.set_exception(DisconnectError(0))
+    connection.protocol.send_request.return_value = failed
+    with pytest.raises(APNsDisconnectError):
+        yield from connection.send_message("Hello", "abcde")
+    assert connection.protocol.send_request.call_count == 1
+
+
+def test_error_reason():
+    error = HTTP2Error(400, {":status": "400"}, b'{"reason":"BadDeviceToken"}')
+    assert _error_reason(error) is Reason.BadDeviceToken
+    error = HTTP2Error(400, {":status": "400"}, b'{"reason": "SomethingNew", "timestamp": 1}')
+    assert _error_reason(error) == "SomethingNew"
+    assert _error_reason(HTTP2Error(500, {":status": "500"})) is None
+
+
+@pytest.mark.asyncio
+def test_error_response(apns_connect):
+    connection = yield from apns_connect()
+    failed = asyncio.Future()
+    failed.set_exception(HTTP2Error(410, {":status": "410", "apns-id": "some-id"},
+                                    b'{"reason": "Unregistered", "timestamp": 1500000000000}'))
+    connection.protocol.send_request.return_value = failed
+    with pytest.raises(APNsError) as excinfo:
+        yield from connection.send_message("Hello", "abcde")
+    assert excinfo.value.status is Reason.Unregistered
+    assert excinfo.value.status == "Unregistered"
+    assert excinfo.value.identifier == "some-id"
+    assert excinfo.value.timestamp == 1500000000000
+    assert str(excinfo.value) == "APNsError(Unregistered)"
+
+
+@pytest.mark.asyncio
+def test_invalid_token_not_resent(apns_connect, event_loop):
+    connection = yield from apns_connect()
+    connection.invalid_tokens = InvalidTokenCache(loop=event_loop)
+    failed = asyncio.Future()
+    failed.set_exception(HTTP2Error(410, {":status": "410"},
+                                    b'{"reason": "Unregistered", "timestamp": %d}' % (time.time() * 1000)))
+    connection.protocol.send_request.return_value = failed
+    for _ in range(2):
+        with pytest.raises(APNsError) as excinfo:
+            yield from connection.send_message("Hello", "abcde")
+        assert excinfo.value.status is Reason.Unregistered
+        assert excinfo.value.code == 410
+    assert connection.protocol.send_request.call_count == 1
+
+
+@pytest.mark.asyncio
+def test_throttled_cuts_concurrency(apns_connect):
+    connection = yield from apns_connect()
+    connection.limiter = AIMDLimiter(10)
+    failed = asyncio.Future()
+    failed.set_exception(HTTP2Error(429, {":status": "429"}, json.dumps({"reason": "TooManyRequests"}).encode()))
+    connection.protocol.send_request.return_value = failed
+    with pytest.raises(APNsError) as excinfo:
+        yield from connection.send_message("Hello", "abcde")
+    assert excinfo.value.code == 429
+    assert connection.limiter.limit == 5
+    assert connection.limiter.in_flight == 0
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_standby_used_on_reconnect(event_loop):
+    with mock.patch("asyncio_apns.apns_connection.H2ClientProtocol") as mock_protocol:
+        protocols = [mock.MagicMock() for _ in range(3)]
+        mock_protocol.connect.side_effect = [future_with_result(p) for p in protocols]
+        connection = APNsConnection("some.crt", "some.key", loop=event_loop, standby_connections=1)
+        yield from connection.connect()
+        yield from asyncio.sleep(0)
+        assert connection.protocol is protocols[0]
+        assert connection.standby_ready == 1
+
+        protocols[0].connected = False
+        yield from connection.connect()
+        assert connection.protocol is protocols[1]
+        yield from asyncio.sleep(0)
+        # only the new standby connection was opened
+        assert mock_protocol.connect.call_count == 3
+        assert connection.standby_ready == 1
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_failed_standby_retried(event_loop):
+    with mock.patch("asyncio_apns.apns_connection.H2ClientProtocol") as mock_protocol, \
+            mock.patch("asyncio_apns.apns_connection.STANDBY_RETRY_DELAY", 0.01):
+        failed = asyncio.Future()
+        failed.set_exception(OSError("connection refused"))
+        protocols = [mock.MagicMock() for _ in range(2)]
+        mock_protocol.connect.side_effect = [future_with_result(protocols[0]), failed,
+                                             future_with_result(protocols[1])]
+        connection = APNsConnection("some.crt", "some.key", loop=event_loop, standby_connections=1,
+                                    metrics=MetricsRecorder())
+        yield from connection.connect()
+        yield from asyncio.sleep(0)
+        assert connection.standby_ready == 0
+        assert connection.metrics.counters["standby_connect_failed"] == 1
+        yield from asyncio.sleep(0.02)
+        assert connection.standby_ready == 1
+        assert connection._standby_retry_delay == 0.01
+        connection.disconnect()
@@ -0,0 +1,176 @@
+import asyncio
+import json
+import os
+from unittest import mock
+
+import pytest
+
+from asyncio_apns import (APNsDisconnectError, APNsError, APNsExpiredError, DurableSender, NotificationPriority,
+                          Reason, SegmentLog)
+
+
+def future_with_result(result):
+    f = asyncio.Future()
+    f.set_result(result)
+    return f
+
+
+def future_with_exception(exc):
+    f = asyncio.Future()
+    f.set_exception(exc)
+    return f
+
+
+def segments(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(".log"))
+
+
+def test_replay_unacked(tmpdir):
+    log = SegmentLog(str(tmpdir), segment_size=4096)
+    first = log.append("abcde", b'{"aps": {}}', [("apns-topic", "com.example")], expiry=2000000000)
+    second = log.append("fghij", b'{}')
+    log.ack(first)
+    entries = list(log.replay())
+    assert [(entry.sequence, entry.token) for entry in entries] == [(second, "fghij")]
+    assert log.pending == 1
+
+
+def test_resume_after_crash(tmpdir):
+    log = SegmentLog(str(tmpdir), segment_size=4096)
+    log.append("abcde", b'{"aps": {}}', [("apns-topic", "com.example")], expiry=2000000000)
+    log.append("fghij", b'{}')
+    third = log.append("klmno", b'{}')
+    log.ack(third)
+    log.checkpoint()
+    # the process dies without closing the log
+    reopened = SegmentLog(str(tmpdir), segment_size=4096)
+    entries = list(reopened.replay())
+    assert [entry.token for entry in entries] == ["abcde", "fghij"]
+    assert entries[0].headers == [("apns-topic", "com.example")]
+    assert entries[0].payload == b'{"aps": {}}'
+    assert entries[0].expiry == 2000000000
+    assert reopened.next_sequence == third + 1
+    assert reopened.append("pqrst", b'{}') == third + 1
+
+
+def test_torn_record_ignored(tmpdir):
+    log = SegmentLog(str(tmpdir), segment_size=4096)
+    log.append("abcde", b'{}')
+    offset = log._offset
+    log.append("fghij", b'{}')
+    # the second record was only partly written when the process died
+    log._mmap[offset + 30] ^= 0xff
+    reopened = SegmentLog(str(tmpdir), segment_size=4096)
+    assert [entry.token for entry in reopened.replay()] == ["abcde"]
+    assert reopened.next_sequence == 1
+
+
+def test_segments_removed_on_checkpoint(tmpdir):
+    log = SegmentLog(str(tmpdir), segment_size=128)
+    sequences = [log.append("{:064x}".format(i), b'{}') for i in range(4)]
+    assert len(segments(str(tmpdir))) == 4
+    for sequence in sequences[:3]:
+        log.ack(sequence)
+    log.checkpoint()
+    assert len(segments(str(tmpdir))) == 1
+    assert [entry.sequence for entry in log.replay()] == [sequences[3]]
+    log.close()
+
+
+def test_too_big(tmpdir):
+    log = SegmentLog(str(tmpdir), segment_size=64)
+    with pytest.raises(ValueError):
+        log.append("abcde", b'x' * 100)
+
+
+@pytest.mark.asyncio
+def test_durable_send(tmpdir, event_loop):
+    client = mock.MagicMock()
+    log = SegmentLog(str(tmpdir), segment_size=4096)
+    sender = DurableSender(client, log, loop=event_loop)
+    client.send_message.return_value = future_with_result("some-id")
+    assert (yield from sender.send_message("Hello", "abcde")) == "some-id"
+    client.send_message.return_value = future_with_exception(APNsError(Reason.BadDeviceToken, None, 400))
+    with pytest.raises(APNsError):
+        yield from sender.send_message("Hello", "abcde")
+    assert log.pending == 0
+
+    # left behind by a crash
+    log.append("fghij", b'{}', [("apns-priority", "5"), ("apns-topic", "com.example")])
+    client.send_message.return_value = future_with_result("other-id")
+    results = sender.resume()
+    assert (yield from results.__anext__()) == ("fghij", "other-id")
+    args = client.send_message.call_args[0]
+    assert args[1:4] == ("fghij", NotificationPriority.delayed, "com.example")
+    assert log.pending == 0
+
+
+@pytest.mark.asyncio
+def test_disconnected_resent(tmpdir, event_loop):
+    client = mock.MagicMock()
+    log = SegmentLog(str(tmpdir), segment_size=4096)
+    sender = DurableSender(client, log, retry_delay=0.001, loop=event_loop)
+    client.send_message.side_effect = [future_with_exception(APNsDisconnectError(None)),
+                                       future_with_exception(asyncio.TimeoutError()),
+                                       future_with_result("some-id")]
+    assert (yield from sender.send_message("Hello", "abcde")) == "some-id"
+    assert client.send_message.call_count == 3
+    assert log.next_sequence == 1
+    assert log.pending == 0
+
+
+@pytest.mark.asyncio
+def test_attempts_limited(tmpdir, event_loop):
+    client = mock.MagicMock()
+    log = SegmentLog(str(tmpdir), segment_size=4096)
+    sender = DurableSender(client, log, retry_delay=0.001, max_attempts=3, loop=event_loop)
+    client.send_message.side_effect = lambda *args, **kwargs: future_with_exception(APNsDisconnectError(None))
+    with pytest.raises(APNsDisconnectError):
+        yield from sender.send_message("Hello", "abcde")
+    assert client.send_message.call_count == 3
+    assert log.pending == 1
+
+    client.send_message.side_effect = None
+    client.send_message.return_value = future_with_result("some-id")
+    results = sender.resume()
+    assert (yield from results.__anext__()) == ("abcde", "some-id")
+    assert log.pending == 0
+
+
+def test_acked_stored_as_ranges(tmpdir):
+    log = SegmentLog(str(tmpdir), segment_size=4096)
+    for _ in range(10):
+        log.append("abcde", b'{}')
+    for sequence in (2, 3, 4, 6, 7):
+        log.ack(sequence)
+    log.checkpoint()
+    with open(os.path.join(str(tmpdir), "checkpoint")) as checkpoint:
+        assert json.load(checkpoint)["ranges"] == [[2, 5], [6, 8]]
+    reopened = SegmentLog(str(tmpdir), segment_size=4096)
+    assert reopened.acked == {2, 3, 4, 6, 7}
+    assert [entry.sequence for entry in reopened.replay()] == [0, 1, 5, 8, 9]
+
+
+@pytest.mark.asyncio
+def test_expired_not_resent(tmpdir, event_loop):
+    client = mock.MagicMock()
+    log = SegmentLog(str(tmpdir), segment_size=4096)
+    log.append("abcde", b'{}', expiry=1)
+    sender = DurableSender(client, log, loop=event_loop)
+    results = sender.resume()
+    assert (yield from results.__anext__()) == ("abcde", None)
+    assert not client.send_message.called
+    assert log.pending == 0
+
+
+@pytest.mark.asyncio
+def test_expired_send_acked(tmpdir, event_loop):
+    client = mock.MagicMock()
+    log = SegmentLog(str(tmpdir), segment_size=4096)
+    sender = DurableSender(client, log, loop=event_loop)
+    client.send_message.return_value = future_with_exception(APNsExpiredError())
+    with pytest.raises(APNsExpiredError):
+        yield from sender.send_message("Hello", "abcde", expiry=1500000000)
+    client.send_message.assert_called_with(mock.ANY, "abcde", NotificationPriority.immediate, None, None,
+                                           expiration=1500000000)
+    assert log.pending == 0
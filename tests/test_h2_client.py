@@ -1,13 +1,19 @@
 import asyncio
 import functools
+import os
+import shutil
 from unittest import mock
 import sys
 
 import pytest
 
-from h2.events import WindowUpdated, ResponseReceived, StreamEnded, ConnectionTerminated
+from h2.errors import ErrorCodes
+from h2.events import (WindowUpdated, ResponseReceived, StreamEnded, ConnectionTerminated, DataReceived,
+                       PingAcknowledged, StreamReset)
 from h2.exceptions import TooManyStreamsError
-from asyncio_apns.h2_client import H2ClientProtocol, HTTP2Error, DisconnectError
+from asyncio_apns.h2_client import (H2ClientProtocol, HTTP2Error, ResponseHeaders, DisconnectError,
+                                    UnprocessedStreamError, ssl_context)
+from asyncio_apns.metrics import MetricsRecorder
 
 
 @pytest.fixture
@@ -135,6 +141,7 @@ def test_too_many_streams_handled(apns_response):
     transport = mock.MagicMock()
     protocol.connection_made(transport)
 
+    conn.remote_settings.max_concurrent_streams = 100
     conn.send_headers.side_effect = TooManyStreamsError
     conn.get_next_available_stream_id.return_value = 1
     future = asyncio.ensure_future(protocol.send_request([]))
@@ -159,6 +166,7 @@ def test_too_many_streams_on_terminated():
     transport = mock.MagicMock()
     protocol.connection_made(transport)
 
+    conn.remote_settings.max_concurrent_streams = 100
     conn.send_headers.side_effect = TooManyStreamsError
     conn.get_next_available_stream_id.return_value = 1
     future = asyncio.ensure_future(protocol.send_request([]))
@@ -227,7 +235,8 @@ def test_request_with_body_window_limit(apns_response, event_loop, opened_for_st
 
     future = asyncio.ensure_future(protocol._send_request(stream_id, [], body=body))
     yield from asyncio.sleep(0)
-    assert stream_id in protocol.flow_control_futures
+    assert protocol.streams[stream_id].flow_control is not None
+    assert stream_id in protocol.blocked_streams
     assert not future.done()
 
     event = WindowUpdated()
@@ -242,4 +251,306 @@ def test_request_with_body_window_limit(apns_response, event_loop, opened_for_st
 
     yield from future
     assert future.done()
-    assert not protocol.flow_control_futures
+    assert not protocol.blocked_streams
+    assert not protocol.streams
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_coalesced_writes(event_loop):
+    conn = mock.MagicMock()
+    protocol = H2ClientProtocol(conn, loop=event_loop, coalesce_writes=True)
+    transport = mock.MagicMock()
+    conn.data_to_send.return_value = b'preface'
+    protocol.connection_made(transport)
+    transport.write.reset_mock()
+
+    conn.data_to_send.return_value = b'frame'
+    protocol._write()
+    protocol._write()
+    assert not transport.write.called
+    yield from asyncio.sleep(0)
+    transport.write.assert_called_once_with(b'frameframe')
+
+
+def test_coalesced_writes_threshold(event_loop):
+    conn = mock.MagicMock()
+    protocol = H2ClientProtocol(conn, loop=event_loop, coalesce_writes=True, write_threshold=10)
+    transport = mock.MagicMock()
+    protocol.connection_made(transport)
+    transport.write.reset_mock()
+
+    conn.data_to_send.return_value = b'frame'
+    protocol._write()
+    assert not transport.write.called
+    protocol._write()
+    transport.write.assert_called_once_with(b'frameframe')
+    assert protocol._flush_handle is None
+
+
+@pytest.mark.asyncio
+def test_response_body_frames_joined(apns_response, event_loop):
+    conn = mock.MagicMock()
+    protocol = H2ClientProtocol(conn)
+    transport = mock.MagicMock()
+    protocol.connection_made(transport)
+
+    future = asyncio.ensure_future(protocol._send_request(1, [], body=None))
+    response, ended = apns_response(stream_id=1, status=400)
+    frames = []
+    for chunk in (b'{"reason":', b'"BadDeviceToken"}'):
+        frame = DataReceived()
+        frame.stream_id = 1
+        frame.data = chunk
+        frame.flow_controlled_length = len(chunk)
+        frames.append(frame)
+    conn.receive_data.return_value = [response] + frames + [ended]
+    event_loop.call_soon(functools.partial(protocol.data_received, b'some_data'))
+
+    with pytest.raises(HTTP2Error):
+        yield from future
+    assert future.exception().json_data() == {"reason": "BadDeviceToken"}
+    conn.acknowledge_received_data.assert_has_calls([mock.call(10, 1), mock.call(17, 1)])
+    assert not protocol.streams
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_blocked_body_on_disconnect(event_loop):
+    conn = mock.MagicMock()
+    protocol = H2ClientProtocol(conn)
+    transport = mock.MagicMock()
+    protocol.connection_made(transport)
+
+    conn.local_flow_control_window.return_value = 10
+    conn.max_outbound_frame_size = 10
+    future = asyncio.ensure_future(protocol._send_request(1, [], body=b'a' * 100))
+    yield from asyncio.sleep(0)
+    protocol.connection_lost(Exception())
+
+    with pytest.raises(DisconnectError):
+        yield from future
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_response_while_body_blocked(apns_response, event_loop):
+    conn = mock.MagicMock()
+    protocol = H2ClientProtocol(conn)
+    transport = mock.MagicMock()
+    protocol.connection_made(transport)
+
+    conn.local_flow_control_window.return_value = 10
+    conn.max_outbound_frame_size = 10
+    future = asyncio.ensure_future(protocol._send_request(1, [], body=b'a' * 100))
+    yield from asyncio.sleep(0)
+    assert 1 in protocol.blocked_streams
+
+    conn.receive_data.return_value = apns_response(stream_id=1, status=413)
+    protocol.data_received(b'some_data')
+    assert not protocol.blocked_streams
+    # a connection window update afterwards finds nothing to unblock
+    conn.receive_data.return_value = [WindowUpdated()]
+    protocol.data_received(b'some_data')
+
+    with pytest.raises(HTTP2Error):
+        yield from future
+    assert future.exception().code == 413
+    conn.reset_stream.assert_called_once_with(1, ErrorCodes.NO_ERROR)
+    assert not conn.end_stream.called
+
+
+@pytest.mark.asyncio
+def test_metrics_request(apns_response, event_loop):
+    conn = mock.MagicMock()
+    metrics = MetricsRecorder()
+    protocol = H2ClientProtocol(conn, metrics=metrics)
+    transport = mock.MagicMock()
+    protocol.connection_made(transport)
+
+    future = asyncio.ensure_future(protocol._send_request(1, [], body=None))
+    conn.receive_data.return_value = apns_response(stream_id=1)
+    event_loop.call_soon(functools.partial(protocol.data_received, b'some_data'))
+    yield from future
+
+    assert metrics.counters["status_200"] == 1
+    assert len(metrics.histograms["response_headers"]) == 1
+    assert len(metrics.histograms["request"]) == 1
+    protocol.connection_lost(None)
+    assert metrics.counters["connection_lost"] == 1
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_metrics_stream_queued(apns_response):
+    conn = mock.MagicMock()
+    metrics = MetricsRecorder()
+    protocol = H2ClientProtocol(conn, metrics=metrics)
+    transport = mock.MagicMock()
+    protocol.connection_made(transport)
+
+    conn.remote_settings.max_concurrent_streams = 100
+    conn.send_headers.side_effect = TooManyStreamsError
+    conn.get_next_available_stream_id.return_value = 1
+    future = asyncio.ensure_future(protocol.send_request([]))
+    yield from asyncio.sleep(0)
+    conn.send_headers.side_effect = None
+    protocol._on_stream_closed()
+    yield from asyncio.sleep(0)
+    conn.receive_data.return_value = apns_response(stream_id=1)
+    protocol.data_received(b'some_data')
+    yield from future
+    assert metrics.counters["stream_queued"] == 1
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_requests_queued_over_stream_limit(apns_response):
+    conn = mock.MagicMock()
+    protocol = H2ClientProtocol(conn)
+    transport = mock.MagicMock()
+    protocol.connection_made(transport)
+
+    conn.remote_settings.max_concurrent_streams = 1
+    conn.get_next_available_stream_id.side_effect = [1, 3]
+    first = asyncio.ensure_future(protocol.send_request([]))
+    second = asyncio.ensure_future(protocol.send_request([]))
+    yield from asyncio.sleep(0)
+    assert conn.send_headers.call_count == 1
+    assert protocol.queue_depth == 1
+
+    conn.receive_data.return_value = apns_response(stream_id=1)
+    protocol.data_received(b'some_data')
+    yield from first
+    yield from asyncio.sleep(0)
+    assert conn.send_headers.call_count == 2
+    assert protocol.queue_depth == 0
+    conn.receive_data.return_value = apns_response(stream_id=3)
+    protocol.data_received(b'some_data')
+    yield from second
+    assert protocol.admission.active == 0
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_goaway_unprocessed_streams(event_loop):
+    conn = mock.MagicMock()
+    protocol = H2ClientProtocol(conn)
+    transport = mock.MagicMock()
+    protocol.connection_made(transport)
+    protocol.on_goaway = mock.MagicMock()
+
+    processed = asyncio.ensure_future(protocol._send_request(1, [], body=None))
+    unprocessed = asyncio.ensure_future(protocol._send_request(3, [], body=None))
+    yield from asyncio.sleep(0)
+    event = ConnectionTerminated()
+    event.error_code = 0
+    event.last_stream_id = 1
+    conn.receive_data.return_value = [event]
+    protocol.data_received(b'some_data')
+
+    with pytest.raises(DisconnectError) as excinfo:
+        yield from processed
+    assert not isinstance(excinfo.value, UnprocessedStreamError)
+    with pytest.raises(UnprocessedStreamError):
+        yield from unprocessed
+    protocol.on_goaway.assert_called_once_with(protocol)
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_refused_stream(event_loop):
+    conn = mock.MagicMock()
+    protocol = H2ClientProtocol(conn)
+    transport = mock.MagicMock()
+    protocol.connection_made(transport)
+
+    future = asyncio.ensure_future(protocol._send_request(1, [], body=None))
+    yield from asyncio.sleep(0)
+    event = StreamReset()
+    event.stream_id = 1
+    event.error_code = ErrorCodes.REFUSED_STREAM
+    conn.receive_data.return_value = [event]
+    protocol.data_received(b'some_data')
+
+    with pytest.raises(UnprocessedStreamError):
+        yield from future
+    assert not protocol.streams
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_ping_rtt(event_loop):
+    conn = mock.MagicMock()
+    metrics = MetricsRecorder()
+    protocol = H2ClientProtocol(conn, loop=event_loop, ping_interval=0.01, metrics=metrics)
+    protocol.connection_made(mock.MagicMock())
+    yield from asyncio.sleep(0.02)
+    assert conn.ping.call_count == 1
+    event = PingAcknowledged()
+    event.ping_data = conn.ping.call_args[0][0]
+    conn.receive_data.return_value = [event]
+    protocol.data_received(b'some_data')
+    assert protocol.rtt is not None
+    assert metrics.histograms["ping_rtt"] == [protocol.rtt]
+    assert protocol._ping_timeout_handle is None
+    assert protocol.connected
+    protocol.connection_lost(None)
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_no_ping_while_receiving(event_loop):
+    conn = mock.MagicMock()
+    conn.receive_data.return_value = []
+    protocol = H2ClientProtocol(conn, loop=event_loop, ping_interval=0.02)
+    protocol.connection_made(mock.MagicMock())
+    for _ in range(4):
+        yield from asyncio.sleep(0.01)
+        protocol.data_received(b'some_data')
+    assert not conn.ping.called
+    protocol.connection_lost(None)
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_ping_timeout(event_loop):
+    conn = mock.MagicMock()
+    protocol = H2ClientProtocol(conn, loop=event_loop, ping_timeout=0.01)
+    transport = mock.MagicMock()
+    protocol.connection_made(transport)
+    future = asyncio.ensure_future(protocol._send_request(1, [], body=None))
+    yield from asyncio.sleep(0)
+    protocol.send_ping()
+    yield from asyncio.sleep(0.02)
+    assert not protocol.connected
+    transport.abort.assert_called_once_with()
+    with pytest.raises(DisconnectError):
+        yield from future
+
+
+def test_ssl_context_cached():
+    context = ssl_context(verify_ssl=False)
+    assert ssl_context(verify_ssl=False) is context
+    assert ssl_context() is not context
+
+
+def test_ssl_context_reloaded_on_change(tmpdir):
+    source = os.path.join(os.path.dirname(__file__), os.pardir, "tests_mocked_server")
+    cert_file, key_file = str(tmpdir.join("cert.pem")), str(tmpdir.join("key.pem"))
+    shutil.copy(os.path.join(source, "cert.pem"), cert_file)
+    shutil.copy(os.path.join(source, "key.pem"), key_file)
+    context = ssl_context(cert_file, key_file)
+    assert ssl_context(cert_file, key_file) is context
+    # a renewed certificate at the same path
+    os.utime(cert_file, ns=(0, 0))
+    assert ssl_context(cert_file, key_file) is not context
+
+
+def test_response_headers():
+    headers = ResponseHeaders([(":status", "200"), ("apns-id", "some-id")])
+    assert headers["apns-id"] == "some-id"
+    assert headers.get("apns-topic") is None
+    assert dict(headers) == {":status": "200", "apns-id": "some-id"}
+    with pytest.raises(KeyError):
+        headers["apns-topic"]
@@ -0,0 +1,112 @@
+import asyncio
+
+import pytest
+
+from asyncio_apns import InvalidToken, InvalidTokenCache, Reason
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_expires_after_ttl(event_loop):
+    clock = Clock()
+    cache = InvalidTokenCache(ttl=10, clock=clock, loop=event_loop)
+    cache.add("abcde", Reason.BadDeviceToken, 400)
+    assert "abcde" in cache
+    assert cache.get("abcde") == InvalidToken("abcde", Reason.BadDeviceToken, 400, None)
+    clock.now += 10
+    assert "abcde" not in cache
+    assert len(cache) == 0
+
+
+def test_ttl_from_added(event_loop):
+    clock = Clock()
+    cache = InvalidTokenCache(ttl=10, clock=clock, loop=event_loop)
+    # APNs saw the token invalid long before the ttl
+    cache.add("abcde", Reason.Unregistered, 410, timestamp=500000)
+    clock.now += 6
+    assert "abcde" in cache
+    clock.now += 4
+    assert "abcde" not in cache
+
+
+def test_least_recently_used_evicted(event_loop):
+    cache = InvalidTokenCache(max_size=2, loop=event_loop)
+    cache.add("first", Reason.Unregistered)
+    cache.add("second", Reason.Unregistered)
+    assert "first" in cache
+    cache.add("third", Reason.Unregistered)
+    assert "first" in cache
+    assert "second" not in cache
+    assert "third" in cache
+
+
+def test_discard(event_loop):
+    cache = InvalidTokenCache(loop=event_loop)
+    cache.add("abcde", Reason.Unregistered)
+    cache.discard("abcde")
+    assert "abcde" not in cache
+
+
+def test_discard_stale_registration(event_loop):
+    cache = InvalidTokenCache(loop=event_loop)
+    cache.add("abcde", Reason.Unregistered, 410, timestamp=1500000000000)
+    cache.discard("abcde", registered_at=1400000000)
+    assert "abcde" in cache
+    cache.discard("abcde", registered_at=1600000000)
+    assert "abcde" not in cache
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_sink_batches(event_loop):
+    batches = []
+
+    @asyncio.coroutine
+    def sink(batch):
+        batches.append([record.token for record in batch])
+
+    cache = InvalidTokenCache(sink=sink, batch_size=2, flush_interval=0.01, loop=event_loop)
+    cache.add("first", Reason.Unregistered)
+    cache.add("second", Reason.Unregistered)
+    cache.add("third", Reason.Unregistered)
+    yield from asyncio.sleep(0)
+    assert batches == [["first", "second"]]
+    yield from asyncio.sleep(0.02)
+    assert batches == [["first", "second"], ["third"]]
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_flush(event_loop):
+    batches = []
+
+    @asyncio.coroutine
+    def sink(batch):
+        batches.append(batch)
+
+    cache = InvalidTokenCache(sink=sink, flush_interval=60, loop=event_loop)
+    cache.add("abcde", Reason.Unregistered)
+    yield from cache.flush()
+    assert len(batches) == 1
+    assert cache._flush_handle is None
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_sink_error_reported(event_loop):
+    @asyncio.coroutine
+    def sink(batch):
+        raise RuntimeError("storage is down")
+
+    errors = []
+    event_loop.set_exception_handler(lambda loop, context: errors.append(context["exception"]))
+    cache = InvalidTokenCache(sink=sink, batch_size=1, loop=event_loop)
+    cache.add("abcde", Reason.Unregistered)
+    yield from cache.flush()
+    assert isinstance(errors[0], RuntimeError)
@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+from asyncio_apns.limiter import AIMDLimiter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_invalid_limits():
+    with pytest.raises(ValueError):
+        AIMDLimiter(10, max_limit=5)
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_waits_over_limit(event_loop):
+    limiter = AIMDLimiter(1, loop=event_loop)
+    started = yield from limiter.acquire()
+    waiting = asyncio.ensure_future(limiter.acquire(), loop=event_loop)
+    yield from asyncio.sleep(0)
+    assert not waiting.done()
+    assert limiter.queue_depth == 1
+    limiter.release(started, sample=False)
+    yield from waiting
+    assert limiter.in_flight == 1
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_additive_increase(event_loop):
+    clock = Clock()
+    limiter = AIMDLimiter(4, clock=clock, loop=event_loop)
+    for _ in range(4):
+        started = yield from limiter.acquire()
+        clock.now += 0.1
+        limiter.release(started)
+    # about one more slot per round of requests
+    assert 4.5 < limiter.limit < 5.5
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_throttled_cuts_once_per_round(event_loop):
+    clock = Clock()
+    limiter = AIMDLimiter(20, clock=clock, loop=event_loop)
+    started = []
+    for _ in range(3):
+        started.append((yield from limiter.acquire()))
+    clock.now += 0.1
+    for request_started in started:
+        limiter.release(request_started, overloaded=True)
+    assert limiter.limit == 10
+    started = yield from limiter.acquire()
+    limiter.release(started, overloaded=True)
+    assert limiter.limit == 5
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_slow_response_cuts(event_loop):
+    clock = Clock()
+    limiter = AIMDLimiter(10, clock=clock, latency_tolerance=2.0, loop=event_loop)
+    started = yield from limiter.acquire()
+    clock.now += 0.1
+    limiter.release(started)
+    started = yield from limiter.acquire()
+    clock.now += 0.5
+    limiter.release(started)
+    assert limiter.limit < 10
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_min_limit(event_loop):
+    clock = Clock()
+    limiter = AIMDLimiter(2, min_limit=2, clock=clock, loop=event_loop)
+    for _ in range(3):
+        started = yield from limiter.acquire()
+        clock.now += 0.1
+        limiter.release(started, overloaded=True)
+    assert limiter.limit == 2
@@ -1,4 +1,9 @@
-from asyncio_apns import Payload, PayloadAlert
+import json
+
+import pytest
+
+from asyncio_apns import (Payload, PayloadAlert, PayloadTemplate, PayloadTooLargeError, Slot,
+                          VOIP_MAX_PAYLOAD_SIZE)
 
 
 def test_payload():
@@ -89,3 +94,78 @@ def test_payload_alert_complete():
                  'title-loc-key': "tlk", 'title-loc-args': ["arg1", "arg2"],
                  'loc-key': "blk", 'loc-args': ["barg1", "barg2"],
                  'action-loc-key': "alk", 'launch-image': "image.png"}
+
+
+def test_payload_compile():
+    p = Payload(alert="XoXo", badge=1)
+    compiled = p.compile()
+    assert compiled.data == json.dumps(p.as_dict()).encode()
+    assert compiled.content_length == str(len(compiled.data)).encode()
+
+
+def test_compiled_payload_immutable():
+    compiled = Payload(alert="XoXo").compile()
+    with pytest.raises(AttributeError):
+        compiled.data = b'{}'
+
+
+def test_template_render():
+    template = PayloadTemplate(Payload(alert=PayloadAlert(title="Hi", body=Slot("body")),
+                                       badge=Slot("badge", int), custom={"user": Slot("name")}))
+    rendered = template.render(body="Привет, \"Bob\"", badge=3, name="bob")
+    expected = Payload(alert=PayloadAlert(title="Hi", body="Привет, \"Bob\""), badge=3, custom={"user": "bob"})
+    assert rendered.data == expected.compile().data
+    assert [payload.data for payload in template.render_many([dict(body="a", badge=1, name="x")])] == [
+        Payload(alert=PayloadAlert(title="Hi", body="a"), badge=1, custom={"user": "x"}).compile().data]
+
+
+def test_template_slot_types():
+    template = PayloadTemplate(Payload(alert=Slot("alert"), badge=Slot("badge", int)))
+    with pytest.raises(TypeError):
+        template.render(alert="Hello", badge="1")
+    with pytest.raises(TypeError):
+        template.render(alert=1, badge=1)
+    with pytest.raises(KeyError):
+        template.render(alert="Hello")
+    with pytest.raises(TypeError):
+        Slot("alert", float)
+
+
+def test_template_size():
+    with pytest.raises(PayloadTooLargeError):
+        PayloadTemplate(Payload(alert=Slot("alert", max_size=4000), custom={"x": "x" * 100}))
+    with pytest.raises(PayloadTooLargeError):
+        PayloadTemplate(Payload(alert="x" * 5000, badge=Slot("badge", int)))
+    with pytest.raises(ValueError):
+        PayloadTemplate(Payload(alert=Slot("alert"), truncate_body=True))
+    template = PayloadTemplate(Payload(alert=Slot("alert")))
+    with pytest.raises(PayloadTooLargeError):
+        template.render(alert="x" * 5000)
+    template = PayloadTemplate(Payload(alert=Slot("alert", max_size=10)))
+    with pytest.raises(PayloadTooLargeError):
+        template.render(alert="x" * 10)
+    assert template.render(alert="x" * 8).data == Payload(alert="x" * 8).compile().data
+
+
+def test_payload_too_large():
+    with pytest.raises(PayloadTooLargeError) as excinfo:
+        Payload(alert="x" * 5000).compile()
+    assert excinfo.value.limit == 4096
+    assert len(Payload(alert="x" * 5000, max_size=VOIP_MAX_PAYLOAD_SIZE).compile().data) > 4096
+
+
+def test_payload_truncate_body():
+    for body in ("x" * 5000, "Привет " * 1000, "\U0001F600" * 1000, "\"\n" * 3000):
+        payload = Payload(alert=PayloadAlert(title="Hi", body=body), badge=1, truncate_body=True)
+        data = payload.compile().data
+        assert len(data) <= 4096
+        truncated = json.loads(data.decode())['aps']['alert']['body']
+        assert truncated.endswith("…")
+        assert body.startswith(truncated[:-1])
+        # no more than the last character could have been kept
+        assert len(data) > 4096 - 12
+    payload = Payload(alert="x" * 5000, truncate_body=True)
+    assert len(payload.compile().data) == 4096
+    payload = Payload(alert="short", custom={"x": "x" * 5000}, truncate_body=True)
+    with pytest.raises(PayloadTooLargeError):
+        payload.compile()
@@ -0,0 +1,134 @@
+import asyncio
+from unittest import mock
+
+import pytest
+
+from asyncio_apns import APNsConnectionPool
+
+
+def future_with_result(result):
+    f = asyncio.Future()
+    f.set_result(result)
+    return f
+
+
+def make_connection(free_streams=10, open_streams=0):
+    connection = mock.MagicMock()
+    connection.connected = False
+    connection.protocol = None
+    connection.rtt = None
+
+    def connect():
+        connection.connected = True
+        connection.protocol = mock.MagicMock()
+        connection.protocol.connected = True
+        connection.protocol.free_streams = free_streams
+        connection.protocol.open_streams = open_streams
+        connection.protocol.max_concurrent_streams = free_streams + open_streams
+        return future_with_result(None)
+    connection.connect.side_effect = connect
+    connection.send_message.side_effect = lambda *args, **kwargs: future_with_result("apns-id")
+    return connection
+
+
+@pytest.yield_fixture
+def connection_factory():
+    with mock.patch("asyncio_apns.pool.APNsConnection") as factory:
+        factory.side_effect = lambda *args, **kwargs: make_connection()
+        yield factory
+
+
+def test_invalid_sizes():
+    with pytest.raises(ValueError):
+        APNsConnectionPool("some.crt", "some.key", min_size=2, max_size=1)
+
+
+@pytest.mark.asyncio
+def test_connect(connection_factory, event_loop):
+    pool = APNsConnectionPool("some.crt", "some.key", min_size=2, loop=event_loop)
+    yield from pool.connect()
+    assert pool.connected
+    assert pool.size == 2
+    assert [s.connected for s in pool.stats()] == [True, True]
+
+
+@pytest.mark.asyncio
+def test_least_loaded_connection_used(connection_factory, event_loop):
+    pool = APNsConnectionPool("some.crt", "some.key", min_size=2, loop=event_loop)
+    yield from pool.connect()
+    busy, idle = pool.connections
+    busy.protocol.free_streams = 1
+    idle.protocol.free_streams = 5
+    result = yield from pool.send_message("Hello", "abcde")
+    assert result == "apns-id"
+    idle.send_message.assert_called_once_with("Hello", "abcde")
+    assert not busy.send_message.called
+
+
+@pytest.mark.asyncio
+def test_lowest_rtt_connection_used(connection_factory, event_loop):
+    pool = APNsConnectionPool("some.crt", "some.key", min_size=3, loop=event_loop)
+    yield from pool.connect()
+    unknown, slow, fast = pool.connections
+    slow.rtt = 0.2
+    fast.rtt = 0.05
+    yield from pool.send_message("Hello", "abcde")
+    fast.send_message.assert_called_once_with("Hello", "abcde")
+
+
+@pytest.mark.asyncio
+def test_grow_when_saturated(connection_factory, event_loop):
+    pool = APNsConnectionPool("some.crt", "some.key", min_size=1, max_size=2, loop=event_loop)
+    yield from pool.connect()
+    pool.connections[0].protocol.free_streams = 0
+    yield from pool.send_message("Hello", "abcde")
+    assert pool.size == 2
+    assert pool.connections[1].send_message.called
+
+    pool.connections[1].protocol.free_streams = 0
+    yield from pool.send_message("Hello", "abcde")
+    assert pool.size == 2
+
+
+@pytest.mark.asyncio
+def test_shrink_when_idle(connection_factory, event_loop):
+    pool = APNsConnectionPool("some.crt", "some.key", min_size=1, max_size=2,
+                              idle_timeout=0, loop=event_loop)
+    yield from pool.connect()
+    busy = pool.connections[0]
+    busy.protocol.free_streams = 0
+    busy.protocol.open_streams = 10
+    yield from pool.send_message("Hello", "abcde")
+    assert pool.size == 2
+    extra = pool.connections[1]
+    busy.protocol.free_streams = 5
+    yield from pool.send_message("Hello", "abcde")
+    assert pool.connections == [busy]
+    assert extra.disconnect.called
+
+
+@pytest.mark.asyncio
+def test_dead_connection_replaced(connection_factory, event_loop):
+    pool = APNsConnectionPool("some.crt", "some.key", min_size=1, loop=event_loop)
+    yield from pool.connect()
+    dead = pool.connections[0]
+    dead.connected = False
+    dead.protocol.connected = False
+    yield from pool.send_message("Hello", "abcde")
+    assert pool.size == 1
+    assert pool.connections[0] is not dead
+    assert not dead.send_message.called
+    assert dead.disconnect.called
+
+
+@pytest.mark.asyncio
+def test_dead_connection_topped_up(connection_factory, event_loop):
+    pool = APNsConnectionPool("some.crt", "some.key", min_size=3, max_size=3, loop=event_loop)
+    yield from pool.connect()
+    dead = pool.connections[0]
+    dead.connected = False
+    dead.protocol.connected = False
+    yield from pool.send_message("Hello", "abcde")
+    assert pool.size == 3
+    assert dead not in pool.connections
+    assert all(connection.connected for connection in pool.connections)
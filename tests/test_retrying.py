@@ -2,8 +2,8 @@ import asyncio
 from unittest import mock
 import pytest
 
-from asyncio_apns.errors import APNsError, APNsDisconnectError
-from asyncio_apns.retrying import RetryingProxy
+from asyncio_apns.errors import APNsError, APNsDisconnectError, Reason
+from asyncio_apns.retrying import RetryBudget, RetryingProxy, RetryPolicy
 
 
 @pytest.mark.asyncio
@@ -14,9 +14,9 @@ def test_retrying_success(event_loop):
     client.send_message.side_effect = lambda *args, **kwargs: future
     args = ("some_message", "some_token")
     res = proxy.send_message(*args)
-    future.set_result(None)
-    yield from res
-    client.send_message.assert_called_once_with(*args)
+    future.set_result("some-id")
+    assert (yield from res) == "some-id"
+    client.send_message.assert_called_once_with(*args, apns_id=mock.ANY)
 
 
 @pytest.mark.asyncio
@@ -34,6 +34,69 @@ def test_retrying_with_error(event_loop):
     with pytest.raises(APNsError) as excinfo:
         yield from res
     assert excinfo.value is exception
-    client.send_message.assert_called_once_with(*args, **kwargs)
+    client.send_message.assert_called_once_with(*args, apns_id=mock.ANY, **kwargs)
 
-# TODO test APNsDisconnectError
+
+def failing(*errors, result="some-id"):
+    results = list(errors)
+
+    def send_message(*args, **kwargs):
+        future = asyncio.Future()
+        if results:
+            future.set_exception(results.pop(0))
+        else:
+            future.set_result(result)
+        return future
+    return send_message
+
+
+@pytest.mark.asyncio
+def test_retrying_disconnect(event_loop):
+    client = mock.MagicMock()
+    client.send_message.side_effect = failing(APNsDisconnectError(None), APNsError(Reason.TooManyRequests, None))
+    proxy = RetryingProxy(client, policy=RetryPolicy(base_delay=0.001), loop=event_loop)
+    assert (yield from proxy.send_message("some_message", "some_token")) == "some-id"
+    assert client.send_message.call_count == 3
+    # the same apns-id on every attempt
+    apns_ids = {call[1]["apns_id"] for call in client.send_message.call_args_list}
+    assert len(apns_ids) == 1
+
+
+@pytest.mark.asyncio
+def test_retrying_given_up(event_loop):
+    client = mock.MagicMock()
+    client.send_message.side_effect = failing(*[APNsDisconnectError(None)] * 3)
+    proxy = RetryingProxy(client, policy=RetryPolicy(max_attempts=2, base_delay=0.001), loop=event_loop)
+    with pytest.raises(APNsDisconnectError):
+        yield from proxy.send_message("some_message", "some_token")
+    assert client.send_message.call_count == 2
+
+
+@pytest.mark.asyncio
+def test_retrying_budget(event_loop):
+    client = mock.MagicMock()
+    client.send_message.side_effect = failing(*[APNsDisconnectError(None)] * 3)
+    budget = RetryBudget(max_balance=1, min_per_second=0)
+    proxy = RetryingProxy(client, policy=RetryPolicy(base_delay=0.001, budget=budget), loop=event_loop)
+    with pytest.raises(APNsDisconnectError):
+        yield from proxy.send_message("some_message", "some_token")
+    assert client.send_message.call_count == 2
+
+
+def test_retry_delay():
+    policy = RetryPolicy(base_delay=1, max_delay=3, random=lambda: 1.0, clock=lambda: 0.0)
+    error = APNsError(Reason.ServiceUnavailable, None)
+    assert policy.retry_delay(error, 1, None) == 1
+    assert policy.retry_delay(error, 2, None) == 2
+    assert policy.retry_delay(error, 3, None) == 3
+    assert policy.retry_delay(error, 2, deadline=1.5) is None
+    assert policy.retry_delay(APNsError(Reason.BadDeviceToken, None), 1, None) is None
+
+
+def test_message_deadline():
+    policy = RetryPolicy(deadline=60, clock=lambda: 0.0)
+    assert policy.message_deadline() == 60
+    with mock.patch("asyncio_apns.retrying.time") as clock:
+        clock.time.return_value = 1000.0
+        assert policy.message_deadline(1010.0) == 10
+        assert policy.message_deadline(2000.0) == 60
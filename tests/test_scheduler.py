@@ -0,0 +1,148 @@
+import asyncio
+import time
+from unittest import mock
+
+import pytest
+
+from asyncio_apns import APNsExpiredError, NotificationPriority, Payload, Scheduler
+from asyncio_apns.scheduler import BACKGROUND, DELAYED, IMMEDIATE
+
+
+@pytest.fixture
+def client():
+    client = mock.MagicMock()
+    client.pending = []
+
+    def send_message(*args, **kwargs):
+        future = asyncio.Future()
+        client.pending.append((args, future))
+        return future
+    client.send_message.side_effect = send_message
+    return client
+
+
+def finish(client, result="some-id"):
+    for _, future in client.pending:
+        if not future.done():
+            future.set_result(result)
+
+
+def test_invalid_weights(client, event_loop):
+    with pytest.raises(ValueError):
+        Scheduler(client, weights={BACKGROUND: 0}, loop=event_loop)
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_sent_below_limit(client, event_loop):
+    scheduler = Scheduler(client, loop=event_loop)
+    task = asyncio.ensure_future(scheduler.send_message("Hello", "abcde"), loop=event_loop)
+    yield from asyncio.sleep(0)
+    assert scheduler.in_flight == 1
+    finish(client)
+    assert (yield from task) == "some-id"
+    assert scheduler.in_flight == 0
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_classes(client, event_loop):
+    scheduler = Scheduler(client, max_in_flight=1, loop=event_loop)
+    tasks = [
+        asyncio.ensure_future(scheduler.send_message("Hello", "first"), loop=event_loop),
+        asyncio.ensure_future(scheduler.send_message("Hello", "abcde"), loop=event_loop),
+        asyncio.ensure_future(scheduler.send_message("Hello", "abcde", NotificationPriority.delayed),
+                              loop=event_loop),
+        asyncio.ensure_future(scheduler.send_message(Payload(content_available=True), "abcde",
+                                                     NotificationPriority.delayed), loop=event_loop),
+    ]
+    yield from asyncio.sleep(0)
+    assert scheduler.queue_depth(IMMEDIATE) == 1
+    assert scheduler.queue_depth(DELAYED) == 1
+    assert scheduler.queue_depth(BACKGROUND) == 1
+    finish(client)
+    while not all(task.done() for task in tasks):
+        yield from asyncio.sleep(0)
+        finish(client)
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_weighted_share(client, event_loop):
+    scheduler = Scheduler(client, max_in_flight=1, weights={IMMEDIATE: 2, DELAYED: 1}, loop=event_loop)
+    # occupies the only slot while the queues fill up
+    first = asyncio.ensure_future(scheduler.send_message("Hello", "first"), loop=event_loop)
+    yield from asyncio.sleep(0)
+    tasks = [asyncio.ensure_future(scheduler.send_message("Hello", "delayed", NotificationPriority.delayed),
+                                   loop=event_loop) for _ in range(3)]
+    tasks += [asyncio.ensure_future(scheduler.send_message("Hello", "immediate"), loop=event_loop)
+              for _ in range(3)]
+    yield from asyncio.sleep(0)
+    while len(client.pending) < 7:
+        finish(client)
+        yield from asyncio.sleep(0)
+    finish(client)
+    yield from asyncio.gather(first, *tasks, loop=event_loop)
+    order = [args[1] for args, _ in client.pending[1:]]
+    # two immediate messages for every delayed one
+    assert sorted(order[:3]) == ["delayed", "immediate", "immediate"]
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_collapsed(client, event_loop):
+    scheduler = Scheduler(client, max_in_flight=1, loop=event_loop)
+    first = asyncio.ensure_future(scheduler.send_message("Hello", "first"), loop=event_loop)
+    yield from asyncio.sleep(0)
+    old = asyncio.ensure_future(scheduler.send_message("Score 1:0", "abcde", collapse_id="score"),
+                                loop=event_loop)
+    new = asyncio.ensure_future(scheduler.send_message("Score 2:0", "abcde", collapse_id="score"),
+                                loop=event_loop)
+    yield from asyncio.sleep(0)
+    assert scheduler.merged_count == 1
+    finish(client)
+    yield from asyncio.sleep(0)
+    finish(client)
+    assert (yield from old) == "some-id"
+    assert (yield from new) == "some-id"
+    assert first.done()
+    assert len(client.pending) == 2
+    args, _ = client.pending[1]
+    assert args[0] == "Score 2:0"
+    assert args[4] == (("apns-collapse-id", "score"),)
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_collapsed_keeps_position(client, event_loop):
+    scheduler = Scheduler(client, max_in_flight=1, loop=event_loop)
+    tasks = [asyncio.ensure_future(scheduler.send_message("Hello", "first"), loop=event_loop)]
+    yield from asyncio.sleep(0)
+    tasks.append(asyncio.ensure_future(scheduler.send_message("Score 1:0", "abcde", collapse_id="score"),
+                                       loop=event_loop))
+    tasks.append(asyncio.ensure_future(scheduler.send_message("Hello", "second"), loop=event_loop))
+    tasks.append(asyncio.ensure_future(scheduler.send_message("Score 2:0", "abcde", collapse_id="score"),
+                                       loop=event_loop))
+    yield from asyncio.sleep(0)
+    for _ in range(3):
+        finish(client)
+        yield from asyncio.sleep(0)
+    yield from asyncio.gather(*tasks, loop=event_loop)
+    assert [args[:2] for args, _ in client.pending] == [("Hello", "first"), ("Score 2:0", "abcde"),
+                                                        ("Hello", "second")]
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_expired_dropped(client, event_loop):
+    scheduler = Scheduler(client, max_in_flight=1, loop=event_loop)
+    first = asyncio.ensure_future(scheduler.send_message("Hello", "abcde"), loop=event_loop)
+    expired = asyncio.ensure_future(scheduler.send_message("Hello", "fghij", deadline=time.time() + 0.01),
+                                    loop=event_loop)
+    yield from asyncio.sleep(0.02)
+    assert len(client.pending) == 1
+    finish(client)
+    assert (yield from first) == "some-id"
+    with pytest.raises(APNsExpiredError):
+        yield from expired
+    assert len(client.pending) == 1
@@ -0,0 +1,137 @@
+import asyncio
+import collections
+import socket
+from unittest import mock
+
+import pytest
+
+from asyncio_apns import APNsDisconnectError, APNsError, APNsExpiredError, InvalidTokenCache, Reason, ShardedSender
+from asyncio_apns.sharding import HashRing, WorkerError, _serve, _Worker
+
+
+TOKENS = ["{:064x}".format(i * 7919) for i in range(2000)]
+
+
+def test_tokens_spread():
+    ring = HashRing(4)
+    counts = collections.Counter(ring.shard(token) for token in TOKENS)
+    assert set(counts) == {0, 1, 2, 3}
+    assert min(counts.values()) > len(TOKENS) / 4 * 0.5
+
+
+def test_stable_when_resized():
+    before = HashRing(4)
+    after = HashRing(5)
+    moved = sum(1 for token in TOKENS if before.shard(token) != after.shard(token))
+    # about a fifth of the tokens move to the new shard, the rest stay
+    assert moved < len(TOKENS) * 0.35
+    assert all(after.shard(token) == 4 for token in TOKENS if before.shard(token) != after.shard(token))
+
+
+def test_auth_token_rejected(event_loop):
+    with pytest.raises(ValueError):
+        ShardedSender("some.crt", "some.key", auth_token=mock.MagicMock(), loop=event_loop)
+
+
+@pytest.yield_fixture
+def in_process_sender(event_loop):
+    """ShardedSender with one worker served by this event loop instead of a process."""
+    patcher = mock.patch("asyncio_apns.sharding.APNsConnectionPool")
+    pool_class = patcher.start()
+    serving = []
+
+    @asyncio.coroutine
+    def start():
+        sender = ShardedSender("some.crt", "some.key", workers=1, loop=event_loop)
+        parent_sock, child_sock = socket.socketpair()
+        serving.append(asyncio.ensure_future(_serve(child_sock, "some.crt", "some.key", {}, event_loop),
+                                             loop=event_loop))
+        reader, writer = yield from asyncio.open_connection(sock=parent_sock, loop=event_loop)
+        worker = _Worker(mock.MagicMock(), reader, writer, event_loop)
+        worker.reading = asyncio.ensure_future(sender._read_results(worker), loop=event_loop)
+        sender.workers.append(worker)
+        return sender, pool_class.return_value
+    yield start
+    patcher.stop()
+    for task in serving:
+        event_loop.run_until_complete(task)
+
+
+def future_with_exception(exc):
+    f = asyncio.Future()
+    f.set_exception(exc)
+    return f
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_worker_round_trip(in_process_sender):
+    sender, pool = yield from in_process_sender()
+    results = {"abcde": asyncio.Future(), "fghij": future_with_exception(APNsError(Reason.BadDeviceToken, None,
+                                                                                   400))}
+    results["abcde"].set_result("some-id")
+    pool.send_message.side_effect = lambda payload, token, *args, **kwargs: results[token]
+    assert (yield from sender.send_message("Hello", "abcde")) == "some-id"
+    with pytest.raises(APNsError) as excinfo:
+        yield from sender.send_message("Hello", "fghij")
+    assert excinfo.value.status == Reason.BadDeviceToken
+    assert excinfo.value.code == 400
+    yield from sender.stop()
+    assert pool.disconnect.called
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_worker_error(in_process_sender):
+    sender, pool = yield from in_process_sender()
+
+    class Unpicklable(Exception):
+        def __reduce__(self):
+            raise TypeError("cannot pickle")
+
+    errors = {"abcde": asyncio.TimeoutError(), "fghij": Unpicklable()}
+    pool.send_message.side_effect = lambda payload, token, *args, **kwargs: future_with_exception(errors[token])
+    with pytest.raises(asyncio.TimeoutError):
+        yield from sender.send_message("Hello", "abcde")
+    with pytest.raises(WorkerError):
+        yield from sender.send_message("Hello", "fghij")
+    yield from sender.stop()
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_expiration_passed_to_worker(in_process_sender):
+    sender, pool = yield from in_process_sender()
+    pool.send_message.side_effect = lambda *args, **kwargs: future_with_exception(APNsExpiredError())
+    with pytest.raises(APNsExpiredError):
+        yield from sender.send_message("Hello", "abcde", expiration=1500000000, deadline=1400000000.0)
+    assert pool.send_message.call_args[1] == dict(expiration=1500000000, deadline=1400000000.0)
+    yield from sender.stop()
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_invalid_token_timestamp(in_process_sender, event_loop):
+    sender, pool = yield from in_process_sender()
+    sender.invalid_tokens = InvalidTokenCache(loop=event_loop)
+    error = APNsError(Reason.Unregistered, None, 410, 1500000000000)
+    pool.send_message.side_effect = lambda *args, **kwargs: future_with_exception(error)
+    with pytest.raises(APNsError) as excinfo:
+        yield from sender.send_message("Hello", "abcde")
+    assert excinfo.value.timestamp == 1500000000000
+    assert sender.invalid_tokens.get("abcde").timestamp == 1500000000000
+    yield from sender.stop()
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_dead_worker(in_process_sender, event_loop):
+    sender, pool = yield from in_process_sender()
+    worker = sender.workers[0]
+    # the worker exits once its requests end
+    worker.requests.writer.write_eof()
+    yield from asyncio.wait_for(worker.reading, 1, loop=event_loop)
+    assert not worker.alive
+    with pytest.raises(APNsDisconnectError):
+        yield from asyncio.wait_for(sender.send_message("Hello", "abcde"), 1, loop=event_loop)
+    assert not worker.pending
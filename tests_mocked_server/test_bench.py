@@ -0,0 +1,45 @@
+import asyncio
+import os
+
+import pytest
+from asyncio_apns import APNsConnection
+from asyncio_apns.bench import format_result, make_payload, percentile, run_case
+from asyncio_apns.mock_server import MockAPNsServer
+
+CWD = os.path.dirname(os.path.realpath(__file__))
+CERT_FILE = os.path.join(CWD, "cert.pem")
+KEY_FILE = os.path.join(CWD, "key.pem")
+
+
+def test_percentile():
+    values = list(range(1000))
+    assert percentile(values, 0.5) == 500
+    assert percentile(values, 0.999) == 999
+    assert percentile([], 0.5) == 0.0
+
+
+def test_make_payload():
+    assert len(make_payload(1024).data) == 1024
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_run_case(event_loop):
+    server = MockAPNsServer(CERT_FILE, KEY_FILE, error_rate=0.1, loop=event_loop)
+    yield from server.start()
+    connection = APNsConnection(CERT_FILE, KEY_FILE, loop=event_loop, server_addr="127.0.0.1",
+                                server_port=server.port)
+    try:
+        result = yield from run_case(connection, 10, 256, 200, trace_memory=True, loop=event_loop)
+    finally:
+        connection.disconnect()
+        yield from server.stop()
+    assert result.messages == 200
+    assert server.responses_count == 200
+    assert result.pushes_per_sec > 0
+    assert result.p50 <= result.p99 <= result.p999
+    assert result.retained_bytes_per_message is not None
+    assert result.retained_blocks_per_message is not None
+    assert result.process_peak_rss_kib > 0
+    assert "process_peak_rss=" in format_result(result)
+    assert "retained/msg=" in format_result(result)
@@ -1,29 +1,40 @@
 import asyncio
 import os
-import subprocess
-import time
+import sys
 
 import pytest
-from asyncio_apns import APNsConnection, APNsError
+from asyncio_apns import APNsConnection, APNsError, APNsDisconnectError, InvalidTokenCache, ShardedSender
+from asyncio_apns.mock_server import MockAPNsServer
 
 CWD = os.path.dirname(os.path.realpath(__file__))
+CERT_FILE = os.path.join(CWD, "cert.pem")
+KEY_FILE = os.path.join(CWD, "key.pem")
 
 
-@pytest.yield_fixture(scope="module")
-def mock_server(request):
-    server = subprocess.Popen("./go-apns-server", shell=True, cwd=CWD)
-    time.sleep(0.5)
-    yield server
-    server.terminate()
+@pytest.yield_fixture
+def mock_server(event_loop):
+    servers = []
+
+    @asyncio.coroutine
+    def start(**kwargs):
+        server = MockAPNsServer(CERT_FILE, KEY_FILE, loop=event_loop, **kwargs)
+        yield from server.start()
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        event_loop.run_until_complete(server.stop())
+
+
+def make_connection(server, loop):
+    return APNsConnection(CERT_FILE, KEY_FILE, loop=loop, server_addr="127.0.0.1", server_port=server.port)
 
 
-@pytest.mark.skipif(not os.path.exists(os.path.join(CWD, 'go-apns-server')),
-                    reason="No binary for test server")
 @pytest.mark.asyncio
 @asyncio.coroutine
 def test_batch_send_messages(event_loop, mock_server):
-    connection = APNsConnection(os.path.join(CWD, "cert.pem"), os.path.join(CWD, "key.pem"),
-                                loop=event_loop, server_addr="127.0.0.1", server_port=8443)
+    server = yield from mock_server(error_rate=0.3)
+    connection = make_connection(server, event_loop)
     yield from connection.connect()
 
     @asyncio.coroutine
@@ -39,4 +50,165 @@ def test_batch_send_messages(event_loop, mock_server):
     for _ in range(1000):
         tasks.append(asyncio.ensure_future(send_message(), loop=event_loop))
     yield from asyncio.wait(tasks, loop=event_loop)
+    for task in tasks:
+        task.result()
+    assert server.responses_count == 1000
+    connection.disconnect()
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_max_concurrent_streams(event_loop, mock_server):
+    server = yield from mock_server(max_concurrent_streams=5, latency=0.01)
+    connection = make_connection(server, event_loop)
+    yield from connection.connect()
+    # let the client see the server SETTINGS
+    yield from asyncio.sleep(0.05, loop=event_loop)
+    tasks = [asyncio.ensure_future(connection.send_message("Hello", "abcde"), loop=event_loop)
+             for _ in range(20)]
+    yield from asyncio.sleep(0, loop=event_loop)
+    assert connection.protocol.open_streams <= 5
+    results = yield from asyncio.gather(*tasks, loop=event_loop)
+    assert all(results)
+    connection.disconnect()
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_small_flow_control_window(event_loop, mock_server):
+    server = yield from mock_server(initial_window_size=100)
+    connection = make_connection(server, event_loop)
+    yield from connection.connect()
+    yield from asyncio.sleep(0.05, loop=event_loop)
+    apns_id = yield from connection.send_message("a" * 1000, "abcde")
+    assert apns_id
     connection.disconnect()
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_goaway(event_loop, mock_server):
+    server = yield from mock_server(goaway_after=1)
+    connection = make_connection(server, event_loop)
+    yield from connection.connect()
+    old_protocol = connection.protocol
+    yield from connection.send_message("Hello", "abcde")
+    yield from asyncio.sleep(0.05, loop=event_loop)
+    # replaced in the background without waiting for the next message
+    assert not old_protocol.connected
+    assert connection.connected
+    assert connection.protocol is not old_protocol
+    assert (yield from connection.send_message("Hello", "abcde"))
+    yield from asyncio.sleep(0.05, loop=event_loop)
+    connection.disconnect()
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_goaway_resends_unprocessed(event_loop, mock_server):
+    server = yield from mock_server(latency=0.2)
+    connection = make_connection(server, event_loop)
+    yield from connection.connect()
+    task = asyncio.ensure_future(connection.send_message("Hello", "abcde"), loop=event_loop)
+    yield from asyncio.sleep(0.05, loop=event_loop)
+    server.send_goaway()
+    assert (yield from task)
+    assert server.requests_count == 2
+    assert server.responses_count == 1
+    connection.disconnect()
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_disconnect_fails_pending(event_loop, mock_server):
+    server = yield from mock_server(latency=1)
+    connection = make_connection(server, event_loop)
+    yield from connection.connect()
+    task = asyncio.ensure_future(connection.send_message("Hello", "abcde"), loop=event_loop)
+    yield from asyncio.sleep(0.05, loop=event_loop)
+    for server_connection in list(server.connections):
+        server_connection.transport.close()
+    with pytest.raises(APNsDisconnectError):
+        yield from task
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_standby_connection(event_loop, mock_server):
+    server = yield from mock_server(goaway_after=1)
+    connection = APNsConnection(CERT_FILE, KEY_FILE, loop=event_loop, server_addr="127.0.0.1",
+                                server_port=server.port, standby_connections=1)
+    yield from connection.connect()
+    yield from asyncio.sleep(0.1, loop=event_loop)
+    assert connection.standby_ready == 1
+    standby = connection._standby[0]
+
+    # the server closes the active connection with GOAWAY after this message
+    assert (yield from connection.send_message("Hello", "abcde"))
+    yield from asyncio.sleep(0.01, loop=event_loop)
+    # switched without a handshake
+    assert connection.protocol is standby
+    assert connection.connected
+    yield from asyncio.sleep(0.1, loop=event_loop)
+    assert connection.standby_ready == 1
+    connection.disconnect()
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_ping_keepalive(event_loop, mock_server):
+    server = yield from mock_server()
+    connection = APNsConnection(CERT_FILE, KEY_FILE, loop=event_loop, server_addr="127.0.0.1",
+                                server_port=server.port, ping_interval=0.01)
+    yield from connection.connect()
+    yield from asyncio.sleep(0.1, loop=event_loop)
+    assert connection.rtt is not None
+    assert connection.connected
+    connection.disconnect()
+
+
+@pytest.mark.skipif(sys.version_info < (3, 6), reason="TLS sessions are resumed from Python 3.6")
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_tls_session_resumed(event_loop, mock_server):
+    server = yield from mock_server()
+    connection = make_connection(server, event_loop)
+    yield from connection.connect()
+    assert (yield from connection.send_message("Hello", "abcde"))
+    connection.disconnect()
+    yield from asyncio.sleep(0.01, loop=event_loop)
+
+    yield from connection.connect()
+    ssl_object = connection.protocol.transport.get_extra_info("ssl_object")
+    assert ssl_object.session_reused
+    connection.disconnect()
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_sharded_sender(event_loop, mock_server):
+    server = yield from mock_server(error_rate=0.2, errors=((410, "Unregistered"),), seed=1)
+    invalid_tokens = InvalidTokenCache(loop=event_loop)
+    sender = ShardedSender(CERT_FILE, KEY_FILE, workers=2, invalid_tokens=invalid_tokens, loop=event_loop,
+                           server_addr="127.0.0.1", server_port=server.port)
+    yield from sender.start()
+    tokens = ["{:064x}".format(i) for i in range(100)]
+    results = dict()
+    for token, result in (yield from _collect(sender.send_many("Hello", tokens))):
+        results[token] = result
+    yield from sender.stop()
+    assert len(results) == 100
+    assert server.responses_count == 100
+    unregistered = [token for token, result in results.items() if isinstance(result, APNsError)]
+    assert unregistered
+    assert all(token in invalid_tokens for token in unregistered)
+
+
+@asyncio.coroutine
+def _collect(results):
+    collected = []
+    while True:
+        try:
+            collected.append((yield from results.__anext__()))
+        except StopAsyncIteration:
+            return collected